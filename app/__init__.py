@@ -36,6 +36,9 @@ def create_app(**kwargs):
     environment = os.environ.get('FLASK_ENV', 'production')
     app.config.from_object(config.config_by_name[environment])
 
+    import app.common.json_provider as json_provider
+    app.json = json_provider.AppJSONProvider(app)
+
     if app.config.get('SERVER_IS_ON_PROXY'):
         app.wsgi_app = proxy_fix.ProxyFix(
             app.wsgi_app,
@@ -1,4 +1,3 @@
-import datetime
 import flask
 import flask_admin as fadmin
 
@@ -6,6 +5,7 @@ import app.api.helper_class as api_class
 import app.database as db_module
 import app.database.user as user
 import app.database.jwt as jwt_module
+import app.database.token_revoke as token_revoke
 
 from app.api.response_case import CommonResponseCase
 from app.api.account.response_case import AccountResponseCase
@@ -22,6 +22,10 @@ class Admin_TokenRevoke_View(fadmin.BaseView):
         token_result = db.session.query(jwt_module.RefreshToken).all()
         revoked_dict = dict()
         redis_key = RedisKeyType.TOKEN_REVOKE.as_redis_key('*')
+        for k in redis_db.scan_iter(match=redis_key):
+            revoked_dict[k.decode()] = redis_db.get(k.decode()).decode()
+        # Also show revocation epochs of users, as revoking all tokens of a user changes only the epoch.
+        redis_key = RedisKeyType.TOKEN_REVOKE_EPOCH.as_redis_key('*')
         for k in redis_db.scan_iter(match=redis_key):
             revoked_dict[k.decode()] = redis_db.get(k.decode()).decode()
 
@@ -54,12 +58,9 @@ class Admin_TokenRevoke_View(fadmin.BaseView):
                 return AccountResponseCase.user_not_found.create_response(
                     message='User or JWT that mapped to that user not found')
 
-            for target in query_result:
-                # TODO: set can set multiple at once, so use that method instead
-                redis_key = RedisKeyType.TOKEN_REVOKE.as_redis_key(target.jti)
-                redis_db.set(redis_key, 'revoked', datetime.timedelta(weeks=2))
-
-                if 'do_delete' in req_body:
+            token_revoke.revoke_user_token(int(req_body['user_uuid']))
+            if 'do_delete' in req_body:
+                for target in query_result:
                     db.session.delete(target)
         else:
             query_result = db.session.query(jwt_module.RefreshToken)\
@@ -69,8 +70,7 @@ class Admin_TokenRevoke_View(fadmin.BaseView):
                 return AccountResponseCase.refresh_token_invalid(
                     message='RefreshToken that has such JTI not found')
 
-            redis_key = RedisKeyType.TOKEN_REVOKE.as_redis_key(req_body["target_jti"])
-            redis_db.set(redis_key, 'revoked', datetime.timedelta(weeks=2))
+            token_revoke.revoke_token(int(req_body['target_jti']))
 
             if 'do_delete' in req_body:
                 db.session.delete(query_result)
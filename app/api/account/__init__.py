@@ -13,6 +13,7 @@ import app.api.account.profile_img_manage as profile_img_mgr
 resource_route = {
     '/account': account_manage.AccountInformationChangeRoute,
     '/account/signup': signup.SignUpRoute,
+    '/account/signup/status': signup.SignUpStatusRoute,
     '/account/signin': signin.SignInRoute,
     '/account/signout': signout.SignOutRoute,
     '/account/refresh': refresh.AccessTokenIssueRoute,
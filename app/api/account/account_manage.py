@@ -5,6 +5,7 @@ import typing
 import app.api.helper_class as api_class
 import app.database as db_module
 import app.database.jwt as jwt_module
+import app.database.user_ident_filter as user_ident_filter
 
 from app.api.response_case import CommonResponseCase
 from app.api.account.response_case import AccountResponseCase
@@ -42,6 +43,9 @@ class AccountInformationChangeRoute(flask.views.MethodView, api_class.MethodView
         if not req_body:
             return CommonResponseCase.body_empty.create_response()
 
+        # Keep current ID and nickname to update the duplicate check sets after commit.
+        old_ident_values = {'id': target_user.id, 'nickname': target_user.nickname}
+
         did_succeed: bool = True
         failed_reason: list[typing.TypedDict('FailedReasonType', {'field': str, 'reason': str, })] = list()
         for field, value in req_body.items():
@@ -79,5 +83,12 @@ class AccountInformationChangeRoute(flask.views.MethodView, api_class.MethodView
             else:
                 raise err
 
+        changed_fields = [k for k, v in old_ident_values.items() if getattr(target_user, k) != v]
+        user_ident_filter.add_values({k: getattr(target_user, k) for k in changed_fields})
+        user_ident_filter.remove_values({
+            k: old_ident_values[k] for k in changed_fields
+            # Case-only changes keep the same lowercase value on the set.
+            if old_ident_values[k].lower() != getattr(target_user, k).lower()})
+
         return AccountResponseCase.user_safe_to_use.create_response(
             data={'user': target_user.to_dict(), }, )
@@ -6,6 +6,7 @@ import app.api.helper_class as api_class
 import app.common.utils as utils
 import app.database as db_module
 import app.database.jwt as jwt_module
+import app.database.token_revoke as token_revoke
 import app.database.user as user_module
 
 from app.api.response_case import CommonResponseCase
@@ -36,6 +37,7 @@ class AccountDeactivationRoute(flask.views.MethodView, api_class.MethodViewMixin
             - refresh_token_expired
             - refresh_token_invalid
             - server_error
+            - server_busy
         '''
         target_user: user_module.User = refresh_token.usertable
         if target_user.email != req_body['email']:
@@ -59,10 +61,8 @@ class AccountDeactivationRoute(flask.views.MethodView, api_class.MethodViewMixin
             # No refresh token of target user don't make any sense,
             # how could user get here although user don't have any valid refresh token?
             return CommonResponseCase.server_error.create_response()
+        token_revoke.revoke_user_token(target_user.uuid)
         for token in target_tokens:
-            # TODO: set can set multiple at once, so use that method instead
-            redis_key = RedisKeyType.TOKEN_REVOKE.as_redis_key(token.jti)
-            redis_db.set(redis_key, 'revoked', datetime.timedelta(weeks=2))
             db.session.delete(token)
 
         target_user.deactivated_at = datetime.datetime.utcnow().replace(tzinfo=utils.UTC)
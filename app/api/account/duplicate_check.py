@@ -5,6 +5,7 @@ import typing
 import app.api.helper_class as api_class
 import app.database as db_module
 import app.database.user as user_module
+import app.database.user_ident_filter as user_ident_filter
 
 from app.api.account.response_case import AccountResponseCase
 
@@ -32,8 +33,10 @@ class AccountDuplicateCheckRoute(flask.views.MethodView, api_class.MethodViewMix
         }
         check_result = list()
 
-        for field_name, field_value in req_body.items():
-            if db.session.query(user_module.User).filter(field_column_map[field_name] == field_value).first():
+        # Values that are not on the redis sets are not in use, so query DB only for possibly used ones.
+        for field_name in user_ident_filter.get_possibly_used_fields(req_body):
+            field_value = req_body[field_name]
+            if db.session.query(user_module.User.uuid).filter(field_column_map[field_name] == field_value).first():
                 check_result.append(field_name)
 
         if check_result:
@@ -42,6 +42,7 @@ class PasswordChangeRoute(flask.views.MethodView, api_class.MethodViewMixin):
             - password_changed
             - user_wrong_password
             - password_change_failed
+            - server_busy
         '''
         target_user: user_module.User = None
         original_password: typing.Optional[str] = req_body.get('original_password', None)
@@ -60,19 +60,33 @@ class AccountResponseCase(api_class.ResponseCaseCollector):
         description='Successfully created a new account. Welcome!',
         code=201, success=True,
         public_sub_code='user.sign_up',
-        data={'user': UserResponseModel.get_model_openapi_description(),
-              'db': '', })
+        data={'user': UserResponseModel.get_model_openapi_description(), })
     user_signed_up_but_mail_error = api_class.Response(  # User signing up success, but sign-up mail did not sent
         description='Successfully created a new account, but we couldn\'t send a confirmation mail.',
         code=201, success=True,
         public_sub_code='user.sign_up_but_mail_error',
-        data={'user': UserResponseModel.get_model_openapi_description(),
-              'db': '', })
+        data={'user': UserResponseModel.get_model_openapi_description(), })
     user_signed_up_but_need_email_verification = api_class.Response(
         # User signing up success but need email verification
         description='Successfully created a new account, and You need to verify email address. Welcome!',
         code=201, success=True,
-        public_sub_code='user.sign_up_but_need_email_verification')
+        public_sub_code='user.sign_up_but_need_email_verification',
+        data={'status_token': ''})
+    user_signup_status = api_class.Response(
+        description='Status of signup steps that are done in background. '
+                    'Each step can be PENDING, DONE, FAILED or SKIPPED, and status is empty after it\'s expired.',
+        code=200, success=True,
+        public_sub_code='user.sign_up_status',
+        data={'status': {'MAIL': 'DONE', 'SYNC_DB': 'DONE', }})
+    user_signup_mail_resent = api_class.Response(
+        description='Confirmation mail of signup will be sent again in background. Check the status later.',
+        code=202, success=True,
+        public_sub_code='user.sign_up_mail_resent')
+    user_signup_mail_resend_not_allowed = api_class.Response(
+        description='Confirmation mail of signup can be sent again only when sending it was failed.',
+        code=409, success=False,
+        public_sub_code='user.sign_up_mail_resend_not_allowed',
+        data={'reason': ''})
 
     user_safe_to_use = api_class.Response(
         description='No one isn\'t using user-wanted nick/id/email address, so you can use it.',
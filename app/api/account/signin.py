@@ -33,11 +33,16 @@ class SignInRoute(flask.views.MethodView, api_class.MethodViewMixin):
             - user_wrong_password
             - user_locked
             - user_deactivated
+            - rate_limit
+            - server_busy
         '''
-        account_result, reason = user.User.try_login(req_body['id'], req_body['pw'])
+        account_result, reason = user.User.try_login(req_body['id'], req_body['pw'], flask.request.remote_addr)
 
         if account_result is False:
-            if reason == 'ACCOUNT_NOT_FOUND':
+            if reason == 'TOO_MANY_LOGIN_FAIL_ON_IP':
+                return CommonResponseCase.rate_limit.create_response(
+                    header=(('Retry-After', str(flask.current_app.config.get('LOGIN_FAIL_IP_WINDOW'))), ))
+            elif reason == 'ACCOUNT_NOT_FOUND':
                 return AccountResponseCase.user_not_found.create_response()
             elif reason.startswith('WRONG_PASSWORD'):
                 return AccountResponseCase.user_wrong_password.create_response(
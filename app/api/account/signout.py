@@ -1,4 +1,3 @@
-import datetime
 import flask
 import flask.views
 import typing
@@ -6,6 +5,7 @@ import typing
 import app.api.helper_class as api_class
 import app.database as db_module
 import app.database.jwt as jwt_module
+import app.database.token_revoke as token_revoke
 
 from app.api.account.response_case import AccountResponseCase
 
@@ -26,8 +26,7 @@ class SignOutRoute(flask.views.MethodView, api_class.MethodViewMixin):
         if refresh_token:
             revoke_target_jti = refresh_token.jti
             try:
-                redis_key = RedisKeyType.TOKEN_REVOKE.as_redis_key(revoke_target_jti)
-                redis_db.set(redis_key, 'revoked', datetime.timedelta(weeks=2))
+                token_revoke.revoke_token(revoke_target_jti)
                 print(f'Refresh token {revoke_target_jti} registered on REDIS!')
             except Exception:
                 print('Raised error while registering token from REDIS')
@@ -2,17 +2,18 @@ import datetime
 import flask
 import flask.views
 import json
-from passlib.hash import argon2
+import typing
 import sqlalchemy as sql
 
 import app.api.helper_class as api_class
 import app.common.utils as utils
-import app.common.mailgun as mailgun
+import app.common.password_hasher as password_hasher
 import app.database as db_module
 import app.database.user as user
+import app.database.user_ident_filter as user_ident_filter
 import app.database.jwt as jwt_module
 import app.database.bca.profile as profile_module
-import app.plugin.bca.user_db.file_io as bca_sync_file_io
+import app.plugin.bca.user_db.onboarding as bca_onboarding
 
 from app.api.response_case import CommonResponseCase
 from app.api.account.response_case import AccountResponseCase
@@ -23,6 +24,30 @@ db = db_module.db
 signup_verify_mail_valid_duration: datetime.timedelta = datetime.timedelta(hours=48)
 
 
+def create_verification_mail_args(target_user: user.User) -> dict[str, str]:
+    # Create email token to verification & confirmation mail
+    email_token = user.EmailToken.create(
+        target_user, user.EmailTokenAction.EMAIL_VERIFICATION, signup_verify_mail_valid_duration)
+
+    http_or_https = 'https://' if flask.current_app.config.get('HTTPS_ENABLE', True) else 'http://'
+    email_result = flask.render_template(
+        'email/email_verify.html',
+        domain_url=http_or_https + flask.current_app.config.get('SERVER_NAME'),
+        api_base_url=(http_or_https + flask.current_app.config.get('SERVER_NAME')
+                      + '/api/' + flask.current_app.config.get('RESTAPI_VERSION')),
+        project_name=flask.current_app.config.get('PROJECT_NAME'),
+        user_nick=target_user.nickname,
+        email_key=email_token.token,
+        language='kor')
+
+    # Mail will be sent on the worker, so that the request doesn't wait for the mail provider.
+    return {
+        'fromaddr': 'do-not-reply@' + flask.current_app.config.get('MAIL_DOMAIN'),
+        'toaddr': target_user.email,
+        'subject': f'{flask.current_app.config.get("PROJECT_NAME")}에 오신 것을 환영합니다!',
+        'message': email_result, }
+
+
 class SignUpRoute(flask.views.MethodView, api_class.MethodViewMixin):
     @api_class.RequestHeader(
         required_fields={
@@ -46,6 +71,7 @@ class SignUpRoute(flask.views.MethodView, api_class.MethodViewMixin):
             - user_already_used
             - body_bad_semantics
             - server_error
+            - server_busy
         '''
         # Normalize all user inputs, including password
         for k, v in req_body.items():
@@ -71,7 +97,7 @@ class SignUpRoute(flask.views.MethodView, api_class.MethodViewMixin):
         new_user.email = req_body['email']
         new_user.id = req_body['id']
         new_user.nickname = req_body['nick']
-        new_user.password = argon2.hash(req_body['pw'])
+        new_user.password = password_hasher.hash_password(req_body['pw'])
         new_user.pw_changed_at = sql.func.now()
         new_user.last_login_date = sql.func.now()
 
@@ -117,37 +143,34 @@ class SignUpRoute(flask.views.MethodView, api_class.MethodViewMixin):
         new_user.role = json.dumps(current_role, ensure_ascii=False)
         db.session.commit()
 
-        mail_sent = True
+        user_ident_filter.add_values({
+            'id': new_user.id,
+            'nickname': new_user.nickname,
+            'email': new_user.email, })
+
+        mail_args: typing.Optional[dict[str, str]] = None
         MAIL_ENABLE = flask.current_app.config.get('MAIL_ENABLE')
         SIGNIN_POSSIBLE_AFTER_MAIL_VERIFICATION = flask.current_app.config.get(
             'SIGNIN_POSSIBLE_AFTER_MAIL_VERIFICATION')
         if MAIL_ENABLE:
             try:
-                # Create email token to verification & confirmation mail
-                email_token = user.EmailToken.create(
-                    new_user, user.EmailTokenAction.EMAIL_VERIFICATION, signup_verify_mail_valid_duration)
-
-                http_or_https = 'https://' if flask.current_app.config.get('HTTPS_ENABLE', True) else 'http://'
-                email_result = flask.render_template(
-                    'email/email_verify.html',
-                    domain_url=http_or_https + flask.current_app.config.get('SERVER_NAME'),
-                    api_base_url=(http_or_https + flask.current_app.config.get('SERVER_NAME')
-                                  + '/api/' + flask.current_app.config.get('RESTAPI_VERSION')),
-                    project_name=flask.current_app.config.get('PROJECT_NAME'),
-                    user_nick=new_user.nickname,
-                    email_key=email_token.token,
-                    language='kor')
-
-                mail_sent = mailgun.send_mail(
-                    fromaddr='do-not-reply@' + flask.current_app.config.get('MAIL_DOMAIN'),
-                    toaddr=new_user.email,
-                    subject=f'{flask.current_app.config.get("PROJECT_NAME")}에 오신 것을 환영합니다!',
-                    message=email_result)
-
-                if SIGNIN_POSSIBLE_AFTER_MAIL_VERIFICATION and mail_sent:
-                    return AccountResponseCase.user_signed_up_but_need_email_verification.create_response()
+                mail_args = create_verification_mail_args(new_user)
             except Exception:
-                mail_sent = False
+                mail_args = None
+
+        # Queue sending mail and creating user db file.
+        # Clients can check those on the signup status route, and get user db file on the sync route.
+        try:
+            bca_onboarding.start_onboarding(new_user.uuid, mail_args)
+        except Exception as err:
+            # User db will be created when the client requests it, but the mail cannot be sent.
+            print(utils.get_traceback_msg(err))
+            mail_args = None
+
+        if MAIL_ENABLE and mail_args and SIGNIN_POSSIBLE_AFTER_MAIL_VERIFICATION:
+            # User cannot sign in until the mail is verified, so give a status token to check if the mail is sent.
+            return AccountResponseCase.user_signed_up_but_need_email_verification.create_response(
+                data={'status_token': bca_onboarding.create_status_token(new_user.uuid), })
 
         jwt_data_header, jwt_data_body = jwt_module.create_login_data(
                                             new_user,
@@ -160,19 +183,85 @@ class SignUpRoute(flask.views.MethodView, api_class.MethodViewMixin):
         response_body = {'user': new_user.to_dict()}
         response_body['user'].update(jwt_data_body)
 
-        # Create and send new user db file
-        try:
-            user_db_obj = bca_sync_file_io.BCaSyncFile.create(new_user.uuid, True, True)
-            file_md5 = user_db_obj.get_hash()
-            file_b64 = user_db_obj.as_b64urlsafe()
-
-            jwt_data_header.append(('ETag', file_md5))
-            response_body['db': file_b64]
-        except Exception:
-            pass
-
         response_type: api_class.Response = AccountResponseCase.user_signed_up
-        if not mail_sent:
+        if MAIL_ENABLE and not mail_args:
             response_type = AccountResponseCase.user_signed_up_but_mail_error
 
         return response_type.create_response(header=jwt_data_header, data=response_body)
+
+
+class SignUpStatusRoute(flask.views.MethodView, api_class.MethodViewMixin):
+    @staticmethod
+    def get_target_user_id(req_header: dict,
+                           access_token: typing.Optional[jwt_module.AccessToken] = None) -> typing.Optional[int]:
+        # Users that need email verification don't have access token, so they use the status token of signup.
+        if access_token:
+            return access_token.user
+        if req_header.get('X-Signup-Status-Token', None):
+            return bca_onboarding.get_user_id_by_status_token(req_header['X-Signup-Status-Token'])
+        return None
+
+    @api_class.RequestHeader(
+        optional_fields={'X-Signup-Status-Token': {'type': 'string', }, },
+        auth={api_class.AuthType.Bearer: False, })
+    def get(self, req_header: dict, access_token: typing.Optional[jwt_module.AccessToken] = None):
+        '''
+        description: Get status of signup steps(confirmation mail and user db file) that are done in background.
+            Users that need email verification can use status_token of the signup response
+            on X-Signup-Status-Token header instead of the access token.
+        responses:
+            - user_signup_status
+            - user_not_signed_in
+            - server_error
+        '''
+        target_user_id = self.get_target_user_id(req_header, access_token)
+        if not target_user_id:
+            return AccountResponseCase.user_not_signed_in.create_response()
+
+        return AccountResponseCase.user_signup_status.create_response(
+            data={'status': bca_onboarding.get_onboarding_status(target_user_id)})
+
+    @api_class.RequestHeader(
+        optional_fields={'X-Signup-Status-Token': {'type': 'string', }, },
+        auth={api_class.AuthType.Bearer: False, })
+    def post(self, req_header: dict, access_token: typing.Optional[jwt_module.AccessToken] = None):
+        '''
+        description: Resend confirmation mail of signup. This is possible only when sending the mail was failed.
+            Users that need email verification can use status_token of the signup response
+            on X-Signup-Status-Token header instead of the access token.
+        responses:
+            - user_signup_mail_resent
+            - user_signup_mail_resend_not_allowed
+            - user_not_signed_in
+            - server_error
+        '''
+        target_user_id = self.get_target_user_id(req_header, access_token)
+        if not target_user_id:
+            return AccountResponseCase.user_not_signed_in.create_response()
+
+        if not flask.current_app.config.get('MAIL_ENABLE'):
+            return AccountResponseCase.user_signup_mail_resend_not_allowed.create_response(
+                data={'reason': 'MAIL_DISABLED'})
+
+        # Resending is allowed only after the worker gave up, so this cannot be used to send mails repeatedly.
+        mail_status = bca_onboarding.get_onboarding_status(target_user_id).get(
+            bca_onboarding.OnboardingStep.MAIL.value, None)
+        if mail_status != bca_onboarding.OnboardingStatus.FAILED.value:
+            return AccountResponseCase.user_signup_mail_resend_not_allowed.create_response(
+                data={'reason': f'MAIL_STATUS_{mail_status or "EXPIRED"}'})
+
+        target_user = db.session.query(user.User).filter(user.User.uuid == target_user_id).first()
+        if not target_user or target_user.email_verified:
+            return AccountResponseCase.user_signup_mail_resend_not_allowed.create_response(
+                data={'reason': 'EMAIL_ALREADY_VERIFIED' if target_user else 'USER_NOT_FOUND'})
+
+        # Previous mail was never delivered, so the 48 hours blocker of EmailToken.create must not block this.
+        # Previous email tokens are also deleted, as those were never delivered too.
+        db_module.redis_db.delete(db_module.RedisKeyType.EMAIL_VERIFICATION.as_redis_key(target_user.uuid))
+        db.session.query(user.EmailToken)\
+            .filter(user.EmailToken.user_id == target_user.uuid)\
+            .filter(user.EmailToken.action == user.EmailTokenAction.EMAIL_VERIFICATION)\
+            .delete(synchronize_session=False)
+
+        bca_onboarding.resend_mail(target_user.uuid, create_verification_mail_args(target_user))
+        return AccountResponseCase.user_signup_mail_resent.create_response()
@@ -15,8 +15,24 @@ from app.api.response_case import CommonResponseCase, ResourceResponseCase
 db = db_module.db
 
 
+def get_card_etag(card_id: int, **kwargs) -> typing.Optional[str]:
+    # Only public cards are validated here, as private and deleted cards need subscription checks.
+    # This queries only the columns that we need, without loading the card and its relationships.
+    target_card = db.session.query(
+            profile_module.Card.commit_id,
+            profile_module.Card.private,
+            profile_module.Card.deleted_at)\
+        .filter(profile_module.Card.locked_at.is_(None))\
+        .filter(profile_module.Card.uuid == card_id)\
+        .first()
+    if not target_card or target_card.private or target_card.deleted_at is not None:
+        return None
+    return target_card.commit_id
+
+
 class CardManagementRoute(flask.views.MethodView, api_class.MethodViewMixin):
     @api_class.RequestHeader(auth={api_class.AuthType.Bearer: False, })
+    @api_class.ConditionalGET(get_card_etag)
     def get(self, card_id: int, req_header: dict, access_token: typing.Optional[jwt_module.AccessToken] = None):
         '''
         description: Returns target card data
@@ -41,7 +57,7 @@ class CardManagementRoute(flask.views.MethodView, api_class.MethodViewMixin):
                     return ResourceResponseCase.resource_forbidden.create_response(
                         message='명함을 보려면 로그인이 필요합니다.')
 
-                elif 'admin' in access_token.role:
+                elif access_token.is_admin():
                     return ResourceResponseCase.resource_found.create_response(
                         header=(('ETag', target_card.commit_id, ), ),
                         data={'card': target_card.to_dict()}, )
@@ -104,7 +120,7 @@ class CardManagementRoute(flask.views.MethodView, api_class.MethodViewMixin):
                     message='명함을 찾을 수 없습니다.')
 
             # Card can be deleted only by created user or admin
-            if target_card.profile_id not in access_token.role:
+            if not api_class.check_profile_permission(access_token, target_card.profile_id):
                 return ResourceResponseCase.resource_forbidden.create_response(
                     message='명함 수정은 명함 제작자만이 할 수 있습니다.')
 
@@ -153,7 +169,7 @@ class CardManagementRoute(flask.views.MethodView, api_class.MethodViewMixin):
                     message='명함을 찾을 수 없습니다.')
 
             # Card can be deleted only by created user or admin
-            if 'admin' not in access_token.role and target_card.profile_id not in access_token.role:
+            if not api_class.check_profile_permission(access_token, target_card.profile_id, allow_admin=True):
                 return ResourceResponseCase.resource_forbidden.create_response(
                     message='명함 삭제는 관리자나 명함 제작자만이 할 수 있습니다.')
 
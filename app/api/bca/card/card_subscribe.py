@@ -30,7 +30,7 @@ class CardSubsctiptionRoute(flask.views.MethodView, api_class.MethodViewMixin):
         '''
         try:
             requested_profile_id: int = utils.safe_int(req_header['X-Profile-Id'])
-            if str(requested_profile_id) not in access_token.role:
+            if not api_class.check_profile_permission(access_token, requested_profile_id):
                 return ResourceResponseCase.resource_forbidden.create_response(
                     message='접속하고 계신 프로필은 본인의 프로필이 아닙니다.')
 
@@ -78,7 +78,7 @@ class CardSubsctiptionRoute(flask.views.MethodView, api_class.MethodViewMixin):
         '''
         try:
             requested_profile_id: int = utils.safe_int(req_header['X-Profile-Id'])
-            if str(requested_profile_id) not in access_token.role:
+            if not api_class.check_profile_permission(access_token, requested_profile_id):
                 return ResourceResponseCase.resource_forbidden.create_response(
                     message='접속하고 계신 프로필은 본인의 프로필이 아닙니다.')
 
@@ -176,7 +176,7 @@ class CardSubsctiptionRoute(flask.views.MethodView, api_class.MethodViewMixin):
         '''
         try:
             requested_profile_id: int = utils.safe_int(req_header['X-Profile-Id'])
-            if str(requested_profile_id) not in access_token.role:
+            if not api_class.check_profile_permission(access_token, requested_profile_id):
                 return ResourceResponseCase.resource_forbidden.create_response(
                     message='접속하고 계신 프로필은 본인의 프로필이 아닙니다.')
 
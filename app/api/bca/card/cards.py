@@ -35,7 +35,7 @@ class CardMainRoute(flask.views.MethodView, api_class.MethodViewMixin):
 
         if 'X-Profile-Id' in req_header:
             requested_profile_id = utils.safe_int(req_header.get('X-Profile-Id', 0))
-            if str(requested_profile_id) not in access_token.role:
+            if not api_class.check_profile_permission(access_token, requested_profile_id):
                 return ResourceResponseCase.resource_forbidden.create_response(
                     message='접속하고 계신 프로필은 본인의 프로필이 아닙니다.')
 
@@ -71,7 +71,7 @@ class CardMainRoute(flask.views.MethodView, api_class.MethodViewMixin):
             - server_error
         '''
         requested_profile_id = utils.safe_int(req_header['X-Profile-Id'])
-        if str(requested_profile_id) not in access_token.role:
+        if not api_class.check_profile_permission(access_token, requested_profile_id):
             return ResourceResponseCase.resource_forbidden.create_response()
 
         file_upload_enabled: bool = flask.current_app.config.get('FILE_MANAGEMENT_ROUTE_ENABLE', False)
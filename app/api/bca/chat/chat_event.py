@@ -32,7 +32,7 @@ class ChatEventRoute(flask.views.MethodView, api_class.MethodViewMixin):
         '''
         try:
             requested_profile_id: int = utils.safe_int(req_header['X-Profile-Id'])
-            if str(requested_profile_id) not in access_token.role:
+            if not api_class.check_profile_permission(access_token, requested_profile_id):
                 return ResourceResponseCase.resource_forbidden.create_response(
                     message='접속하고 계신 프로필은 본인의 프로필이 아닙니다.')
 
@@ -100,7 +100,7 @@ class ChatEventRoute(flask.views.MethodView, api_class.MethodViewMixin):
                 return CommonResponseCase.http_not_found.create_response()
 
             requested_profile_id: int = utils.safe_int(req_header['X-Profile-Id'])
-            if str(requested_profile_id) not in access_token.role:
+            if not api_class.check_profile_permission(access_token, requested_profile_id):
                 return ResourceResponseCase.resource_forbidden.create_response(
                     message='접속하고 계신 프로필은 본인의 프로필이 아닙니다.')
 
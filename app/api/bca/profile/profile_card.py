@@ -36,13 +36,13 @@ class ProfileCardRoute(flask.views.MethodView, api_class.MethodViewMixin):
                     message='해당 프로필은 명함이 없습니다.')
 
             target_card_subscription_cache: list[profile_module.CardSubscription] = []
-            if access_token and ('admin' not in access_token.role) and (str(profile_id) not in access_token.role):
+            if access_token and not api_class.check_profile_permission(access_token, profile_id, allow_admin=True):
                 # Requested user is not a admin, and requested user is not a owner of target profile.
                 # So we're going to query all the cards on the target profile
                 # that requested profiles are subscribing to, rather than querying each cards seperately.
                 if 'X-Profile-Id' in req_header:
                     requested_profile_id = utils.safe_int(req_header['X-Profile-Id'])
-                    if str(requested_profile_id) not in access_token.role:
+                    if not api_class.check_profile_permission(access_token, requested_profile_id):
                         return ResourceResponseCase.resource_forbidden.create_response()
 
                     # Check if requested user subscribed the card.
@@ -55,7 +55,7 @@ class ProfileCardRoute(flask.views.MethodView, api_class.MethodViewMixin):
             response_cards: list[profile_module.Card] = list()
             for card in target_cards:
                 # Admin can see all cards
-                if 'admin' in access_token.role:
+                if access_token and access_token.is_admin():
                     response_cards.append(card)
                     continue
 
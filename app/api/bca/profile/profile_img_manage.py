@@ -95,7 +95,7 @@ class ProfileImageManagementRoute(flask.views.MethodView, api_class.MethodViewMi
             if not target_profile:
                 return ResourceResponseCase.resource_not_found.create_response(
                     message='프로필을 찾을 수 없습니다.')
-            if target_profile.user_id != access_token.user and 'admin' not in access_token.role:
+            if target_profile.user_id != access_token.user and not access_token.is_admin():
                 # Check requested user is admin or the owner of the profile
                 return ResourceResponseCase.resource_forbidden.create_response(
                     message='프로필 사진은 관리자나 해당 명함의 주인만이 삭제할 수 있습니다.')
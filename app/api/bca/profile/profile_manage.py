@@ -9,21 +9,53 @@ import app.api.helper_class as api_class
 import app.common.utils as utils
 import app.database as db_module
 import app.database.jwt as jwt_module
+import app.database.token_revoke as token_revoke
 import app.database.bca.profile as profile_module
 import app.database.bca.chat as chat_module
 import app.plugin.bca.user_db.journal_handler as user_db_journal
 
 from app.api.response_case import CommonResponseCase, ResourceResponseCase
-from app.api.account.response_case import AccountResponseCase
 
 db = db_module.db
 redis_db = db_module.redis_db
 
 
+def get_profile_etag(profile_id: int,
+                     req_header: dict,
+                     access_token: typing.Optional[jwt_module.AccessToken] = None) -> typing.Optional[str]:
+    # Only public profiles are validated here, as private and deleted profiles need relation checks.
+    # This queries only the columns that we need, without loading the profile and its relationships.
+    requested_profile_id = utils.safe_int(req_header.get('X-Profile-Id', 0))
+    if 'X-Profile-Id' in req_header and not api_class.check_profile_permission(access_token, requested_profile_id):
+        return None
+
+    target_profile = db.session.query(
+            profile_module.Profile.commit_id,
+            profile_module.Profile.private,
+            profile_module.Profile.deleted_at)\
+        .filter(profile_module.Profile.locked_at.is_(None))\
+        .filter(profile_module.Profile.uuid == profile_id)\
+        .first()
+    if not target_profile or target_profile.private or target_profile.deleted_at:
+        return None
+
+    # Public profiles cannot be seen when the profile blocks the requested profile.
+    if requested_profile_id and db.session.query(
+            db.session.query(profile_module.ProfileRelation)
+            .filter(profile_module.ProfileRelation.from_profile_id == profile_id)
+            .filter(profile_module.ProfileRelation.to_profile_id == requested_profile_id)
+            .filter(profile_module.ProfileRelation.status == profile_module.ProfileRelationStatus.BLOCK)
+            .exists()).scalar():
+        return None
+
+    return target_profile.commit_id
+
+
 class ProfileManagementRoute(flask.views.MethodView, api_class.MethodViewMixin):
     @api_class.RequestHeader(
         optional_fields={'X-Profile-Id': {'type': 'integer'}, },
         auth={api_class.AuthType.Bearer: False, })
+    @api_class.ConditionalGET(get_profile_etag)
     def get(self, profile_id: int, req_header: dict, access_token: typing.Optional[jwt_module.AccessToken] = None):
         '''
         description: Get profile data of given profile_id. Private profiles can be view only by the followers and admin.
@@ -37,7 +69,8 @@ class ProfileManagementRoute(flask.views.MethodView, api_class.MethodViewMixin):
             # Need to check is requested profile is following target profile,
             # First, we need to check if X-Profile-Id is valid
             requested_profile_id = utils.safe_int(req_header.get('X-Profile-Id', 0))
-            if 'X-Profile-Id' in req_header and str(requested_profile_id) not in access_token.role:
+            if 'X-Profile-Id' in req_header\
+                    and not api_class.check_profile_permission(access_token, requested_profile_id):
                 return ResourceResponseCase.resource_forbidden.create_response(
                     message='접속하고 계신 프로필은 본인의 프로필이 아닙니다.')
 
@@ -56,7 +89,7 @@ class ProfileManagementRoute(flask.views.MethodView, api_class.MethodViewMixin):
                     return ResourceResponseCase.resource_forbidden.create_response(
                         message='해당 프로필을 볼 권한이 없습니다.')
 
-                elif 'admin' in access_token.role:
+                elif access_token.is_admin():
                     return ResourceResponseCase.resource_found.create_response(
                         header=(('ETag', target_profile.commit_id, ), ),
                         data={'profile': target_profile.to_dict(), })
@@ -264,7 +297,7 @@ class ProfileManagementRoute(flask.views.MethodView, api_class.MethodViewMixin):
             if not target_profile:
                 return ResourceResponseCase.resource_not_found.create_response(
                     message='프로필을 찾을 수 없습니다.')
-            if target_profile.user_id != access_token.user and 'admin' not in access_token.role:
+            if target_profile.user_id != access_token.user and not access_token.is_admin():
                 # Check requested user is admin or the owner of the profile
                 return ResourceResponseCase.resource_forbidden.create_response(
                     message='프로필은 관리자나 해당 명함의 주인만이 삭제할 수 있습니다.')
@@ -294,17 +327,7 @@ class ProfileManagementRoute(flask.views.MethodView, api_class.MethodViewMixin):
             db.session.commit()
 
             # Revoke access token so that user renews their access token that excludes this profile id
-            query_result = db.session.query(jwt_module.RefreshToken)\
-                .filter(jwt_module.RefreshToken.user == target_profile.user_id).all()
-            if not query_result:
-                # How could this happend?
-                return AccountResponseCase.access_token_invalid.create_response(
-                    message='해당 유저의 로그인 기록을 찾을 수 없습니다.\n이 경우는 일어나면 안되며, 관리자한테 문의해주세요.')
-
-            for target in query_result:
-                # TODO: set can set multiple at once, so use that method instead
-                redis_key = db_module.RedisKeyType.TOKEN_REVOKE.as_redis_key(target.jti)
-                redis_db.set(redis_key, 'revoked', datetime.timedelta(weeks=2))
+            token_revoke.revoke_user_token(target_profile.user_id)
 
             # Apply changeset on user db
             with user_db_journal.UserDBJournalCreator(db):
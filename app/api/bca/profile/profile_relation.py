@@ -32,7 +32,7 @@ class ProfileRelationRoute(flask.views.MethodView, api_class.MethodViewMixin):
         try:
             requested_profile_id: int = utils.safe_int(req_header['X-Profile-Id'])
 
-            if str(requested_profile_id) not in access_token.role:
+            if not api_class.check_profile_permission(access_token, requested_profile_id):
                 return ResourceResponseCase.resource_forbidden.create_response()
 
             target_profile = db.session.query(profile_module.Profile)\
@@ -88,7 +88,7 @@ class ProfileRelationRoute(flask.views.MethodView, api_class.MethodViewMixin):
         '''
         try:
             requested_profile_id: int = utils.safe_int(req_header['X-Profile-Id'])
-            if str(requested_profile_id) not in access_token.role:
+            if not api_class.check_profile_permission(access_token, requested_profile_id):
                 return ResourceResponseCase.resource_forbidden.create_response()
 
             # Parse status
@@ -175,7 +175,7 @@ class ProfileRelationRoute(flask.views.MethodView, api_class.MethodViewMixin):
         '''
         try:
             requested_profile_id: int = utils.safe_int(req_header['X-Profile-Id'])
-            if str(requested_profile_id) not in access_token.role:
+            if not api_class.check_profile_permission(access_token, requested_profile_id):
                 return ResourceResponseCase.resource_forbidden.create_response()
 
             target_profile = db.session.query(profile_module.Profile)\
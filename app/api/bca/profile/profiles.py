@@ -1,4 +1,3 @@
-import datetime
 import flask
 import json
 import typing
@@ -7,6 +6,7 @@ import app.api.helper_class as api_class
 import app.database as db_module
 import app.database.user as user_module
 import app.database.jwt as jwt_module
+import app.database.token_revoke as token_revoke
 import app.database.bca.profile as profile_module
 import app.plugin.bca.user_db.journal_handler as user_db_journal
 
@@ -115,17 +115,7 @@ class ProfileMainRoute(flask.views.MethodView, api_class.MethodViewMixin):
             db.session.commit()
 
             # Revoke access token so that user renews their access token that includes all of his/her profile ids
-            query_result = db.session.query(jwt_module.RefreshToken)\
-                .filter(jwt_module.RefreshToken.user == target_user.uuid).all()
-            if not query_result:
-                # How could this happend?
-                return AccountResponseCase.access_token_invalid.create_response(
-                    message='User or JWT that mapped to that user not found')
-
-            for target in query_result:
-                # TODO: set can set multiple at once, so use that method instead
-                redis_key = db_module.RedisKeyType.TOKEN_REVOKE.as_redis_key(target.jti)
-                redis_db.set(redis_key, 'revoked', datetime.timedelta(weeks=2))
+            token_revoke.revoke_user_token(target_user.uuid)
 
             return ResourceResponseCase.resource_created.create_response(
                 header=(('ETag', new_profile.commit_id, ), ),
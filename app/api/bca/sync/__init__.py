@@ -2,8 +2,10 @@ import flask
 import flask.views
 
 import app.api.helper_class as api_class
+import app.common.compression as compression
 import app.database.jwt as jwt_module
 import app.plugin.bca.user_db.file_io as bca_sync_file_io
+import app.plugin.bca.user_db.sync_cache as bca_sync_cache
 
 from app.api.response_case import CommonResponseCase
 from app.api.bca.sync.sync_response_case import SyncResponseCase
@@ -19,34 +21,121 @@ class SyncRoute(flask.views.MethodView, api_class.MethodViewMixin):
             - server_error
         '''
         return SyncResponseCase.sync_ok.create_response(
-            header=(('ETag', bca_sync_file_io.BCaSyncFile.get_hash(access_token.user)), ))
+            header=(('ETag', bca_sync_cache.get_sync_db_hash(access_token.user)), ))
 
+    @api_class.RequestQuery(
+        optional_fields={'tables': {'type': 'string', }, })
     @api_class.RequestHeader(
-        optional_fields={'If-Match': {'type': 'string', }, },
+        optional_fields={
+            'If-Match': {'type': 'string', },
+            'X-Sync-Table-Versions': {'type': 'string', }, },
         auth={api_class.AuthType.Bearer: True, })
-    def get(self, req_header: dict, access_token: jwt_module.AccessToken):
+    def get(self, req_query: dict, req_header: dict, access_token: jwt_module.AccessToken):
         '''
-        description: Send DB file data as URL-safe base64
+        description: Send DB file data as URL-safe base64.
+            If tables query is given (like `?tables=TB_CARD,TB_CARD_SUBSCRIPTION`),
+            then only rows of the outdated tables will be sent.
+            Table versions that client has must be sent on X-Sync-Table-Versions header
+            (like `TB_CARD=abcd,TB_PROFILE=efgh`).
+            If Accept header prefers application/vnd.sqlite3,
+            then DB file will be sent as is, not as JSON,
+            and the file may be compressed with gzip or zstd if Accept-Encoding header allows.
         responses:
             - sync_ok
+            - sync_partial
             - sync_latest
+            - body_bad_semantics
             - server_error
         '''
+        if 'tables' in req_query:
+            return self.get_partial(req_query, req_header, access_token)
+
         try:
             md5_placeholder = 'THISSTRINGCANNOTBETHEMD5`~!@#$%^&*()-_=+[{]};:\'"\\|,<.>/?'
             client_md5 = req_header.get('If-Match', md5_placeholder)
 
-            if bca_sync_file_io.BCaSyncFile.check_hash(user_id=access_token.user, hash_str=client_md5):
+            if flask.request.accept_mimetypes.best_match(
+                    ('application/json', bca_sync_file_io.SYNC_DB_MIMETYPE)) == bca_sync_file_io.SYNC_DB_MIMETYPE:
+                return self.get_file(client_md5, access_token)
+
+            # User db will be served from memory if it's cached. (See sync_cache)
+            if bca_sync_cache.get_sync_db_hash(access_token.user) == client_md5:
                 return SyncResponseCase.sync_latest.create_response(header=(('ETag', client_md5), ), )
 
+            sync_db = bca_sync_cache.get_sync_db(access_token.user)
+            response = SyncResponseCase.sync_ok.create_response(
+                header=(('ETag', sync_db.hash), ),
+                data={'db': bca_sync_cache.get_sync_db_b64urlsafe(sync_db)})
+            # Body is same while the user db is not changed, so the compressed body can be reused.
+            compression.set_body_cache_key(response[0], f'sync_db:{access_token.user}:{sync_db.hash}')
+            return response
+
+        except Exception:
+            return CommonResponseCase.server_error.create_response()
+
+    def get_file(self, client_md5: str, access_token: jwt_module.AccessToken):
+        # Precompressed artifact made by the worker is sent as is, if client accepts its encoding.
+        accept_encodings = {
+            encoding for encoding in bca_sync_file_io.SYNC_DB_ARTIFACT_EXTENSIONS
+            if flask.request.accept_encodings[encoding]}
+        artifact = bca_sync_file_io.read_sync_db_artifact(access_token.user, accept_encodings)
+        if artifact:
+            file_md5, content_encoding, file_data = artifact
+        else:
+            sync_db = bca_sync_cache.get_sync_db(access_token.user)
+            file_md5, content_encoding, file_data = sync_db.hash, None, sync_db.db_bytes
+
+        if file_md5 == client_md5:
+            return SyncResponseCase.sync_latest.create_response(header=(('ETag', client_md5), ), )
+
+        response = flask.Response(file_data, status=200, mimetype=bca_sync_file_io.SYNC_DB_MIMETYPE)
+        response.headers['ETag'] = file_md5
+        response.headers['Vary'] = 'Accept, Accept-Encoding'
+        if content_encoding:
+            # Strong ETag must be different on each content-coding. (See app.common.compression)
+            response.headers['Content-Encoding'] = content_encoding
+            response.headers['ETag'] = compression.add_etag_encoding(file_md5, content_encoding)
+        return response
+
+    def get_partial(self, req_query: dict, req_header: dict, access_token: jwt_module.AccessToken):
+        target_tables: list[str] = list(dict.fromkeys(z.strip() for z in req_query['tables'].split(',') if z.strip()))
+        if not target_tables or any(z not in bca_sync_file_io.SYNC_DB_TABLES for z in target_tables):
+            return CommonResponseCase.body_bad_semantics.create_response(
+                data={'bad_semantics': [{
+                    'field': 'tables',
+                    'reason': f'tables must be one or more of {", ".join(bca_sync_file_io.SYNC_DB_TABLES)}'}, ]})
+
+        try:
+            client_table_versions: dict[str, str] = dict()
+            for client_table_version in req_header.get('X-Sync-Table-Versions', '').split(','):
+                tablename, _, version = client_table_version.strip().partition('=')
+                if tablename and version:
+                    client_table_versions[tablename] = version
+
+            # Versions must be read before reading rows.
+            # If the table is changed while reading, then client will get the newer rows with the older version,
+            # so the client will just refresh the table again on the next sync.
+            table_versions = bca_sync_file_io.get_table_versions(access_token.user, target_tables)
+            table_versions_header = ('X-Sync-Table-Versions', ','.join(f'{k}={v}' for k, v in table_versions.items()))
+
+            outdated_tables = [z for z in target_tables if client_table_versions.get(z, None) != table_versions[z]]
+            if not outdated_tables:
+                return SyncResponseCase.sync_latest.create_response(header=(table_versions_header, ))
+
             try:
                 user_db_obj = bca_sync_file_io.BCaSyncFile.load(access_token.user)
             except FileNotFoundError:
-                user_db_obj = bca_sync_file_io.BCaSyncFile.create(access_token.user, True, True)
+                user_db_obj = bca_sync_file_io.BCaSyncFile.load_or_create(access_token.user)
+                table_versions = bca_sync_file_io.get_table_versions(access_token.user, target_tables)
+                table_versions_header = (
+                    'X-Sync-Table-Versions', ','.join(f'{k}={v}' for k, v in table_versions.items()))
 
-            file_md5 = user_db_obj.get_hash()
-            file_b64 = user_db_obj.as_b64urlsafe()
-            return SyncResponseCase.sync_ok.create_response(header=(('ETag', file_md5), ), data={'db': file_b64})
+            table_data = user_db_obj.read_tables(outdated_tables)
+            return SyncResponseCase.sync_partial.create_response(
+                header=(table_versions_header, ),
+                data={'tables': {
+                    tablename: {'version': table_versions[tablename], **table_data[tablename]}
+                    for tablename in outdated_tables}})
 
         except Exception:
             return CommonResponseCase.server_error.create_response()
@@ -61,9 +150,11 @@ class SyncRoute(flask.views.MethodView, api_class.MethodViewMixin):
             - server_error
         '''
         try:
-            user_db_obj = bca_sync_file_io.BCaSyncFile.create(access_token.user, True, True)
-            file_md5 = user_db_obj.get_hash()
-            file_b64 = user_db_obj.as_b64urlsafe()
+            # The file is replaced, so this must not run while journals are written on the file.
+            with bca_sync_file_io.lock_user_db(access_token.user):
+                user_db_obj = bca_sync_file_io.BCaSyncFile.create(access_token.user, True, True)
+                file_md5 = user_db_obj.get_hash()
+                file_b64 = user_db_obj.as_b64urlsafe()
             return SyncResponseCase.sync_ok.create_response(
                 header=(('ETag', file_md5), ),
                 data={'db': file_b64})
@@ -8,6 +8,12 @@ class SyncResponseCase(api_class.ResponseCaseCollector):
         code=200, success=True,
         public_sub_code='sync.ok',
         data={'db': ''})
+    sync_partial = api_class.Response(
+        description='Some tables of your profile/card db are outdated, '
+                    'so we sent you all rows of those tables.',
+        code=200, success=True,
+        public_sub_code='sync.partial',
+        data={'tables': {}})
     sync_recreated = api_class.Response(
         description='Your profile/card db file is recreated.',
         code=200, success=True,
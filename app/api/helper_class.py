@@ -12,6 +12,8 @@ import unicodedata
 import werkzeug.datastructures as wz_dt
 import yaml
 
+import app.common.compression as compression
+
 BASE_TYPE = typing.Type[typing.Union[str, bool, int, float, list, dict]]
 openapi_type_def: dict[BASE_TYPE, str] = {
     str: 'string',
@@ -21,7 +23,7 @@ openapi_type_def: dict[BASE_TYPE, str] = {
     list: 'array',
     dict: 'object',
 
-    # Below will be automatically converted by jsonify
+    # Below will be automatically converted by jsonify(See app.common.json_provider)
     datetime.datetime: 'string'
 }
 openapi_type_def_inverse: dict[str, BASE_TYPE] = {
@@ -183,8 +185,8 @@ class Response:
             ('Server', flask.current_app.config.get('BACKEND_NAME', 'Backend Core')),
         ))
 
-        resp_data = copy.deepcopy(data)
-        resp_data.update(data)
+        # data is only read while serializing, so we don't need to copy it.
+        resp_data = data
 
         resp_template_path = template_path or self.template_path
         resp_content_type = content_type or self.content_type
@@ -288,6 +290,19 @@ class AuthType(enum.Enum):
     RefreshToken = enum.auto()
 
 
+def check_profile_permission(access_token, profile_id: typing.Union[int, str, None], allow_admin: bool = False) -> bool:
+    '''
+    Returns True if profile_id is one of the profiles of the token holder (or the token holder is admin, if allowed).
+    Role of the token is parsed when the token is loaded, so this is a set lookup,
+    and this never matches a part of the other profile id.
+    '''
+    if not access_token:
+        return False
+    if allow_admin and access_token.is_admin():
+        return True
+    return access_token.has_profile(profile_id)
+
+
 def json_list_filter(in_list: list, filter_empty_value: bool = True) -> list:
     result_list: list = list()
 
@@ -367,9 +382,9 @@ def json_dict_filter(in_dict: dict, filter_empty_value: bool = True) -> dict:
 def dict_type_check(type_def: dict[str, dict[str, str]],
                     data: dict[str, typing.Any]) -> typing.Optional[tuple[str, str, str]]:
     type_def_rtypes = {k: openapi_type_def_inverse[v['type']] for k, v in type_def.items()}
-    data_for_iter = copy.deepcopy(data)
 
-    for data_k, data_v in data_for_iter.items():
+    # Only values are replaced while iterating, so we don't need to copy the data.
+    for data_k, data_v in data.items():
         expected_type = type_def_rtypes.get(data_k, None)
 
         if not expected_type:
@@ -401,12 +416,104 @@ def dict_type_check(type_def: dict[str, dict[str, str]],
     return None
 
 
+def create_type_coercer(type_name: str) -> typing.Callable[[typing.Any], typing.Any]:
+    '''
+    Returns a function that converts a value to the OpenAPI type as dict_type_check does.
+    The function raises TypeError with the OpenAPI type name of the value when it cannot be converted.
+    '''
+    expected_type = openapi_type_def_inverse[type_name]
+
+    if expected_type is str:
+        return lambda value: value if isinstance(value, str) else str(value)
+
+    def type_coercer(value: typing.Any) -> typing.Any:
+        if isinstance(value, expected_type):
+            return value
+
+        if isinstance(value, str):
+            # If field's type is str, then at least we can try conversion.
+            try:
+                value_parsed = json.loads(value)
+                if expected_type in (int, float) and isinstance(value_parsed, (int, float)):
+                    return expected_type(value_parsed)
+                elif isinstance(value_parsed, expected_type):
+                    return expected_type(value_parsed)
+            except Exception:
+                pass
+
+        raise TypeError(openapi_type_def.get(type(value), 'UNKNOWN'))
+
+    return type_coercer
+
+
+class RequestFieldPlan:
+    '''
+    Validation plan of request fields, which is compiled once when the route is decorated,
+    so that requests only look up and normalize the fields that the route accepts.
+    '''
+    required_field_names: tuple[str, ...]
+    field_names: frozenset[str]
+    field_types: dict[str, str]
+    type_coercers: dict[str, typing.Callable[[typing.Any], typing.Any]]
+
+    def __init__(self,
+                 required_fields: dict[str, dict[str, str]],
+                 optional_fields: dict[str, dict[str, str]],
+                 type_check: bool = False):
+        self.required_field_names = tuple(required_fields)
+        self.field_names = frozenset((*required_fields, *optional_fields))
+        if type_check:
+            # Optional fields override required fields that have the same name, like self.fields of the decorators.
+            self.field_types = {k: v['type'] for k, v in {**required_fields, **optional_fields}.items()}
+            self.type_coercers = {k: create_type_coercer(v) for k, v in self.field_types.items()}
+        else:
+            self.field_types = dict()
+            self.type_coercers = dict()
+
+    def get_lacks(self, data: dict[str, typing.Any]) -> list[str]:
+        return [z for z in self.required_field_names if z not in data]
+
+    def filter_str_fields(self, source: typing.Mapping[str, str]) -> dict[str, str]:
+        # For headers and query strings. Those are case-insensitive or flat, so look up only the accepted fields.
+        result: dict[str, str] = dict()
+        for field_name in self.field_names:
+            value = source.get(field_name, None)
+            if value is None:
+                continue
+
+            value = unicodedata.normalize('NFC', value).strip()
+            if value:
+                result[field_name] = value
+        return result
+
+    def filter_json_fields(self, in_dict: dict[str, typing.Any]) -> dict[str, typing.Any]:
+        # For parsed JSON bodies. Fields that are not accepted are removed before normalizing nested values.
+        if not in_dict:
+            return dict()
+
+        return json_dict_filter({
+            k: v for k, v in in_dict.items()
+            if k in self.field_names or unicodedata.normalize('NFC', k).strip() in self.field_names})
+
+    def coerce_types(self, data: dict[str, typing.Any]) -> typing.Optional[tuple[str, str, str]]:
+        # Converts values in place, and returns (field name, expected type, type we got) on failure.
+        for field_name, value in data.items():
+            type_coercer = self.type_coercers.get(field_name, None)
+            if not type_coercer:
+                return (field_name, 'UNKNOWN', 'UNKNOWN')
+
+            try:
+                data[field_name] = type_coercer(value)
+            except TypeError as err:
+                return (field_name, self.field_types[field_name], str(err))
+        return None
+
+
 class RequestHeader:
     def __init__(self,
                  required_fields: typing.Optional[dict[str, dict[str, str]]] = None,
                  optional_fields: typing.Optional[dict[str, dict[str, str]]] = None,
                  auth: typing.Optional[dict[AuthType, bool]] = None):
-        self.req_header: dict = dict()
         self.required_fields: dict[str, dict[str, str]] = required_fields or {}
         self.optional_fields: dict[str, dict[str, str]] = optional_fields or {}
         self.auth: dict[AuthType, bool] = auth or {}
@@ -422,27 +529,32 @@ class RequestHeader:
                 self.optional_fields['Authorization'] = {'type': 'string', }
                 self.optional_fields['X-Csrf-Token'] = {'type': 'string', }
 
+        self.field_plan = RequestFieldPlan(self.required_fields, self.optional_fields)
+
     def __call__(self, func: typing.Callable):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
+            # This decorator object is shared by all requests of the route, even on threaded workers,
+            # so per-request values must be kept on local variables, not on self.
             try:
-                # Filter for empty keys and values
-                self.req_header = json_dict_filter(flask.request.headers, True)
+                # Get only required and optional fields, and filter for empty values
+                req_header: dict[str, str] = self.field_plan.filter_str_fields(flask.request.headers)
 
                 # Check if all required fields are in
-                if (not all([z in self.req_header.keys() for z in self.required_fields])):
-                    return CommonResponseCase.header_required_omitted.create_response(
-                        data={'lacks': [z for z in self.required_fields if z not in self.req_header], })
+                if lacks := self.field_plan.get_lacks(req_header):
+                    return CommonResponseCase.header_required_omitted.create_response(data={'lacks': lacks, })
 
-                # Remove every field not in required and optional fields
-                self.req_header = {k: self.req_header[k] for k in self.req_header
-                                   if k in list(self.required_fields.keys()) + list(self.optional_fields.keys())}
-                if self.required_fields and not self.req_header:
+                if self.required_fields and not req_header:
                     return CommonResponseCase.header_required_omitted.create_response(
                         data={'lacks': list(self.required_fields.keys()), })
 
+                # ETags of compressed bodies have the encoding suffix, but routes compare If-Match with
+                # the ETag of the content, like commit_id. (See app.common.compression)
+                if 'If-Match' in req_header:
+                    req_header['If-Match'] = compression.strip_etag_encoding(req_header['If-Match'])
+
                 if self.required_fields or self.optional_fields:
-                    kwargs['req_header'] = self.req_header
+                    kwargs['req_header'] = req_header
             except Exception:
                 return CommonResponseCase.header_invalid.create_response()
 
@@ -454,7 +566,7 @@ class RequestHeader:
                 for auth, required in self.auth.items():
                     # We need match-case syntax which is introduced on Python 3.10
                     if auth == AuthType.Bearer:
-                        csrf_token = self.req_header.get('X-Csrf-Token', None)
+                        csrf_token = req_header.get('X-Csrf-Token', None)
                         if required and not csrf_token:
                             return account_resp_case.AccountResponseCase.access_token_invalid.create_response()
 
@@ -587,38 +699,33 @@ class RequestQuery:
     def __init__(self,
                  required_fields: typing.Optional[dict[str, dict[str, str]]] = None,
                  optional_fields: typing.Optional[dict[str, dict[str, str]]] = None):
-        self.req_query: dict = dict()
         self.required_fields: dict[str, dict[str, str]] = required_fields or {}
         self.optional_fields: dict[str, dict[str, str]] = optional_fields or {}
 
         self.fields: dict[str, dict[str, str]] = copy.deepcopy(self.required_fields)
         self.fields.update(self.optional_fields)
 
+        self.field_plan = RequestFieldPlan(self.required_fields, self.optional_fields)
+
     def __call__(self, func: typing.Callable):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
+            # This decorator object is shared by all requests of the route, even on threaded workers,
+            # so per-request values must be kept on local variables, not on self.
             try:
-                # Filter for empty keys and values
-                self.req_query = json_dict_filter(flask.request.args.copy(), True)
+                # Get only required and optional fields, and filter for empty values
+                req_query: dict[str, str] = self.field_plan.filter_str_fields(flask.request.args)
 
                 # Check if all required fields are in
-                if (not all([z in self.req_query.keys() for z in self.required_fields])):
-                    return CommonResponseCase.path_required_omitted.create_response(
-                        data={'lacks': [z for z in self.required_fields if z not in self.req_query], })
+                if lacks := self.field_plan.get_lacks(req_query):
+                    return CommonResponseCase.path_required_omitted.create_response(data={'lacks': lacks, })
 
-                # Remove every field not in required and optional fields
-                self.req_query = {k: self.req_query[k] for k in self.req_query
-                                  if k in list(self.required_fields.keys()) + list(self.optional_fields.keys())}
-
-                # Remove every field not in required and optional fields
-                self.req_query = {k: self.req_query[k] for k in self.req_query
-                                  if k in list(self.required_fields.keys()) + list(self.optional_fields.keys())}
-                if self.required_fields and not self.req_query:
+                if self.required_fields and not req_query:
                     return CommonResponseCase.path_required_omitted.create_response(
                         data={'lacks': list(self.required_fields.keys()), })
 
                 if self.required_fields or self.optional_fields:
-                    kwargs['req_query'] = self.req_query
+                    kwargs['req_query'] = req_query
             except Exception:
                 return CommonResponseCase.body_invalid.create_response()
 
@@ -674,40 +781,39 @@ class RequestBody:
     def __init__(self,
                  required_fields: typing.Optional[dict[str, dict[str, str]]] = None,
                  optional_fields: typing.Optional[dict[str, dict[str, str]]] = None):
-        self.req_body: dict = dict()
         self.required_fields: dict[str, dict[str, str]] = required_fields or {}
         self.optional_fields: dict[str, dict[str, str]] = optional_fields or {}
 
         self.fields: dict[str, dict[str, str]] = copy.deepcopy(self.required_fields)
         self.fields.update(self.optional_fields)
 
+        self.field_plan = RequestFieldPlan(self.required_fields, self.optional_fields, type_check=True)
+
     def __call__(self, func: typing.Callable):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
+            # This decorator object is shared by all requests of the route, even on threaded workers,
+            # so per-request values must be kept on local variables, not on self.
             try:
-                # Filter for empty keys and values
-                self.req_body = None
+                # Get only required and optional fields, and filter for empty keys and values
+                req_body: typing.Optional[dict[str, typing.Any]] = None
                 try:
-                    self.req_body = json_dict_filter(flask.request.get_json(force=True), True)
+                    req_body = self.field_plan.filter_json_fields(flask.request.get_json(force=True))
                 except Exception:
                     # Try to get body data from FormData
-                    self.req_body = json_dict_filter(flask.request.form.to_dict(flat=True), True)
-                if self.req_body is None:
+                    req_body = self.field_plan.filter_json_fields(flask.request.form.to_dict(flat=True))
+                if req_body is None:
                     raise Exception('Getting body data from request failed')
 
                 # Check if all required fields are in
-                if (not all([z in self.req_body.keys() for z in self.required_fields])):
-                    return CommonResponseCase.body_required_omitted.create_response(
-                        data={'lacks': [z for z in self.required_fields if z not in self.req_body], }, )
-
-                # Remove every field not in required and optional fields
-                self.req_body = {k: self.req_body[k] for k in self.req_body
-                                 if k in list(self.required_fields.keys()) + list(self.optional_fields.keys())}
-                if self.required_fields and not self.req_body:
+                if lacks := self.field_plan.get_lacks(req_body):
+                    return CommonResponseCase.body_required_omitted.create_response(data={'lacks': lacks, }, )
+
+                if self.required_fields and not req_body:
                     return CommonResponseCase.body_empty.create_response()
 
-                # Type check the values
-                req_type_check_result = dict_type_check(self.fields, self.req_body)
+                # Type check and convert the values
+                req_type_check_result = self.field_plan.coerce_types(req_body)
                 if req_type_check_result:
                     field_name, expected_type, type_we_got = req_type_check_result
                     error_msg = f'Expected type `{expected_type}`, but got `{type_we_got}`'
@@ -718,7 +824,7 @@ class RequestBody:
             except Exception:
                 return CommonResponseCase.body_invalid.create_response()
 
-            kwargs['req_body'] = self.req_body
+            kwargs['req_body'] = req_body
             return func(*args, **kwargs)
 
         # Parse docstring and inject requestBody data
@@ -763,3 +869,59 @@ class RequestBody:
             wrapper.__doc__ = yaml.safe_dump(doc_data)
 
         return wrapper
+
+
+class ConditionalGET:
+    '''
+    Answers `If-None-Match` with 304 Not Modified before the route loads and serializes the resource.
+    validator is called with the same keyword arguments as the route(path parameters, req_header, access_token...),
+    so this must be applied under RequestHeader/RequestQuery decorators.
+    validator must return the current ETag of the resource(like commit_id) using a cheap query,
+    or None when the resource needs the full permission check of the route, like private resources.
+    '''
+    def __init__(self, validator: typing.Callable[..., typing.Optional[str]]):
+        self.validator = validator
+
+    def __call__(self, func: typing.Callable):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if_none_match: wz_dt.ETags = flask.request.if_none_match
+            if if_none_match:
+                try:
+                    current_etag = self.validator(**kwargs)
+                except Exception:
+                    # Just run the route, it'll handle the error by itself.
+                    current_etag = None
+
+                # Client may have the ETag of a compressed body, which has the encoding suffix.
+                # (See app.common.compression)
+                matched_etag = next((
+                    etag for etag in compression.get_encoded_etags(current_etag)
+                    if if_none_match.contains_weak(etag)), None) if current_etag else None
+                if matched_etag:
+                    return CommonResponseCase.http_not_modified.create_response(
+                        header=(('ETag', matched_etag), ))
+
+            return func(*args, **kwargs)
+
+        # Parse docstring and inject parameter data
+        if doc_str := inspect.getdoc(func):
+            doc_data: dict = yaml.safe_load(doc_str)
+
+            if 'parameters' not in doc_data:
+                doc_data['parameters'] = []
+            doc_data['parameters'].append({
+                'in': 'header',
+                'name': 'If-None-Match',
+                'description': 'ETag of the resource that client has',
+                'schema': {'type': 'string', },
+            })
+
+            if not doc_data['responses']:
+                doc_data['responses'] = list()
+            doc_data['responses'] += ['http_not_modified', ]
+
+            func.__doc__ = yaml.safe_dump(doc_data)
+            wrapper.__doc__ = yaml.safe_dump(doc_data)
+
+        return wrapper
@@ -1,7 +1,9 @@
 import flask
 import werkzeug.exceptions
 
+import app.common.compression as compression
 import app.common.utils as utils
+import app.common.password_hasher as password_hasher
 from app.api.response_case import CommonResponseCase
 from app.api.account.response_case import AccountResponseCase
 
@@ -27,7 +29,7 @@ def before_request():
 
 
 def after_request(response):
-    return response
+    return compression.compress_response(response)
 
 
 def teardown_request(exception):
@@ -58,6 +60,10 @@ def register_request_handler(app: flask.Flask):
     def handle_429(exception: werkzeug.exceptions.HTTPException):
         return CommonResponseCase.rate_limit.create_response()
 
+    @app.errorhandler(password_hasher.PasswordHasherBusyException)
+    def handle_password_hasher_busy(exception: password_hasher.PasswordHasherBusyException):
+        return CommonResponseCase.server_busy.create_response()
+
     @app.errorhandler(Exception)
     def handle_exception(exception: werkzeug.exceptions.HTTPException):
         # response = exception.get_response()  # TODO: Log this
@@ -22,6 +22,11 @@ class CommonResponseCase(api_class.ResponseCaseCollector):
         code=500, success=False,
         private_sub_code='backend.db_error',
         public_sub_code='backend.error')
+    server_busy = api_class.Response(
+        description='Backend is too busy to handle this request now, try again after Retry-After seconds.',
+        code=503, success=False,
+        public_sub_code='backend.busy',
+        header=(('Retry-After', '1'), ))
 
     # Common client-fault mistake related
     body_invalid = api_class.Response(
@@ -66,6 +71,10 @@ class CommonResponseCase(api_class.ResponseCaseCollector):
         description='Normal plane HTTP OK response',
         code=200, success=True,
         public_sub_code='http.ok')
+    http_not_modified = api_class.Response(
+        description='Resource is not modified since the client got it. (ETag on If-None-Match is still valid)',
+        code=304, success=True,
+        public_sub_code='http.not_modified')
     http_mtd_forbidden = api_class.Response(
         description='Method you requested is not allowed on this route',
         code=405, success=False,
@@ -3,12 +3,17 @@ import flask
 import app.common.cli_tools.openapi_support as openapi_support
 import app.common.cli_tools.db_operation as db_operation
 import app.common.cli_tools.db_erd_draw as db_erd_draw
+import app.common.cli_tools.benchmark as benchmark
 
 
 def init_app(app: flask.Flask):
     app.cli.add_command(openapi_support.create_openapi_doc)
     app.cli.add_command(db_operation.drop_db)
     app.cli.add_command(db_erd_draw.draw_db_erd)
+    app.cli.add_command(benchmark.benchmark_token)
+    app.cli.add_command(benchmark.calibrate_argon2)
+    app.cli.add_command(benchmark.benchmark_request_validator)
+    app.cli.add_command(benchmark.benchmark_json)
 
     # init_app must return app
     return app
@@ -0,0 +1,260 @@
+import click
+import copy
+import flask
+import flask.cli
+import flask.json.provider
+import secrets
+import statistics
+import time
+import typing
+
+import app.api.helper_class as api_class
+import app.common.json_provider as json_provider
+import app.common.password_hasher as password_hasher
+import app.database as db_module
+import app.database.jwt as jwt_module
+import app.database.user as user_module
+
+db = db_module.db
+
+BENCHMARK_USER_AGENT = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
+                        'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/96.0.4664.110 Safari/537.36')
+BENCHMARK_IP_ADDR = '127.0.0.1'
+
+
+def run_benchmark(name: str, iterations: int, func: typing.Callable[[], typing.Any]):
+    # Warm up caches (like LRU cache or DB connection pool) first.
+    func()
+
+    elapsed_list: list[int] = list()
+    for _ in range(iterations):
+        start_time = time.perf_counter_ns()
+        func()
+        elapsed_list.append(time.perf_counter_ns() - start_time)
+
+    elapsed_list.sort()
+    print(f'{name:<24} '
+          f'mean {statistics.mean(elapsed_list) / 1000:10.1f}us / '
+          f'p50 {elapsed_list[len(elapsed_list) // 2] / 1000:10.1f}us / '
+          f'p99 {elapsed_list[min(len(elapsed_list) - 1, len(elapsed_list) * 99 // 100)] / 1000:10.1f}us')
+
+
+@click.command('benchmark-token')
+@click.argument('user_id', type=int)
+@click.option('--iterations', type=int, default=100, help='Number of iterations of each benchmark')
+@flask.cli.with_appcontext
+def benchmark_token(user_id: int, iterations: int):
+    '''
+    Measures token issue/verify, signin and refresh of the given user.
+    Refresh tokens created by this benchmark are removed after the benchmark.
+    '''
+    if flask.current_app.config.get('RESTAPI_VERSION', 'prod') != 'dev':
+        print('Cannot run benchmark: RESTAPI_VERSION is not \'dev\'')
+        return
+
+    target_user = db.session.query(user_module.User).filter(user_module.User.uuid == user_id).first()
+    if not target_user:
+        print(f'User {user_id} not found')
+        return
+
+    key: str = flask.current_app.config.get('SECRET_KEY')
+    csrf_token = secrets.token_hex(16)
+
+    # Refresh tokens that are created after this are created by this benchmark.
+    last_jti: int = db.session.query(db.func.max(jwt_module.RefreshToken.jti)).scalar() or 0
+
+    try:
+        signin_result: dict[str, str] = dict()
+
+        def signin():
+            response_header, _ = jwt_module.create_login_data(
+                target_user, BENCHMARK_USER_AGENT, csrf_token, None, BENCHMARK_IP_ADDR, key)
+            signin_result['refresh_token'] = next(
+                v for k, v in response_header if k == 'Set-Cookie' and v.startswith('refresh_token='))\
+                .split(';')[0].removeprefix('refresh_token=')
+
+        run_benchmark('signin', iterations, signin)
+
+        def refresh():
+            jwt_module.refresh_login_data(
+                signin_result['refresh_token'], BENCHMARK_USER_AGENT, csrf_token, None, BENCHMARK_IP_ADDR, key)
+
+        run_benchmark('refresh', iterations, refresh)
+
+        refresh_token = jwt_module.RefreshToken.from_token(signin_result['refresh_token'], key)
+        access_token = jwt_module.AccessToken.from_refresh_token(refresh_token)
+        access_token_jwt = access_token.create_token(key + csrf_token)
+
+        run_benchmark('access token issue', iterations, lambda: access_token.create_token(key + csrf_token))
+        run_benchmark(
+            'access token verify', iterations,
+            lambda: jwt_module.AccessToken.from_token(access_token_jwt, key + csrf_token))
+        run_benchmark(
+            'user-agent check', iterations,
+            lambda: jwt_module.get_user_agent_family(BENCHMARK_USER_AGENT))
+    finally:
+        db.session.rollback()
+        db.session.query(jwt_module.RefreshToken)\
+            .filter(jwt_module.RefreshToken.user == user_id)\
+            .filter(jwt_module.RefreshToken.jti > last_jti)\
+            .delete(synchronize_session=False)
+        db.session.commit()
+
+
+@click.command('calibrate-argon2')
+@click.option('--target-ms', type=float, default=250.0, help='Target latency of a password verification')
+@click.option('--memory-cost', type=int, default=65536, help='Argon2 memory cost(KiB)')
+@click.option('--parallelism', type=int, default=1, help='Argon2 parallelism')
+@click.option('--iterations', type=int, default=5, help='Number of verifications for each time cost')
+@click.option('--max-time-cost', type=int, default=64, help='Stop calibration at this time cost')
+def calibrate_argon2(target_ms: float, memory_cost: int, parallelism: int, iterations: int, max_time_cost: int):
+    '''
+    Finds Argon2 time cost whose verification takes about target latency on this machine.
+    Run this on the deployed hardware, and set ARGON2_* environment variables with the result.
+    '''
+    test_pw = secrets.token_urlsafe(16)
+
+    time_cost = 1
+    median_ms = 0.0
+    while time_cost <= max_time_cost:
+        parameters: password_hasher.Argon2Parameters = (time_cost, memory_cost, parallelism)
+        pw_hash = password_hasher.hash_password_job(test_pw, parameters)
+
+        elapsed_list: list[int] = list()
+        for _ in range(iterations):
+            start_time = time.perf_counter_ns()
+            password_hasher.verify_password_job(test_pw, pw_hash, parameters)
+            elapsed_list.append(time.perf_counter_ns() - start_time)
+
+        median_ms = statistics.median(elapsed_list) / 1000000
+        print(f'time_cost {time_cost:3} / memory_cost {memory_cost} / parallelism {parallelism}: '
+              f'median {median_ms:8.1f}ms')
+        if median_ms >= target_ms:
+            break
+
+        # Verification time grows linearly with time cost, so jump close to the target and then walk up.
+        time_cost = max(time_cost + 1, min(max_time_cost, int(time_cost * target_ms / max(median_ms, 0.001))))
+    else:
+        time_cost = max_time_cost
+        print(f'Target latency is not reached until time cost {max_time_cost}, consider raising memory cost')
+
+    print('\nRecommended environment variables:')
+    print(f'ARGON2_TIME_COST={time_cost}')
+    print(f'ARGON2_MEMORY_COST={memory_cost}')
+    print(f'ARGON2_PARALLELISM={parallelism}')
+
+
+BENCHMARK_REQUEST_HEADER_FIELDS = {
+    'required_fields': {
+        'User-Agent': {'type': 'string', },
+        'X-Csrf-Token': {'type': 'string', }, },
+    'optional_fields': {'X-Client-Token': {'type': 'string', }, }, }
+BENCHMARK_REQUEST_QUERY_FIELDS = {
+    'optional_fields': {
+        'page': {'type': 'integer', },
+        'sort': {'type': 'string', }, }, }
+BENCHMARK_REQUEST_BODY_FIELDS = {
+    'required_fields': {
+        'id': {'type': 'string', },
+        'pw': {'type': 'string', }, },
+    'optional_fields': {
+        'private': {'type': 'boolean', },
+        'data': {'type': 'object', }, }, }
+
+
+@click.command('benchmark-request-validator')
+@click.option('--iterations', type=int, default=10000, help='Number of iterations of each benchmark')
+@flask.cli.with_appcontext
+def benchmark_request_validator(iterations: int):
+    '''
+    Measures per-request overhead of stacked RequestHeader/RequestQuery/RequestBody decorators.
+    "legacy validation" repeats what the decorators did before validation plans were compiled,
+    so that both can be compared on the same machine.
+    '''
+    def route_func(**kwargs):
+        return kwargs
+
+    decorated_route_func = api_class.RequestHeader(**BENCHMARK_REQUEST_HEADER_FIELDS)(
+        api_class.RequestQuery(**BENCHMARK_REQUEST_QUERY_FIELDS)(
+            api_class.RequestBody(**BENCHMARK_REQUEST_BODY_FIELDS)(route_func)))
+
+    body_fields = copy.deepcopy(BENCHMARK_REQUEST_BODY_FIELDS['required_fields'])
+    body_fields.update(BENCHMARK_REQUEST_BODY_FIELDS['optional_fields'])
+
+    def legacy_validation():
+        req_header = api_class.json_dict_filter(flask.request.headers, True)
+        req_header = {k: req_header[k] for k in req_header
+                      if k in list(BENCHMARK_REQUEST_HEADER_FIELDS['required_fields'].keys())
+                      + list(BENCHMARK_REQUEST_HEADER_FIELDS['optional_fields'].keys())}
+
+        req_query = api_class.json_dict_filter(flask.request.args.copy(), True)
+        req_query = {k: req_query[k] for k in req_query
+                     if k in list(BENCHMARK_REQUEST_QUERY_FIELDS['optional_fields'].keys())}
+
+        req_body = api_class.json_dict_filter(flask.request.get_json(force=True), True)
+        req_body = {k: req_body[k] for k in req_body
+                    if k in list(BENCHMARK_REQUEST_BODY_FIELDS['required_fields'].keys())
+                    + list(BENCHMARK_REQUEST_BODY_FIELDS['optional_fields'].keys())}
+        # dict_type_check deep-copied the body before.
+        api_class.dict_type_check(body_fields, copy.deepcopy(req_body))
+        return req_header, req_query, req_body
+
+    with flask.current_app.test_request_context(
+            '/benchmark?page=3&sort=name&unused=value',
+            method='POST',
+            headers={
+                'User-Agent': BENCHMARK_USER_AGENT,
+                'X-Csrf-Token': secrets.token_hex(16),
+                'Accept': 'application/json',
+                'Accept-Encoding': 'gzip, deflate, br',
+                'Accept-Language': 'ko-KR,ko;q=0.9,en-US;q=0.8',
+                'Cookie': f'refresh_token={secrets.token_urlsafe(128)}',
+                'Origin': 'https://example.com',
+                'Referer': 'https://example.com/signin', },
+            json={
+                'id': 'benchmark_user',
+                'pw': secrets.token_urlsafe(16),
+                'private': 'true',
+                'data': {'email': {'index': 0, 'value': {'default': {'index': 0, 'value': 'a@example.com'}}}},
+                'unused': ['value', ] * 16, }):
+        run_benchmark('undecorated route', iterations, route_func)
+        run_benchmark('legacy validation', iterations, legacy_validation)
+        run_benchmark('compiled validation', iterations, decorated_route_func)
+
+
+@click.command('benchmark-json')
+@click.option('--iterations', type=int, default=100, help='Number of iterations of each benchmark')
+@click.option('--rows', type=int, default=1000, help='Number of rows of each response')
+@flask.cli.with_appcontext
+def benchmark_json(iterations: int, rows: int):
+    '''
+    Measures serialization of the largest responses(chat event list and card list) on the current DB,
+    with the default JSON provider of flask and the app JSON provider.
+    Compare "create_response" and "to_dict" to see the serialization share of the response time.
+    '''
+    # On python, all imports will be cached, so it's OK to import in method.
+    import app.database.bca.chat as chat_module
+    import app.database.bca.profile as profile_module
+    from app.api.response_case import ResourceResponseCase
+
+    flask_json_provider = flask.json.provider.DefaultJSONProvider(flask.current_app)
+    app_json_provider = json_provider.AppJSONProvider(flask.current_app)
+
+    benchmark_targets: dict[str, typing.Callable[[], dict]] = {
+        'chat_events': lambda: {'chat_events': [
+            z.to_dict() for z in db.session.query(chat_module.ChatEvent).limit(rows).all()]},
+        'cards': lambda: {'cards': [
+            z.to_dict() for z in db.session.query(profile_module.Card).limit(rows).all()]},
+    }
+
+    with flask.current_app.test_request_context('/benchmark'):
+        for target_name, get_response_data in benchmark_targets.items():
+            response_data = get_response_data()
+            print(f'{target_name}: {len(next(iter(response_data.values())))} rows')
+
+            run_benchmark(f'{target_name} to_dict', iterations, get_response_data)
+            run_benchmark(f'{target_name} flask json', iterations, lambda: flask_json_provider.response(response_data))
+            run_benchmark(f'{target_name} app json', iterations, lambda: app_json_provider.response(response_data))
+            run_benchmark(
+                f'{target_name} create_response', iterations,
+                lambda: ResourceResponseCase.multiple_resources_found.create_response(data=response_data))
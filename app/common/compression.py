@@ -0,0 +1,176 @@
+import collections
+import flask
+import gzip
+import threading
+import typing
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, it's not offered to clients if zstandard is not installed.
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, it's not offered to clients if brotli is not installed.
+    brotli = None
+
+# Compressed bodies are reused only when the route marks the response with this attribute,
+# as the body of most responses differs on every request.
+BODY_CACHE_KEY_ATTR = 'compression_cache_key'
+# All encodings that this module can send. ETags of encoded bodies have one of these as a suffix.
+KNOWN_ENCODINGS: tuple[str, ...] = ('zstd', 'br', 'gzip')
+
+
+def add_etag_encoding(etag: str, encoding: str) -> str:
+    '''
+    Returns the ETag of the encoded body, as a strong ETag must be different on each content-coding.
+    (like `"abcd"` to `"abcd-gzip"`, quotes are kept as is, as some routes send ETags without quotes)
+    Weak ETags are returned as is, as those can be shared by the encoded bodies.
+    '''
+    if not etag or etag.startswith('W/'):
+        return etag
+    if len(etag) > 1 and etag.startswith('"') and etag.endswith('"'):
+        return f'{etag[:-1]}-{encoding}"'
+    return f'{etag}-{encoding}'
+
+
+def strip_etag_encoding(etag: str) -> str:
+    # Reverse of add_etag_encoding, for the ETags that clients send back on If-Match.
+    for encoding in KNOWN_ENCODINGS:
+        if etag.endswith(f'-{encoding}"'):
+            return f'{etag[:-len(encoding) - 2]}"'
+        if etag.endswith(f'-{encoding}'):
+            return etag[:-len(encoding) - 1]
+    return etag
+
+
+def get_encoded_etags(etag: str) -> list[str]:
+    # Returns the ETag and the ETags of all encoded bodies of it, for If-None-Match checks.
+    return [etag, *(add_etag_encoding(etag, encoding) for encoding in KNOWN_ENCODINGS)]
+
+
+def get_encoders(config: typing.Mapping[str, typing.Any]) -> dict[str, typing.Callable[[bytes], bytes]]:
+    # Returns encoders that are available on this server, as {Content-Encoding: encoder}.
+    encoders: dict[str, typing.Callable[[bytes], bytes]] = dict()
+    if zstandard is not None:
+        # ZstdCompressor is not thread-safe, so this makes a new one on every call.
+        encoders['zstd'] = lambda z: zstandard.ZstdCompressor(level=config.get('COMPRESSION_ZSTD_LEVEL')).compress(z)
+    if brotli is not None:
+        encoders['br'] = lambda z: brotli.compress(z, quality=config.get('COMPRESSION_BROTLI_QUALITY'))
+    # mtime is fixed, so that the same body always makes the same compressed body.
+    encoders['gzip'] = lambda z: gzip.compress(z, compresslevel=config.get('COMPRESSION_GZIP_LEVEL'), mtime=0)
+    return encoders
+
+
+def select_encoding(config: typing.Mapping[str, typing.Any]) -> typing.Optional[str]:
+    '''
+    Returns the encoding that client accepts with the highest quality value.
+    When qualities are same, the one that comes first on COMPRESSION_ENCODINGS is selected.
+    '''
+    available_encodings = get_encoders(config)
+    candidates = [
+        (flask.request.accept_encodings[encoding], -index, encoding)
+        for index, encoding in enumerate(config.get('COMPRESSION_ENCODINGS', ()))
+        if encoding in available_encodings]
+    candidates = [z for z in candidates if z[0] > 0]
+    return max(candidates)[2] if candidates else None
+
+
+class CompressedBodyCache:
+    '''
+    Bounded LRU of compressed bodies, which is limited by the total size of the entries.
+    Keys are given by the routes, and those must change whenever the body changes.
+    Uncompressed body length is also stored, so a wrongly reused key doesn't send a different body.
+    '''
+    max_bytes: int
+    entries: collections.OrderedDict[tuple[str, str], tuple[int, bytes]]
+    total_bytes: int = 0
+
+    def __init__(self):
+        self.max_bytes = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str, encoding: str, body_size: int) -> typing.Optional[bytes]:
+        with self.lock:
+            entry = self.entries.get((key, encoding), None)
+            if entry is None or entry[0] != body_size:
+                return None
+            self.entries.move_to_end((key, encoding))
+            return entry[1]
+
+    def put(self, key: str, encoding: str, body_size: int, compressed_body: bytes):
+        if len(compressed_body) > self.max_bytes:
+            return
+
+        with self.lock:
+            previous_entry = self.entries.pop((key, encoding), None)
+            if previous_entry is not None:
+                self.total_bytes -= len(previous_entry[1])
+
+            self.entries[(key, encoding)] = (body_size, compressed_body)
+            self.total_bytes += len(compressed_body)
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_body) = self.entries.popitem(last=False)
+                self.total_bytes -= len(evicted_body)
+
+
+compressed_body_cache = CompressedBodyCache()
+
+
+def set_body_cache_key(response: flask.Response, key: str) -> flask.Response:
+    '''
+    Marks the response so that its compressed body is reused for the responses with the same key.
+    Use this only when the body is made from a cache and the key changes with the body,
+    like the user db hash of the sync route.
+    '''
+    setattr(response, BODY_CACHE_KEY_ATTR, key)
+    return response
+
+
+def compress_response(response: flask.Response) -> flask.Response:
+    config = flask.current_app.config
+    if not config.get('COMPRESSION_ENABLE', False):
+        return response
+
+    # Streamed or file responses are sent as is, and already encoded responses(like sync artifacts) too.
+    if response.direct_passthrough or response.is_streamed:
+        return response
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return response
+    if 'Content-Encoding' in response.headers:
+        return response
+    if response.mimetype not in config.get('COMPRESSION_MIMETYPES', ()):
+        return response
+
+    # Body may be compressed or not by Accept-Encoding header, so caches must know that.
+    response.vary.add('Accept-Encoding')
+
+    encoding = select_encoding(config)
+    if not encoding:
+        return response
+
+    body = response.get_data()
+    if len(body) < config.get('COMPRESSION_MIN_SIZE', 0):
+        return response
+
+    compressed_body = None
+    cache_key: typing.Optional[str] = getattr(response, BODY_CACHE_KEY_ATTR, None)
+    compressed_body_cache.max_bytes = config.get('COMPRESSION_CACHE_MAX_BYTES', 0)
+    if cache_key and compressed_body_cache.max_bytes:
+        compressed_body = compressed_body_cache.get(cache_key, encoding, len(body))
+
+    if compressed_body is None:
+        compressed_body = get_encoders(config)[encoding](body)
+        if cache_key and compressed_body_cache.max_bytes:
+            compressed_body_cache.put(cache_key, encoding, len(body), compressed_body)
+
+    # Small or already compressed data(like base64 of images) may not be smaller.
+    if len(compressed_body) >= len(body):
+        return response
+
+    response.set_data(compressed_body)
+    response.headers['Content-Encoding'] = encoding
+    if 'ETag' in response.headers:
+        response.headers['ETag'] = add_etag_encoding(response.headers['ETag'], encoding)
+    return response
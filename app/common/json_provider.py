@@ -0,0 +1,65 @@
+import base64
+import datetime
+import enum
+import flask
+import flask.json.provider
+import typing
+import werkzeug.http
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, responses are serialized by json module if it's not installed.
+    orjson = None
+
+
+class AppJSONProvider(flask.json.provider.DefaultJSONProvider):
+    '''
+    JSON provider of the app, which uses orjson when it's available and ORJSON_ENABLE config is not false.
+    Output is same as the default provider of flask, including datetime format(HTTP date),
+    so clients don't need to care about which serializer is used.
+    '''
+    # Same as JSON_AS_ASCII of app.config.Config, orjson always writes non-ASCII characters as UTF-8.
+    ensure_ascii = False
+
+    @staticmethod
+    def default(o: typing.Any) -> typing.Any:
+        if isinstance(o, (datetime.date, datetime.datetime)):
+            return werkzeug.http.http_date(o)
+        if isinstance(o, enum.Enum):
+            return o.value
+        if isinstance(o, (bytes, bytearray, memoryview)):
+            return base64.urlsafe_b64encode(bytes(o)).decode()
+        return flask.json.provider.DefaultJSONProvider.default(o)
+
+    def use_orjson(self) -> bool:
+        return orjson is not None and self._app.config.get('ORJSON_ENABLE', True)
+
+    def get_orjson_option(self) -> int:
+        # Datetimes are passed to default(), as orjson serializes those as ISO 8601 unlike flask.
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if self.compact is False or (self.compact is None and self._app.debug):
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps_bytes(self, obj: typing.Any) -> bytes:
+        if self.use_orjson():
+            try:
+                return orjson.dumps(obj, default=self.default, option=self.get_orjson_option())
+            except orjson.JSONEncodeError:
+                # orjson doesn't support some values that json module supports, like integers over 64 bits.
+                pass
+        return super().dumps(obj).encode()
+
+    def dumps(self, obj: typing.Any, **kwargs: typing.Any) -> str:
+        if kwargs:
+            # orjson doesn't support arguments of json.dumps.
+            # Default provider applies default, sort_keys and ensure_ascii of this provider for us.
+            return super().dumps(obj, **kwargs)
+        return self.dumps_bytes(obj).decode()
+
+    def response(self, *args: typing.Any, **kwargs: typing.Any) -> flask.Response:
+        # Serialize directly to bytes, so that we don't need to encode the body again.
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj) + b'\n', mimetype=self.mimetype)
@@ -1,20 +1,37 @@
 import flask
+import os
+import typing
+
 import app.common.mailgun.aws_ses as mailgun_aws
 import app.common.mailgun.gmail as mailgun_gmail
 
 
-def send_mail(fromaddr: str, toaddr: str, subject: str, message: str, raise_on_fail: bool = False) -> bool:
+def get_mail_config_from_env() -> dict[str, typing.Any]:
+    # Celery workers don't initialize flask app, so those need to read mail configs from os.environ.
+    # This must be same as mail configs on app.config.Config.
+    return {
+        'MAIL_ENABLE': os.environ.get('MAIL_ENABLE', True) != 'false',
+        'MAIL_PROVIDER': os.environ.get('MAIL_PROVIDER', 'AMAZON'),
+        'GOOGLE_CLIENT_ID': os.environ.get('GOOGLE_CLIENT_ID', None),
+        'GOOGLE_CLIENT_SECRET': os.environ.get('GOOGLE_CLIENT_SECRET', None),
+        'GOOGLE_REFRESH_TOKEN': os.environ.get('GOOGLE_REFRESH_TOKEN', None),
+    }
+
+
+def send_mail_with_config(config: typing.Mapping[str, typing.Any],
+                          fromaddr: str, toaddr: str, subject: str, message: str,
+                          raise_on_fail: bool = False) -> bool:
     mail_sent: bool = True
-    if flask.current_app.config.get('MAIL_ENABLE'):
+    if config.get('MAIL_ENABLE'):
         try:
-            mail_provider = flask.current_app.config.get('MAIL_PROVIDER', 'AMAZON')
+            mail_provider = config.get('MAIL_PROVIDER', 'AMAZON')
             if mail_provider == 'AMAZON':
                 mailgun_aws.send_mail(fromaddr=fromaddr, toaddr=toaddr, subject=subject, message=message)
             elif mail_provider == 'GOOGLE':
                 mailgun_gmail.send_mail(
-                    google_client_id=flask.current_app.config.get('GOOGLE_CLIENT_ID'),
-                    google_client_secret=flask.current_app.config.get('GOOGLE_CLIENT_SECRET'),
-                    google_refresh_token=flask.current_app.config.get('GOOGLE_REFRESH_TOKEN'),
+                    google_client_id=config.get('GOOGLE_CLIENT_ID'),
+                    google_client_secret=config.get('GOOGLE_CLIENT_SECRET'),
+                    google_refresh_token=config.get('GOOGLE_REFRESH_TOKEN'),
                     fromaddr=fromaddr, toaddr=toaddr, subject=subject, message=message)
             else:
                 raise NotImplementedError(f'Mail provider "{mail_provider}" is not supported')
@@ -25,3 +42,7 @@ def send_mail(fromaddr: str, toaddr: str, subject: str, message: str, raise_on_f
             if raise_on_fail:
                 raise err
     return mail_sent
+
+
+def send_mail(fromaddr: str, toaddr: str, subject: str, message: str, raise_on_fail: bool = False) -> bool:
+    return send_mail_with_config(flask.current_app.config, fromaddr, toaddr, subject, message, raise_on_fail)
@@ -0,0 +1,139 @@
+import concurrent.futures
+import flask
+import functools
+import os
+import threading
+import typing
+
+from passlib.hash import argon2
+
+
+class PasswordHasherBusyException(Exception):
+    '''
+    Raised when too many password hashing jobs are waiting on this process.
+    This is handled by the request handler and responded as server_busy(503),
+    so that login storms don't pile up requests on the workers.
+    '''
+    def __init__(self, message: str = 'Too many password hashing jobs are waiting'):
+        super().__init__(message)
+
+
+# Argon2 cost parameters, None means the default value of passlib.
+Argon2Parameters = tuple[typing.Optional[int], typing.Optional[int], typing.Optional[int]]
+
+
+@functools.lru_cache(maxsize=8)
+def get_argon2_hasher(parameters: Argon2Parameters):
+    time_cost, memory_cost, parallelism = parameters
+    options = {
+        'time_cost': time_cost,
+        'memory_cost': memory_cost,
+        'parallelism': parallelism, }
+    return argon2.using(**{k: v for k, v in options.items() if v is not None})
+
+
+# Functions below are run on the hasher processes, so those must not use flask context.
+def hash_password_job(pw: str, parameters: Argon2Parameters) -> str:
+    return get_argon2_hasher(parameters).hash(pw)
+
+
+def verify_password_job(pw: str, pw_hash: str, parameters: Argon2Parameters) -> tuple[bool, typing.Optional[str]]:
+    # Returns the verification result, and a new hash if the password is correct but the hash uses old parameters.
+    hasher = get_argon2_hasher(parameters)
+    try:
+        # Try verification with password they entered without trimming.
+        # If it fails, silently try it with trimming, but only when trimming changes the password.
+        verified_pw = pw
+        result = hasher.verify(pw, pw_hash)
+        if not result and pw.strip() != pw:
+            verified_pw = pw.strip()
+            result = hasher.verify(verified_pw, pw_hash)
+    except Exception:
+        return False, None
+
+    if result and hasher.needs_update(pw_hash):
+        return True, hasher.hash(verified_pw)
+    return result, None
+
+
+class PasswordHasherExecutor:
+    '''
+    Runs Argon2 on a process pool, so that hashing doesn't hold the GIL of the request workers.
+    Number of jobs on this process is limited by PASSWORD_HASH_QUEUE_SIZE,
+    and PasswordHasherBusyException is raised immediately when the queue is full.
+    '''
+    executor: typing.Optional[concurrent.futures.ProcessPoolExecutor] = None
+    executor_pid: typing.Optional[int] = None
+    queue_semaphore: typing.Optional[threading.BoundedSemaphore] = None
+
+    lock: threading.Lock
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def ensure_executor(self):
+        # Process pools are not usable after fork (like gunicorn workers with preload),
+        # so create the pool lazily on each process.
+        if self.executor_pid == os.getpid():
+            return
+
+        with self.lock:
+            if self.executor_pid == os.getpid():
+                return
+
+            config = flask.current_app.config
+            worker_count: int = config.get('PASSWORD_HASH_WORKERS', 0)
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=worker_count) if worker_count else None
+            self.queue_semaphore = threading.BoundedSemaphore(max(config.get('PASSWORD_HASH_QUEUE_SIZE', 1), 1))
+            self.executor_pid = os.getpid()
+
+    def run(self, func: typing.Callable, *args):
+        self.ensure_executor()
+        # Keep those on locals, as those can be replaced by other threads when the pool is broken.
+        executor, queue_semaphore = self.executor, self.queue_semaphore
+        if not queue_semaphore.acquire(blocking=False):
+            raise PasswordHasherBusyException()
+
+        try:
+            if not executor:
+                # Hashing on the request worker itself, when PASSWORD_HASH_WORKERS is 0.
+                return func(*args)
+
+            try:
+                return executor.submit(func, *args).result()
+            except concurrent.futures.process.BrokenProcessPool:
+                # One of the hasher processes was killed (maybe by OOM killer), create a new pool on next job.
+                # Broken pool must be shut down, or its management thread and pipes are leaked.
+                # Other threads may have already replaced it, so only the broken one is reset.
+                with self.lock:
+                    if self.executor is executor:
+                        executor.shutdown(wait=False)
+                        self.executor = None
+                        self.executor_pid = None
+                raise
+        finally:
+            queue_semaphore.release()
+
+
+password_hasher_executor = PasswordHasherExecutor()
+
+
+def get_argon2_parameters() -> Argon2Parameters:
+    config = flask.current_app.config
+    return (
+        config.get('ARGON2_TIME_COST', None),
+        config.get('ARGON2_MEMORY_COST', None),
+        config.get('ARGON2_PARALLELISM', None), )
+
+
+def hash_password(pw: str) -> str:
+    return password_hasher_executor.run(hash_password_job, pw, get_argon2_parameters())
+
+
+def verify_password(pw: str, pw_hash: str) -> tuple[bool, typing.Optional[str]]:
+    '''
+    Verifies the password with both untrimmed and trimmed one in a single job.
+    When the password is correct but the hash was made with old Argon2 parameters,
+    a new hash of the password is also returned, so that the caller can save it.
+    '''
+    return password_hasher_executor.run(verify_password_job, pw, pw_hash, get_argon2_parameters())
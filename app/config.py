@@ -14,6 +14,29 @@ class Config:
     X_PREFIX_LEVEL = int(os.environ.get('X_PREFIX_LEVEL', 0))
 
     JSON_AS_ASCII = False
+    # API responses are serialized by orjson if it's installed, unless $env:ORJSON_ENABLE is 'false'
+    ORJSON_ENABLE = os.environ.get('ORJSON_ENABLE', True) != 'false'
+    # Responses are compressed with zstd, br(brotli) or gzip when the client accepts it,
+    # unless $env:COMPRESSION_ENABLE is 'false'. zstd and br are used only when those packages are installed.
+    COMPRESSION_ENABLE = os.environ.get('COMPRESSION_ENABLE', True) != 'false'
+    # Bodies smaller than this(bytes) are sent as is, as compression doesn't help those much.
+    COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+    try:
+        COMPRESSION_MIMETYPES = json.loads(os.environ.get(
+            'COMPRESSION_MIMETYPES',
+            '["application/json", "text/plain", "text/html", "text/css", "text/javascript", "image/svg+xml"]'))
+        # Encodings in order of preference, when the client accepts those with the same quality.
+        COMPRESSION_ENCODINGS = json.loads(os.environ.get('COMPRESSION_ENCODINGS', '["zstd", "br", "gzip"]'))
+    except Exception:
+        print('Failed to load COMPRESSION_MIMETYPES or COMPRESSION_ENCODINGS.\n'
+              'Please check the value is a valid JSON array.')
+        COMPRESSION_MIMETYPES = ['application/json', ]
+        COMPRESSION_ENCODINGS = ['gzip', ]
+    COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6))
+    COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 5))
+    COMPRESSION_ZSTD_LEVEL = int(os.environ.get('COMPRESSION_ZSTD_LEVEL', 3))
+    # Compressed bodies of cached payloads(like sync db) are kept up to this size(bytes) per process, 0 disables this.
+    COMPRESSION_CACHE_MAX_BYTES = int(os.environ.get('COMPRESSION_CACHE_MAX_BYTES', 16 * 1024 * 1024))
     PROJECT_NAME = os.environ.get('PROJECT_NAME')
     BACKEND_NAME = os.environ.get('BACKEND_NAME')
     SERVER_NAME = os.environ.get('SERVER_NAME', None)
@@ -31,6 +54,29 @@ class Config:
     # `ACCOUNT_ROUTE_ENABLE` will be disabled only if $env:ACCOUNT_ROUTE_ENABLE is 'false'
     ACCOUNT_ROUTE_ENABLE = os.environ.get('ACCOUNT_ROUTE_ENABLE', True) != 'false'
     DROP_ALL_REFRESH_TOKEN_ON_LOAD = os.environ.get('DROP_ALL_REFRESH_TOKEN_ON_LOAD', True) != 'false'
+    # When this is enabled, revoked tokens are checked on the in-process cache that is updated by redis pub/sub,
+    # instead of querying redis on every authenticated request.
+    # This will be enabled only if $env:TOKEN_REVOKE_CACHE_ENABLE is 'true'
+    TOKEN_REVOKE_CACHE_ENABLE = os.environ.get('TOKEN_REVOKE_CACHE_ENABLE', False) == 'true'
+
+    # Argon2 cost parameters of password hashes. Default values of passlib are used when those are not set.
+    # Use `flask calibrate-argon2` to find the values for the deployed hardware.
+    # Hashes with old parameters are rehashed when the users sign in.
+    ARGON2_TIME_COST = int(os.environ.get('ARGON2_TIME_COST')) if os.environ.get('ARGON2_TIME_COST') else None
+    ARGON2_MEMORY_COST = int(os.environ.get('ARGON2_MEMORY_COST')) if os.environ.get('ARGON2_MEMORY_COST') else None
+    ARGON2_PARALLELISM = int(os.environ.get('ARGON2_PARALLELISM')) if os.environ.get('ARGON2_PARALLELISM') else None
+    # Password hashing runs on this number of processes per request worker, 0 means hashing on the request worker.
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 1))
+    # Requests that need password hashing are responded with 503 when this number of jobs are already waiting.
+    PASSWORD_HASH_QUEUE_SIZE = int(os.environ.get('PASSWORD_HASH_QUEUE_SIZE', 8))
+
+    # Login failures are counted on redis with sliding windows. (Windows are in seconds)
+    # Accounts are locked when the failures reach LOGIN_FAIL_ACCOUNT_LIMIT on the window,
+    # and sign-in from an IP address is rejected while its failures are over LOGIN_FAIL_IP_LIMIT on the window.
+    LOGIN_FAIL_ACCOUNT_LIMIT = int(os.environ.get('LOGIN_FAIL_ACCOUNT_LIMIT', 5))
+    LOGIN_FAIL_ACCOUNT_WINDOW = int(os.environ.get('LOGIN_FAIL_ACCOUNT_WINDOW', 86400))
+    LOGIN_FAIL_IP_LIMIT = int(os.environ.get('LOGIN_FAIL_IP_LIMIT', 30))
+    LOGIN_FAIL_IP_WINDOW = int(os.environ.get('LOGIN_FAIL_IP_WINDOW', 600))
 
     FILE_MANAGEMENT_ROUTE_ENABLE = os.environ.get('FILE_MANAGEMENT_ROUTE_ENABLE', False) == 'true'
     FILE_UPLOAD_IMAGE_WEB_FRIENDLY_CHECK = os.environ.get('FILE_UPLOAD_IMAGE_WEB_FRIENDLY_CHECK', False) == 'true'
@@ -22,6 +22,10 @@ class RedisKeyType(utils.EnumAutoName):
     EMAIL_VERIFICATION = enum.auto()
     EMAIL_PASSWORD_RESET = enum.auto()
     TOKEN_REVOKE = enum.auto()
+    TOKEN_REVOKE_EPOCH = enum.auto()
+    LOGIN_FAIL_ACCOUNT = enum.auto()
+    LOGIN_FAIL_IP = enum.auto()
+    USER_IDENT_USED = enum.auto()
 
     def as_redis_key(self, value: str):
         return f'{self.value}={str(value)}'
@@ -158,6 +162,9 @@ def init_app(app: flask.Flask):
     # checkfirst isn't supported on create_all.
     for table in db.get_tables_for_bind():
         table.create(checkfirst=True, bind=db.engine)
+        # Indexes that are added after the table is created are not created by table.create
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
 
     if app.config.get('RESTAPI_VERSION') == 'dev' and app.config.get('DROP_ALL_REFRESH_TOKEN_ON_LOAD', True):
         # Drop some DB tables when on dev mode
@@ -167,5 +174,14 @@ def init_app(app: flask.Flask):
         # Also, flush all keys in redis DB
         redis_db.flushdb()  # no asynchronous
 
+    # Load values of user ID, nickname and email on redis, so that duplicate checks can skip DB queries.
+    # This is skipped if those are already loaded by another worker.
+    import app.database.user_ident_filter as user_ident_filter  # noqa
+    try:
+        user_ident_filter.warm_up()
+    except Exception as err:
+        # Duplicate checks just fall back to DB until warm-up is done.
+        print(utils.get_traceback_msg(err))
+
     # init_app must return app
     return app
@@ -1,16 +1,18 @@
 import datetime
 import flask
-import inspect
+import functools
 import jwt
 import jwt.exceptions
 import redis
 import secrets
+import sqlalchemy as sql
 import user_agents as ua
 import user_agents.parsers as ua_parser
 import typing
 
 import app.common.utils as utils
 import app.database as db_module
+import app.database.token_revoke as token_revoke
 import app.database.user as user_module
 
 db = db_module.db
@@ -27,8 +29,22 @@ admin_token_valid_duration: datetime.timedelta = datetime.timedelta(hours=12)
 T = typing.TypeVar('T', bound='TokenBase')
 
 
+@functools.lru_cache(maxsize=1024)
+def get_user_agent_family(user_agent: str) -> tuple[bool, bool, bool, str, str]:
+    # Parsing User-Agent is slow, and clients send the same User-Agent on every token refresh,
+    # so cache only the fields that we compare.
+    parsed_ua: ua_parser.UserAgent = ua.parse(user_agent)
+    return (
+        parsed_ua.is_mobile,
+        parsed_ua.is_tablet,
+        parsed_ua.is_pc,
+        parsed_ua.os.family,
+        parsed_ua.browser.family,
+    )
+
+
 class TokenBase:
-    ALLOWED_CLAIM = ['api_ver', 'iss', 'exp', 'user', 'sub', 'jti', 'role', 'otp']
+    ALLOWED_CLAIM = ['api_ver', 'iss', 'exp', 'user', 'sub', 'jti', 'role', 'otp', 'rev']
 
     # This will raise error when env var "RESTAPI_VERSION" not set.
     api_ver: str = flask.current_app.config.get('RESTAPI_VERSION')
@@ -44,15 +60,37 @@ class TokenBase:
 
     # Private Claim
     user: int = -1  # Audience, User, Token holder
-    role: str = ''
+    # Role is a list of 'admin' and {'type': 'profile', 'id': <profile id>}.
+    # This is a JSON string on DB (and on old tokens), but tokens carry this as a list.
+    role: typing.Union[str, list] = ''
     otp: str = ''
+    # Revocation epoch of the user when this token is issued. (See token_revoke)
+    rev: int = 0
     # data: dict
 
+    # Parsed data of role, which are set by parse_role.
+    # Authorization checks must use these instead of searching on role string.
+    profile_ids: frozenset[int] = frozenset()
+    _is_admin: bool = False
+
+    @staticmethod
+    def get_role_list(role: typing.Union[str, list, None]) -> list:
+        if isinstance(role, str):
+            role = utils.safe_json_loads(role) if role else None
+        return role if isinstance(role, list) else []
+
+    def parse_role(self):
+        role_list = self.get_role_list(self.role)
+        self.profile_ids = frozenset(
+            utils.safe_int(r.get('id', 0)) for r in role_list
+            if isinstance(r, dict) and r.get('type', '') == 'profile')
+        self._is_admin = 'admin' in role_list
+
     def is_admin(self):
-        json_result = utils.safe_json_loads(self.role)
-        if json_result and 'admin' in json_result:
-            return True
-        return False
+        return self._is_admin
+
+    def has_profile(self, profile_id: typing.Union[int, str, None]) -> bool:
+        return utils.safe_int(profile_id) in self.profile_ids
 
     def create_token(self, key: str, algorithm: str = 'HS256') -> str:
         if not self.sub:
@@ -75,12 +113,9 @@ class TokenBase:
         if (not token_exp_time) or (token_exp_time < current_time):
             raise jwt.exceptions.ExpiredSignatureError('Token has reached expiration time')
 
-        result_payload = dict()
-        attrs = inspect.getmembers(self, lambda o: not callable(o))
-
-        for attr_name, attr_value in attrs:
-            if attr_name in self.ALLOWED_CLAIM:
-                result_payload[attr_name] = attr_value
+        # Collect claims from the claim list directly, instead of inspecting all members of this object.
+        result_payload = {claim_name: getattr(self, claim_name) for claim_name in self.ALLOWED_CLAIM}
+        result_payload['role'] = self.get_role_list(self.role)
 
         return jwt.encode(payload=result_payload, key=key, algorithm=algorithm)
 
@@ -116,6 +151,7 @@ class TokenBase:
 
         new_token = cls()
         new_token.__dict__.update(token_data)
+        new_token.parse_role()
         return new_token
 
 
@@ -126,16 +162,16 @@ class AccessToken(TokenBase):
     _refresh_token: 'RefreshToken' = None
 
     def create_token(self, key: str, algorithm: str = 'HS256', exp_reset: bool = True) -> str:
-        if not db.session.query(RefreshToken).filter(RefreshToken.jti == self.jti).first():
-            raise Exception('Access Token could not be issued')
+        # We don't need to query the refresh token again if this token is created from the refresh token on DB.
+        refresh_token = self._refresh_token
+        if refresh_token is None or refresh_token.jti != self.jti or not sql.inspect(refresh_token).persistent:
+            if not db.session.query(RefreshToken.jti).filter(RefreshToken.jti == self.jti).first():
+                raise Exception('Access Token could not be issued')
 
         new_token = super().create_token(key, algorithm=algorithm)
 
         # If new token safely issued, then remove revoked history
-        redis_key = RedisKeyType.TOKEN_REVOKE.as_redis_key(self.jti)
-        redis_result = redis_db.get(redis_key)
-        if redis_result and redis_result == b'revoked':
-            redis_db.delete(redis_key)
+        token_revoke.unrevoke_token(self.jti)
 
         return new_token
 
@@ -144,9 +180,7 @@ class AccessToken(TokenBase):
         parsed_token = super().from_token(jwt_input, key, algorithm)
 
         # Check if token's revoked
-        redis_key = RedisKeyType.TOKEN_REVOKE.as_redis_key(parsed_token.jti)
-        redis_result = redis_db.get(redis_key)
-        if redis_result and redis_result == b'revoked':
+        if token_revoke.is_token_revoked(parsed_token.jti, parsed_token.user, utils.safe_int(parsed_token.rev)):
             raise jwt.exceptions.InvalidTokenError('This token was revoked')
 
         return parsed_token
@@ -175,6 +209,9 @@ class AccessToken(TokenBase):
         new_token.jti = refresh_token.jti
         # role field must be refreshed from TB_USER
         new_token.role = refresh_token.usertable.role
+        new_token.parse_role()
+        # Tokens issued before the latest revocation of the user are revoked.
+        new_token.rev = token_revoke.get_revoke_epoch(refresh_token.user)
 
         return new_token
 
@@ -190,7 +227,8 @@ class RefreshToken(TokenBase, db.Model, db_module.DefaultModelMixin):
                     db.Sequence('SQ_RefreshToken_UUID'),
                     primary_key=True)
     # Expiration Unix Time
-    exp = db.Column(db.DateTime, nullable=False)
+    # This is indexed, as expired tokens are deleted periodically. (See maintenance)
+    exp = db.Column(db.DateTime, nullable=False, index=True)
     # Audience, User, Token holder
     user = db.Column(db_module.PrimaryKeyType,
                      db.ForeignKey('TB_USER.uuid'),
@@ -217,6 +255,7 @@ class RefreshToken(TokenBase, db.Model, db_module.DefaultModelMixin):
         new_token = cls()
         new_token.usertable = userdata
         new_token.role = userdata.role
+        new_token.parse_role()
         new_token.exp = datetime.datetime.utcnow().replace(microsecond=0)  # Drop microseconds
         new_token.exp += refresh_token_valid_duration
         new_token.otp = str(int(secrets.token_hex(8), 16)).zfill(24)
@@ -254,6 +293,7 @@ class RefreshToken(TokenBase, db.Model, db_module.DefaultModelMixin):
         cookie_token_exp = datetime.datetime.fromtimestamp(token_data.get('exp', 0), utils.UTC)
 
         if target_token.user == int(token_data.get('user', '')) and db_token_exp == cookie_token_exp:
+            target_token.parse_role()
             return target_token
         else:
             raise jwt.exceptions.InvalidTokenError('RefreshToken information mismatch')
@@ -290,9 +330,7 @@ class AdminToken(TokenBase):
         parsed_token = super().from_token(jwt_input, key, algorithm)
 
         # Check if token's revoked
-        redis_key = RedisKeyType.TOKEN_REVOKE.as_redis_key(parsed_token.jti)
-        redis_result = redis_db.get(redis_key)
-        if redis_result and redis_result == b'revoked':
+        if token_revoke.is_token_revoked(parsed_token.jti, parsed_token.user, utils.safe_int(parsed_token.rev)):
             raise jwt.exceptions.InvalidTokenError('This token was revoked')
 
         return parsed_token
@@ -321,6 +359,8 @@ class AdminToken(TokenBase):
         new_token.jti = refresh_token.jti
         new_token.role = refresh_token.role
         new_token.otp = refresh_token.otp
+        new_token.parse_role()
+        new_token.rev = token_revoke.get_revoke_epoch(refresh_token.user)
 
         return new_token
 
@@ -360,7 +400,7 @@ def create_login_data(user_data: user_module.User,
         'token': access_token_jwt,
     }
 
-    if refresh_token.role and 'admin' in refresh_token.role:
+    if refresh_token.is_admin():
         # This user is admin, so we need to issue admin token and send this with cookie.
         admin_token = AdminToken.from_refresh_token(refresh_token)
         admin_token_jwt = admin_token.create_token(key)
@@ -395,18 +435,8 @@ def refresh_login_data(refresh_token_jwt: str,
     # Check device type/OS/browser using User-Agent.
     # We'll refresh token only if it's same with db records
     try:
-        db_ua: ua_parser.UserAgent = ua.parse(refresh_token.user_agent)
-        req_ua: ua_parser.UserAgent = ua.parse(user_agent)
-
-        check_result: bool = all((
-            all((
-                db_ua.is_mobile == req_ua.is_mobile,
-                db_ua.is_tablet == req_ua.is_tablet,
-                db_ua.is_pc == req_ua.is_pc,
-            )),
-            db_ua.os.family == req_ua.os.family,
-            db_ua.browser.family == req_ua.browser.family,
-        ))
+        # Device type, OS family and browser family must be same.
+        check_result: bool = get_user_agent_family(refresh_token.user_agent) == get_user_agent_family(user_agent)
         if not check_result:
             raise jwt.exceptions.InvalidTokenError('User-Agent does not compatable')
     except jwt.exceptions.InvalidTokenError:
@@ -456,7 +486,7 @@ def refresh_login_data(refresh_token_jwt: str,
     }
 
     # Re-issue Admin token if user is admin
-    if refresh_token.role and 'admin' in refresh_token.role:
+    if refresh_token.is_admin():
         admin_token = AdminToken.from_refresh_token(refresh_token)
         admin_token_jwt = admin_token.create_token(key)
         admin_token_cookie = utils.cookie_creator(
@@ -0,0 +1,79 @@
+import flask
+import secrets
+import time
+import typing
+
+import redis
+
+import app.database as db_module
+
+RedisKeyType = db_module.RedisKeyType
+
+# Login failures are recorded on redis sorted sets, as (member: unique id, score: failed time in milliseconds).
+# Failures older than the window are removed on every write, so the set is a sliding window of failures,
+# and the whole set expires after the window when no failures happen.
+# This returns the number of failures on the window, including the new one.
+LOGIN_FAIL_RECORD_SCRIPT = '''
+local now_ms = tonumber(ARGV[1])
+local window_ms = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now_ms - window_ms)
+redis.call('ZADD', KEYS[1], now_ms, ARGV[3])
+redis.call('PEXPIRE', KEYS[1], window_ms)
+return redis.call('ZCARD', KEYS[1])
+'''
+
+
+def get_window_config(name: str) -> tuple[int, int]:
+    # Returns (limit, window milliseconds) of LOGIN_FAIL_{name}_LIMIT and LOGIN_FAIL_{name}_WINDOW.
+    config = flask.current_app.config
+    return int(config.get(f'LOGIN_FAIL_{name}_LIMIT')), int(config.get(f'LOGIN_FAIL_{name}_WINDOW')) * 1000
+
+
+def get_fail_count(redis_key: str, window_ms: int) -> int:
+    redis_db: redis.StrictRedis = db_module.redis_db
+    return redis_db.zcount(redis_key, int(time.time() * 1000) - window_ms, '+inf')
+
+
+def is_ip_blocked(ip_addr: typing.Optional[str]) -> bool:
+    '''
+    Returns True if too many logins were failed from this IP address on the window.
+    This is checked before querying the user or verifying the password,
+    so that credential stuffing from a single address costs only a redis query.
+    '''
+    if not ip_addr:
+        return False
+
+    limit, window_ms = get_window_config('IP')
+    return get_fail_count(RedisKeyType.LOGIN_FAIL_IP.as_redis_key(ip_addr), window_ms) >= limit
+
+
+def record_login_fail(user_id: typing.Optional[int], ip_addr: typing.Optional[str]) -> int:
+    '''
+    Records a login failure of the user and the IP address in a single round trip,
+    and returns the number of failures of the user on the window. (0 if user_id is not given)
+    '''
+    redis_db: redis.StrictRedis = db_module.redis_db
+    record_script = redis_db.register_script(LOGIN_FAIL_RECORD_SCRIPT)
+    now_ms = int(time.time() * 1000)
+    fail_id = f'{now_ms}:{secrets.token_hex(4)}'
+
+    targets: list[tuple[str, int]] = list()
+    if user_id:
+        targets.append((RedisKeyType.LOGIN_FAIL_ACCOUNT.as_redis_key(user_id), get_window_config('ACCOUNT')[1]))
+    if ip_addr:
+        targets.append((RedisKeyType.LOGIN_FAIL_IP.as_redis_key(ip_addr), get_window_config('IP')[1]))
+    if not targets:
+        return 0
+
+    with redis_db.pipeline(transaction=False) as pipe:
+        for redis_key, window_ms in targets:
+            record_script(keys=(redis_key, ), args=(now_ms, window_ms, fail_id), client=pipe)
+        results = pipe.execute()
+
+    return int(results[0]) if user_id else 0
+
+
+def clear_login_fail(user_id: int):
+    # Failures of IP addresses are not cleared, as an attacker may have an account.
+    redis_db: redis.StrictRedis = db_module.redis_db
+    redis_db.delete(RedisKeyType.LOGIN_FAIL_ACCOUNT.as_redis_key(user_id))
@@ -0,0 +1,276 @@
+import datetime
+import flask
+import os
+import threading
+import time
+import typing
+
+import redis
+
+import app.common.utils as utils
+import app.database as db_module
+
+RedisKeyType = db_module.RedisKeyType
+
+# Revocation records are kept for this duration, which is longer than the lifetime of access and admin tokens.
+TOKEN_REVOKE_DURATION: datetime.timedelta = datetime.timedelta(weeks=2)
+# Revoked and unrevoked JTIs are published on this channel, so that API servers can update their revocation cache.
+# Messages are `revoke:<jti>:<expiration unix time>`, `unrevoke:<jti>`,
+# or `epoch:<user id>:<revocation epoch>:<expiration unix time>`.
+TOKEN_REVOKE_CHANNEL = 'TOKEN_REVOKED'
+# Expired JTIs on the revocation cache are removed with this interval(seconds).
+TOKEN_REVOKE_CACHE_PRUNE_INTERVAL = 60
+
+# Revocation epoch of a user is stored on a single redis key, and all tokens of the user has the epoch when issued.
+# Tokens that have older epoch than the current one are revoked, so revoking all tokens of a user is a single write.
+# New epoch is always bigger than both the current epoch and the current time(microseconds),
+# so epochs keep increasing even after the key is expired.
+TOKEN_REVOKE_EPOCH_BUMP_SCRIPT = '''
+local current_epoch = tonumber(redis.call('GET', KEYS[1]) or '0')
+local new_epoch = math.max(tonumber(ARGV[1]), current_epoch + 1)
+redis.call('SET', KEYS[1], new_epoch, 'EX', ARGV[2])
+return new_epoch
+'''
+
+
+class TokenRevokeCache:
+    '''
+    Set of revoked JTIs of this process, which is kept up to date by TOKEN_REVOKE_CHANNEL.
+    Tokens that are not on this cache can be accepted without asking redis,
+    but this can be used only while the subscriber is connected.
+    '''
+    # Key is JTI, and value is expiration unix time of the revocation record.
+    revoked: dict[int, float]
+    # Key is user id, and value is (revocation epoch, expiration unix time of the epoch).
+    epochs: dict[int, tuple[int, float]]
+    # This is True only when we have all revocation records and we are receiving all revocation messages.
+    is_synced: bool = False
+
+    lock: threading.Lock
+    subscriber_thread: typing.Optional[threading.Thread] = None
+    subscriber_pid: typing.Optional[int] = None
+
+    def __init__(self):
+        self.revoked = dict()
+        self.epochs = dict()
+        self.lock = threading.Lock()
+
+    def may_be_revoked(self, jti: int) -> bool:
+        expire_at = self.revoked.get(jti, None)
+        return expire_at is not None and expire_at > time.time()
+
+    def get_epoch(self, user_id: int) -> int:
+        epoch, expire_at = self.epochs.get(user_id, (0, 0))
+        return epoch if expire_at > time.time() else 0
+
+    def add(self, jti: int, expire_at: float):
+        with self.lock:
+            self.revoked[jti] = max(expire_at, self.revoked.get(jti, 0))
+
+    def set_epoch(self, user_id: int, epoch: int, expire_at: float):
+        with self.lock:
+            # Messages can arrive out of order, but epochs never decrease.
+            if self.epochs.get(user_id, (0, 0))[0] <= epoch:
+                self.epochs[user_id] = (epoch, expire_at)
+
+    def discard(self, jti: int):
+        with self.lock:
+            self.revoked.pop(jti, None)
+
+    def prune(self):
+        current_time = time.time()
+        with self.lock:
+            self.revoked = {k: v for k, v in self.revoked.items() if v > current_time}
+            self.epochs = {k: v for k, v in self.epochs.items() if v[1] > current_time}
+
+    @staticmethod
+    def load_records(redis_conn: redis.StrictRedis,
+                     key_type: db_module.RedisKeyType) -> typing.Generator[tuple[int, bytes, float], None, None]:
+        # Yields (id, value, expiration unix time) of all records of key_type on redis.
+        current_time = time.time()
+        redis_key_prefix = key_type.as_redis_key('')
+
+        redis_keys: list[bytes] = list(redis_conn.scan_iter(match=redis_key_prefix + '*', count=1000))
+        for index in range(0, len(redis_keys), 1000):
+            target_keys = redis_keys[index:index + 1000]
+            with redis_conn.pipeline(transaction=False) as pipe:
+                for redis_key in target_keys:
+                    pipe.get(redis_key)
+                    pipe.pttl(redis_key)
+                redis_results = pipe.execute()
+
+            for redis_key, redis_value, redis_pttl in zip(target_keys, redis_results[0::2], redis_results[1::2]):
+                record_id = utils.safe_int(redis_key.decode().removeprefix(redis_key_prefix))
+                if not record_id or redis_value is None:
+                    continue
+                # Records without TTL are treated as same as newly written ones.
+                yield record_id, redis_value, current_time + (
+                    redis_pttl / 1000 if redis_pttl > 0 else TOKEN_REVOKE_DURATION.total_seconds())
+
+    def resync(self, redis_conn: redis.StrictRedis):
+        # Load all revocation records and epochs from redis.
+        revoked: dict[int, float] = {
+            jti: expire_at
+            for jti, redis_value, expire_at in self.load_records(redis_conn, RedisKeyType.TOKEN_REVOKE)
+            if redis_value == b'revoked'}
+        epochs: dict[int, tuple[int, float]] = {
+            user_id: (utils.safe_int(redis_value), expire_at)
+            for user_id, redis_value, expire_at in self.load_records(redis_conn, RedisKeyType.TOKEN_REVOKE_EPOCH)}
+
+        with self.lock:
+            self.revoked = revoked
+            self.epochs = epochs
+
+    def handle_message(self, message_data: bytes):
+        action, _, value = message_data.decode().partition(':')
+        if action == 'revoke':
+            jti_str, _, expire_at_str = value.partition(':')
+            jti = utils.safe_int(jti_str)
+            if jti:
+                self.add(jti, utils.safe_int(expire_at_str) or time.time() + TOKEN_REVOKE_DURATION.total_seconds())
+        elif action == 'unrevoke':
+            jti = utils.safe_int(value)
+            if jti:
+                self.discard(jti)
+        elif action == 'epoch':
+            user_id_str, epoch_str, expire_at_str = (value.split(':') + ['', '', ''])[:3]
+            user_id = utils.safe_int(user_id_str)
+            if user_id:
+                self.set_epoch(
+                    user_id, utils.safe_int(epoch_str),
+                    utils.safe_int(expire_at_str) or time.time() + TOKEN_REVOKE_DURATION.total_seconds())
+
+    def ensure_subscriber(self, redis_conn: redis.StrictRedis):
+        # Threads are not copied on fork (like gunicorn workers with preload),
+        # so start the subscriber thread lazily on each process.
+        if self.subscriber_pid == os.getpid() and self.subscriber_thread and self.subscriber_thread.is_alive():
+            return
+
+        with self.lock:
+            if self.subscriber_pid == os.getpid() and self.subscriber_thread and self.subscriber_thread.is_alive():
+                return
+
+            self.is_synced = False
+            self.subscriber_pid = os.getpid()
+            self.subscriber_thread = threading.Thread(
+                target=self.run_subscriber,
+                args=(redis_conn, ),
+                name='TokenRevokeCacheSubscriber',
+                daemon=True)
+            self.subscriber_thread.start()
+
+    def run_subscriber(self, redis_conn: redis.StrictRedis):
+        while True:
+            try:
+                pubsub = redis_conn.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(TOKEN_REVOKE_CHANNEL)
+
+                # Subscribe first and then load all records, so that we don't miss any revocations between those.
+                self.resync(redis_conn)
+                self.is_synced = True
+
+                last_pruned_at = time.time()
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message and message.get('type', None) == 'message':
+                        self.handle_message(message['data'])
+
+                    if time.time() - last_pruned_at > TOKEN_REVOKE_CACHE_PRUNE_INTERVAL:
+                        self.prune()
+                        last_pruned_at = time.time()
+            except Exception as err:
+                print(utils.get_traceback_msg(err))
+
+            # We may miss revocations while we are not subscribing, so ask redis on every check until resync.
+            self.is_synced = False
+            time.sleep(1)
+
+
+token_revoke_cache = TokenRevokeCache()
+
+
+def get_revoke_epoch(user_id: int) -> int:
+    # Tokens must be issued with this epoch.
+    return utils.safe_int(db_module.redis_db.get(RedisKeyType.TOKEN_REVOKE_EPOCH.as_redis_key(user_id)))
+
+
+def is_token_revoked(jti: int, user_id: int, revoke_epoch: int) -> bool:
+    redis_db: redis.StrictRedis = db_module.redis_db
+
+    if flask.current_app.config.get('TOKEN_REVOKE_CACHE_ENABLE', False):
+        token_revoke_cache.ensure_subscriber(redis_db)
+        # Only revoked tokens are checked on redis again, as the cache can be stale after unrevocation.
+        if token_revoke_cache.is_synced\
+                and not token_revoke_cache.may_be_revoked(jti)\
+                and revoke_epoch >= token_revoke_cache.get_epoch(user_id):
+            return False
+
+    with redis_db.pipeline(transaction=False) as pipe:
+        pipe.get(RedisKeyType.TOKEN_REVOKE.as_redis_key(jti))
+        pipe.get(RedisKeyType.TOKEN_REVOKE_EPOCH.as_redis_key(user_id))
+        revoked_result, epoch_result = pipe.execute()
+
+    if revoked_result and revoked_result == b'revoked':
+        return True
+    return revoke_epoch < utils.safe_int(epoch_result)
+
+
+def revoke_tokens(jtis: typing.Iterable[int]):
+    '''
+    Revokes access/admin tokens of the given JTIs, and notifies all API servers.
+    All revocations are sent in a single round trip.
+    '''
+    redis_db: redis.StrictRedis = db_module.redis_db
+    expire_at = int(time.time() + TOKEN_REVOKE_DURATION.total_seconds())
+
+    with redis_db.pipeline(transaction=False) as pipe:
+        for jti in jtis:
+            pipe.set(RedisKeyType.TOKEN_REVOKE.as_redis_key(jti), 'revoked', TOKEN_REVOKE_DURATION)
+            pipe.publish(TOKEN_REVOKE_CHANNEL, f'revoke:{jti}:{expire_at}')
+        pipe.execute()
+
+
+def revoke_token(jti: int):
+    revoke_tokens((jti, ))
+
+
+def revoke_user_tokens(user_ids: typing.Iterable[int]) -> dict[int, int]:
+    '''
+    Revokes all access/admin tokens of the given users by increasing their revocation epochs.
+    This is a single write per user regardless of the number of tokens,
+    and all users are handled in a single round trip.
+    Refresh tokens are not revoked, so users can get new access tokens with the new epoch.
+    '''
+    redis_db: redis.StrictRedis = db_module.redis_db
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return dict()
+
+    bump_script = redis_db.register_script(TOKEN_REVOKE_EPOCH_BUMP_SCRIPT)
+    expire_seconds = int(TOKEN_REVOKE_DURATION.total_seconds())
+    with redis_db.pipeline(transaction=False) as pipe:
+        for user_id in user_ids:
+            bump_script(
+                keys=(RedisKeyType.TOKEN_REVOKE_EPOCH.as_redis_key(user_id), ),
+                args=(time.time_ns() // 1000, expire_seconds),
+                client=pipe)
+        new_epochs = dict(zip(user_ids, (utils.safe_int(z) for z in pipe.execute())))
+
+    expire_at = int(time.time()) + expire_seconds
+    with redis_db.pipeline(transaction=False) as pipe:
+        for user_id, epoch in new_epochs.items():
+            pipe.publish(TOKEN_REVOKE_CHANNEL, f'epoch:{user_id}:{epoch}:{expire_at}')
+        pipe.execute()
+
+    return new_epochs
+
+
+def revoke_user_token(user_id: int) -> int:
+    return revoke_user_tokens((user_id, ))[user_id]
+
+
+def unrevoke_token(jti: int):
+    # This is used when a new access token is issued with the JTI of a revoked token.
+    redis_db: redis.StrictRedis = db_module.redis_db
+    if redis_db.delete(RedisKeyType.TOKEN_REVOKE.as_redis_key(jti)):
+        redis_db.publish(TOKEN_REVOKE_CHANNEL, f'unrevoke:{jti}')
@@ -32,7 +32,7 @@ class UploadedFile(db_module.DefaultModelMixin, db.Model):
     locked_by = db.relationship(user_module.User, primaryjoin=locked_by_id == user_module.User.uuid)
     why_locked = db.Column(db.String, nullable=True)
 
-    deleted_at = db.Column(db.DateTime, nullable=True)
+    deleted_at = db.Column(db.DateTime, nullable=True, index=True)
     deleted_by_id = db.Column(db_module.PrimaryKeyType,
                               db.ForeignKey('TB_USER.uuid'),
                               nullable=True)
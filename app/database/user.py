@@ -4,10 +4,11 @@ import flask
 import jwt
 import secrets
 import typing
-from passlib.hash import argon2
 
 import app.common.utils as utils
+import app.common.password_hasher as password_hasher
 import app.database as db_module
+import app.database.login_throttle as login_throttle
 
 db = db_module.db
 redis_db = db_module.redis_db
@@ -57,15 +58,14 @@ class User(db_module.DefaultModelMixin, db.Model):
         if not self.password:
             return False
 
-        # Try verification with password they entered without trimming.
-        # If it fails, silently try it with trimming.
-        try:
-            result = argon2.verify(pw, self.password)
-            if not result:
-                result = argon2.verify(pw.strip(), self.password)
-            return result
-        except Exception:
-            return False
+        # Verification runs on the password hasher processes, with and without trimming at once.
+        # This raises PasswordHasherBusyException when the hasher is too busy.
+        result, new_password_hash = password_hasher.verify_password(pw, self.password)
+        if new_password_hash:
+            # Argon2 parameters are changed after this hash was made, so replace it with new one.
+            # This will be saved when the session is committed.
+            self.password = new_password_hash
+        return result
 
     def change_password(self, orig_pw: str, new_pw: str, force_change: bool = False) -> tuple[bool, str]:
         # Returns False if this fails, and returns True when it success
@@ -86,7 +86,9 @@ class User(db_module.DefaultModelMixin, db.Model):
             return False, 'PW_REUSED_ON_ID_EMAIL_NICK'
 
         try:
-            self.password = argon2.hash(new_pw)
+            self.password = password_hasher.hash_password(new_pw)
+        except password_hasher.PasswordHasherBusyException:
+            raise
         except Exception:
             return False, 'UNKNOWN_ERROR'
 
@@ -121,10 +123,17 @@ class User(db_module.DefaultModelMixin, db.Model):
             return False, 'DB_ERROR'
 
     @classmethod
-    def try_login(cls, user_ident: str, pw: str) -> tuple[typing.Union[bool, 'User'], str]:
+    def try_login(cls,
+                  user_ident: str,
+                  pw: str,
+                  ip_addr: typing.Optional[str] = None) -> tuple[typing.Union[bool, 'User'], str]:
         SIGNIN_POSSIBLE_AFTER_MAIL_VERIFICATION = flask.current_app.config.get(
             'SIGNIN_POSSIBLE_AFTER_MAIL_VERIFICATION')
 
+        # Reject addresses that failed too many times before querying DB or verifying password.
+        if login_throttle.is_ip_blocked(ip_addr):
+            return False, 'TOO_MANY_LOGIN_FAIL_ON_IP'
+
         user_ident = utils.normalize(user_ident.strip())
         pw = utils.normalize(pw.strip())
         # We won't support UUID login,
@@ -141,6 +150,7 @@ class User(db_module.DefaultModelMixin, db.Model):
 
         self = db.session.query(User).filter(login_type == user_ident).first()
         if not self:
+            login_throttle.record_login_fail(None, ip_addr)
             return False, 'ACCOUNT_NOT_FOUND'
 
         # If login isn't successful, record failed try
@@ -155,24 +165,30 @@ class User(db_module.DefaultModelMixin, db.Model):
             reason = 'EMAIL_NOT_VERIFIED'
 
         if reason:
-            if reason == 'WRONG_PASSWORD':
-                self.login_fail_count += 1
-                self.login_fail_date = db.func.now()
-
-                if self.login_fail_count >= 5:
-                    self.locked_at = db.func.now()
-                    self.why_locked = 'TOO_MUCH_LOGIN_FAIL'
-                    reason = 'ACCOUNT_LOCKED::TOO_MUCH_LOGIN_FAIL'
-                else:
-                    reason += f'::{5 - self.login_fail_count}'
+            if reason != 'WRONG_PASSWORD':
+                return False, reason
+
+            # Failures are counted on redis, and DB is written only when the account gets locked,
+            # so that attacks with wrong passwords don't become writes on TB_USER.
+            login_fail_limit = login_throttle.get_window_config('ACCOUNT')[0]
+            login_fail_count = login_throttle.record_login_fail(self.uuid, ip_addr)
+            if login_fail_count < login_fail_limit:
+                return False, f'{reason}::{login_fail_limit - login_fail_count}'
+
+            self.login_fail_count = login_fail_count
+            self.login_fail_date = db.func.now()
+            self.locked_at = db.func.now()
+            self.why_locked = 'TOO_MUCH_LOGIN_FAIL'
             try:
                 db.session.commit()
-                return False, reason
+                login_throttle.clear_login_fail(self.uuid)
+                return False, 'ACCOUNT_LOCKED::TOO_MUCH_LOGIN_FAIL'
             except Exception:
                 db.session.rollback()
                 return False, 'DB_ERROR'
 
         # If password is correct and account is not locked, process login.
+        login_throttle.clear_login_fail(self.uuid)
         self.last_login_date = db.func.now()
         self.login_fail_count = 0
         try:
@@ -220,7 +236,7 @@ class EmailToken(db_module.DefaultModelMixin, db.Model):
 
     action = db.Column(db.Enum(EmailTokenAction), nullable=False)
     token = db.Column(db.String, unique=True, nullable=False)
-    expired_at = db.Column(db.DateTime, nullable=False)
+    expired_at = db.Column(db.DateTime, nullable=False, index=True)
 
     @classmethod
     def query_using_token(cls, email_token: str) -> typing.Optional['EmailToken']:
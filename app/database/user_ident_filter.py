@@ -0,0 +1,89 @@
+import itertools
+import typing
+
+import redis
+
+import app.database as db_module
+
+db = db_module.db
+RedisKeyType = db_module.RedisKeyType
+
+# Values of these columns of TB_USER are kept on redis sets, as lowercase(the columns are case-insensitive).
+# A value that is not on the set is definitely not in use, so availability checks can skip the DB query.
+# Values on the set may not be in use anymore, so those must be checked on DB.
+USER_IDENT_FIELDS: tuple[str, ...] = ('id', 'nickname', 'email')
+# Sets are used only after warm-up is done, as values that are not on the set must not be in use.
+USER_IDENT_READY_KEY = RedisKeyType.USER_IDENT_USED.as_redis_key('__ready__')
+USER_IDENT_WARMUP_BATCH_SIZE = 1000
+
+
+def get_redis_key(field_name: str) -> str:
+    return RedisKeyType.USER_IDENT_USED.as_redis_key(field_name)
+
+
+def add_values(values: dict[str, typing.Optional[str]]):
+    # Call this after new values are committed, like signup or rename.
+    redis_db: redis.StrictRedis = db_module.redis_db
+    with redis_db.pipeline(transaction=False) as pipe:
+        for field_name, value in values.items():
+            if field_name in USER_IDENT_FIELDS and value:
+                pipe.sadd(get_redis_key(field_name), value.lower())
+        pipe.execute()
+
+
+def remove_values(values: dict[str, typing.Optional[str]]):
+    # Call this after old values are released and committed, like rename.
+    redis_db: redis.StrictRedis = db_module.redis_db
+    with redis_db.pipeline(transaction=False) as pipe:
+        for field_name, value in values.items():
+            if field_name in USER_IDENT_FIELDS and value:
+                pipe.srem(get_redis_key(field_name), value.lower())
+        pipe.execute()
+
+
+def get_possibly_used_fields(values: dict[str, str]) -> list[str]:
+    '''
+    Returns field names whose values may be in use, in a single round trip.
+    Only the returned fields need to be checked on DB.
+    All fields are returned when the sets are not warmed up yet.
+    '''
+    target_fields = [k for k in values if k in USER_IDENT_FIELDS]
+    if not target_fields:
+        return list()
+
+    redis_db: redis.StrictRedis = db_module.redis_db
+    with redis_db.pipeline(transaction=False) as pipe:
+        pipe.exists(USER_IDENT_READY_KEY)
+        for field_name in target_fields:
+            pipe.sismember(get_redis_key(field_name), str(values[field_name]).lower())
+        is_ready, *is_members = pipe.execute()
+
+    if not is_ready:
+        return target_fields
+    return [field_name for field_name, is_member in zip(target_fields, is_members) if is_member]
+
+
+def warm_up(force: bool = False):
+    '''
+    Adds all values of TB_USER on the sets, and marks the sets as ready.
+    Values are only added and never replaced, so values of concurrent signups are not lost.
+    '''
+    redis_db: redis.StrictRedis = db_module.redis_db
+    if not force and redis_db.exists(USER_IDENT_READY_KEY):
+        return
+
+    # On python, all imports will be cached, so it's OK to import in method.
+    import app.database.user as user_module
+
+    query_result = iter(
+        db.session.query(user_module.User.id, user_module.User.nickname, user_module.User.email)
+        .yield_per(USER_IDENT_WARMUP_BATCH_SIZE))
+    while user_rows := list(itertools.islice(query_result, USER_IDENT_WARMUP_BATCH_SIZE)):
+        with redis_db.pipeline(transaction=False) as pipe:
+            for field_index, field_name in enumerate(USER_IDENT_FIELDS):
+                field_values = [row[field_index].lower() for row in user_rows if row[field_index]]
+                if field_values:
+                    pipe.sadd(get_redis_key(field_name), *field_values)
+            pipe.execute()
+
+    redis_db.set(USER_IDENT_READY_KEY, 'ready')
@@ -24,5 +24,9 @@ def init_app(app: flask.Flask):
         default_limits=['3 per second'],
         storage_uri=limiter_storage_url)
 
+    # Register B.Ca related plugins
+    import app.plugin.bca as bca_plugin
+    runable_app = bca_plugin.init_app(runable_app)
+
     # init_app must return app
     return runable_app
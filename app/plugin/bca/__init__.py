@@ -0,0 +1,14 @@
+import flask
+
+
+def init_app(app: flask.Flask):
+    import app.plugin.bca.cli_tools as bca_cli_tools
+
+    app.cli.add_command(bca_cli_tools.userdb_shard_resize)
+    app.cli.add_command(bca_cli_tools.userdb_shard_rebalance_finish)
+    app.cli.add_command(bca_cli_tools.userdb_consistency_check)
+    app.cli.add_command(bca_cli_tools.userdb_migrate)
+    app.cli.add_command(bca_cli_tools.maintenance_run)
+
+    # init_app must return app
+    return app
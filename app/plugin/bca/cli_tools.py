@@ -0,0 +1,82 @@
+import click
+import flask
+import flask.cli
+
+import app.plugin.bca.user_db.consistency as user_db_consistency
+import app.plugin.bca.user_db.maintenance as user_db_maintenance
+import app.plugin.bca.user_db.migration as user_db_migration
+import app.plugin.bca.user_db.shard_router as shard_router
+
+
+@click.command('userdb-shard-resize')
+@click.argument('shard_count', type=int)
+@flask.cli.with_appcontext
+def userdb_shard_resize(shard_count: int):
+    try:
+        current_shard_count, previous_shard_count = shard_router.get_shard_config(force_reload=True)
+        if previous_shard_count:
+            print(f'Rebalance from {previous_shard_count} shards is not finished yet.\n'
+                  'Run `flask userdb-shard-rebalance-finish` first.')
+            return
+
+        moved_ratio = shard_router.get_moved_ratio(current_shard_count, shard_count)
+        shard_router.resize_shard(shard_count)
+        print(f'Shard count changed from {current_shard_count} to {shard_count} '
+              f'(about {moved_ratio:.1%} of users will be moved).\n'
+              'Keep the workers of previous shards running until their queues are drained, '
+              'and then run `flask userdb-shard-rebalance-finish`.')
+    except Exception:
+        print('Error raised while resizing user db shards')
+
+
+@click.command('userdb-shard-rebalance-finish')
+@flask.cli.with_appcontext
+def userdb_shard_rebalance_finish():
+    try:
+        shard_router.finish_rebalance()
+        print('Successfully finished user db shard rebalance')
+    except Exception:
+        print('Error raised while finishing user db shard rebalance')
+
+
+@click.command('userdb-consistency-check')
+@click.option('--user-id', type=int, default=None, help='Check only this user. All users are checked if not given.')
+@click.option('--repair', is_flag=True, default=False, help='Apply missing, stale and extra rows.')
+@flask.cli.with_appcontext
+def userdb_consistency_check(user_id: int, repair: bool):
+    try:
+        if user_id is not None:
+            user_db_consistency.add_check_user_db_task_to_queue(user_id, repair)
+            print(f'Consistency check of user {user_id} is enqueued')
+        else:
+            user_db_consistency.check_all_user_db_task.delay(repair)
+            print('Consistency check of all users is enqueued. '
+                  f'{user_db_consistency.USER_DB_CONSISTENCY_BATCH_SIZE} users will be enqueued '
+                  f'every {user_db_consistency.USER_DB_CONSISTENCY_BATCH_INTERVAL} seconds.')
+        print('Results will be printed on the worker log.')
+    except Exception:
+        print('Error raised while enqueueing user db consistency check')
+
+
+@click.command('userdb-migrate')
+@flask.cli.with_appcontext
+def userdb_migrate():
+    try:
+        user_db_migration.migrate_all_user_db_task.delay()
+        print(f'Migration of all user dbs to version {user_db_migration.USER_DB_SCHEMA_VERSION} is enqueued. '
+              f'{user_db_migration.USER_DB_MIGRATION_BATCH_SIZE} users will be migrated '
+              f'every {user_db_migration.USER_DB_MIGRATION_BATCH_INTERVAL} seconds.')
+    except Exception:
+        print('Error raised while enqueueing user db migration')
+
+
+@click.command('maintenance-run')
+@flask.cli.with_appcontext
+def maintenance_run():
+    try:
+        user_db_maintenance.run_maintenance_task.delay()
+        print(f'Maintenance of {", ".join(user_db_maintenance.MAINTENANCE_TARGETS)} is enqueued. '
+              f'{user_db_maintenance.MAINTENANCE_BATCH_SIZE} rows will be deleted '
+              f'every {user_db_maintenance.MAINTENANCE_BATCH_INTERVAL} seconds.')
+    except Exception:
+        print('Error raised while enqueueing maintenance')
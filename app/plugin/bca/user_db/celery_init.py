@@ -1,7 +1,9 @@
 import celery
 import os
+import redis
 
 internal_celery_app: celery.Celery = None
+internal_redis_conn: redis.StrictRedis = None
 
 
 def init_celery_app():
@@ -23,8 +25,27 @@ def init_celery_app():
         internal_celery_app.conf.task_ignore_result = True
 
         import app.plugin.bca.user_db.journal_handler as journal_handler  # noqa
+        import app.plugin.bca.user_db.consistency as consistency  # noqa
+        import app.plugin.bca.user_db.migration as migration  # noqa
+        import app.plugin.bca.user_db.maintenance as maintenance  # noqa
+        import app.plugin.bca.user_db.onboarding as onboarding  # noqa
 
     return internal_celery_app
 
 
+def get_redis_connection() -> redis.StrictRedis:
+    # We'll get redis informations from os.environ because celery worker won't initialize flask app.
+    # redis-py's connection pool detects fork by itself, so it's safe to share this on the module level.
+    global internal_redis_conn
+
+    if internal_redis_conn is None:
+        internal_redis_conn = redis.StrictRedis(
+            host=os.environ.get('REDIS_HOST'),
+            port=int(os.environ.get('REDIS_PORT')),
+            password=os.environ.get('REDIS_PASSWORD'),
+            db=int(os.environ.get('REDIS_DB', 0)))
+
+    return internal_redis_conn
+
+
 init_celery_app()
@@ -0,0 +1,123 @@
+import collections
+import contextlib
+import os
+import pathlib as pt
+import sqlite3
+import typing
+
+import app.plugin.bca.user_db.file_io as user_db_file_io
+
+# Maximum number of user db connections that a worker process keeps opened.
+USER_DB_CONNECTION_CACHE_SIZE = int(os.environ.get('USER_DB_CONNECTION_CACHE_SIZE', 64))
+
+
+class UserDBConnectionCacheEntry:
+    user_id: int
+    pathobj: pt.Path
+    file_id: tuple[int, int]
+    conn: sqlite3.Connection
+
+    def __init__(self, user_id: int, pathobj: pt.Path):
+        self.user_id = user_id
+        self.pathobj = pathobj
+        self.file_id = self.get_file_id(pathobj)
+        self.conn = sqlite3.connect(pathobj)
+        user_db_file_io.apply_user_db_pragmas(self.conn)
+        # The last connection of a WAL database checkpoints and removes the -wal file by its path on close,
+        # so a connection to a replaced file could write to or remove the -wal of the new file.
+        # Writers already checkpoint the file after every write, so we don't need the checkpoint on close.
+        # (Connection.setconfig is available on python 3.12 or later)
+        if hasattr(self.conn, 'setconfig'):
+            self.conn.setconfig(sqlite3.SQLITE_DBCONFIG_NO_CKPT_ON_CLOSE, True)
+
+    @staticmethod
+    def get_file_id(pathobj: pt.Path) -> tuple[int, int]:
+        # Sync db files are replaced (unlink and create) on rebuild, not overwritten,
+        # so the inode tells us whether the file we opened is still the file on that path.
+        # This raises FileNotFoundError when the file is removed.
+        file_stat = pathobj.stat()
+        return (file_stat.st_dev, file_stat.st_ino)
+
+    def is_valid(self, pathobj: pt.Path) -> bool:
+        try:
+            return self.pathobj == pathobj and self.file_id == self.get_file_id(pathobj)
+        except FileNotFoundError:
+            return False
+
+    def close(self):
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+
+class UserDBConnectionCache:
+    '''
+    Bounded LRU of opened user db connections in a worker process.
+    Users who receive journals frequently can skip all connection setup costs.
+    '''
+    max_size: int
+    entries: collections.OrderedDict[int, UserDBConnectionCacheEntry]
+
+    def __init__(self, max_size: int = USER_DB_CONNECTION_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+
+    def get(self, user_id: int, pathobj: pt.Path) -> sqlite3.Connection:
+        entry = self.entries.get(user_id, None)
+        if entry is not None:
+            if entry.is_valid(pathobj):
+                self.entries.move_to_end(user_id)
+                return entry.conn
+
+            # File is replaced or removed after we opened it.
+            self.invalidate(user_id)
+
+        if not pathobj.exists():
+            raise FileNotFoundError()
+
+        entry = UserDBConnectionCacheEntry(user_id, pathobj)
+        self.entries[user_id] = entry
+        while len(self.entries) > self.max_size:
+            _, evicted_entry = self.entries.popitem(last=False)
+            evicted_entry.close()
+
+        return entry.conn
+
+    def invalidate(self, user_id: int):
+        entry = self.entries.pop(user_id, None)
+        if entry is not None:
+            entry.close()
+
+    def clear(self):
+        while self.entries:
+            _, entry = self.entries.popitem()
+            entry.close()
+
+
+user_db_connection_cache = UserDBConnectionCache()
+
+
+@contextlib.contextmanager
+def open_user_db(target_file: user_db_file_io.BCaSyncFile) -> typing.Generator[sqlite3.Connection, None, None]:
+    '''
+    Yields a sqlite3 connection of target_file.
+    Files on local storage will be cached, but files downloaded from S3 are temporary files,
+    so we open and close those every time.
+    '''
+    if target_file.s3_bucket_name:
+        conn = sqlite3.connect(target_file.pathobj)
+        user_db_file_io.apply_user_db_pragmas(conn)
+        try:
+            yield conn
+        finally:
+            conn.close()
+        return
+
+    conn = user_db_connection_cache.get(target_file.user_id, target_file.pathobj)
+    try:
+        yield conn
+    except sqlite3.DatabaseError:
+        # Connection may be broken, don't reuse it.
+        user_db_connection_cache.invalidate(target_file.user_id)
+        raise
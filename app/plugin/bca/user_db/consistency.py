@@ -0,0 +1,155 @@
+import os
+import typing
+
+import redis_lock
+
+import app.common.utils as utils
+import app.common.firebase_notify as firebase_notify
+import app.plugin.bca.user_db.connection_cache as connection_cache
+import app.plugin.bca.user_db.file_io as user_db_file_io
+import app.plugin.bca.user_db.shard_router as shard_router
+import app.plugin.bca.user_db.table_statement as user_db_table_statement
+import app.plugin.bca.user_db.temp_service_db as temp_service_db
+from app.plugin.bca.user_db.celery_init import internal_celery_app, get_redis_connection
+
+# Consistency check tasks of each user are throttled by this Celery rate limit (per worker),
+# and users are enqueued in batches of USER_DB_CONSISTENCY_BATCH_SIZE,
+# with USER_DB_CONSISTENCY_BATCH_INTERVAL seconds between batches.
+USER_DB_CONSISTENCY_RATE_LIMIT = os.environ.get('USER_DB_CONSISTENCY_RATE_LIMIT', '10/s')
+USER_DB_CONSISTENCY_BATCH_SIZE = int(os.environ.get('USER_DB_CONSISTENCY_BATCH_SIZE', 100))
+USER_DB_CONSISTENCY_BATCH_INTERVAL = int(os.environ.get('USER_DB_CONSISTENCY_BATCH_INTERVAL', 10))
+
+# Rows must be inserted in this order and deleted in the reverse order to avoid FK error.
+USER_DB_TABLE_ORDER: tuple[str] = ('TB_PROFILE', 'TB_CARD', 'TB_PROFILE_RELATION', 'TB_CARD_SUBSCRIPTION', )
+
+
+class UserDBConsistencyReport:
+    user_id: int
+    # These are keyed by table name, and contain row uuids.
+    missing: dict[str, list[int]]  # Rows that are on service db, but not on user db
+    stale: dict[str, list[int]]  # Rows that have different commit_id
+    extra: dict[str, list[int]]  # Rows that are on user db, but must not be on user db
+    repaired: bool = False
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.missing = dict()
+        self.stale = dict()
+        self.extra = dict()
+
+    @property
+    def is_consistent(self) -> bool:
+        return not any((*self.missing.values(), *self.stale.values(), *self.extra.values()))
+
+    def to_dict(self) -> dict[str, typing.Any]:
+        return {
+            'user_id': self.user_id,
+            'is_consistent': self.is_consistent,
+            'repaired': self.repaired,
+            'missing': {k: len(v) for k, v in self.missing.items() if v},
+            'stale': {k: len(v) for k, v in self.stale.items() if v},
+            'extra': {k: len(v) for k, v in self.extra.items() if v},
+        }
+
+
+def check_user_db(user_id: int, repair: bool = False) -> UserDBConsistencyReport:
+    '''
+    Compares user db with service db using commit_id of each row,
+    and if repair is True, applies only missing, stale and extra rows.
+    This is much cheaper than rebuilding the whole user db.
+    '''
+    report = UserDBConsistencyReport(user_id)
+
+    redis_conn = get_redis_connection()
+    with redis_lock.Lock(redis_conn, user_db_file_io.SYNC_DB_ID_KEY(user_id)):
+        try:
+            target_file = user_db_file_io.BCaSyncFile.load(user_id)
+        except FileNotFoundError:
+            # User db will be created with the latest data when it's needed, so there's nothing to check.
+            return report
+
+        service_db_records = temp_service_db.get_service_db_connection().get_user_db_records(user_id)
+
+        with connection_cache.open_user_db(target_file) as user_db_conn:
+            expected_rows: dict[str, dict[int, typing.Any]] = dict()
+            for tablename in USER_DB_TABLE_ORDER:
+                expected_rows[tablename] = {row.uuid: row for row in service_db_records[tablename]}
+                actual_commit_ids: dict[int, str] = dict(
+                    user_db_conn.execute(f'SELECT uuid, commit_id FROM "{tablename}"').fetchall())
+
+                report.missing[tablename] = [
+                    row_uuid for row_uuid in expected_rows[tablename]
+                    if row_uuid not in actual_commit_ids]
+                report.stale[tablename] = [
+                    row_uuid for row_uuid, row in expected_rows[tablename].items()
+                    if row_uuid in actual_commit_ids and actual_commit_ids[row_uuid] != row.commit_id]
+                report.extra[tablename] = [
+                    row_uuid for row_uuid in actual_commit_ids
+                    if row_uuid not in expected_rows[tablename]]
+
+            if not repair or report.is_consistent:
+                return report
+
+            with user_db_conn:
+                for tablename in USER_DB_TABLE_ORDER:
+                    table_statement = user_db_table_statement.USER_DB_TABLE_STATEMENTS[tablename]
+                    for row_uuid in (*report.missing[tablename], *report.stale[tablename]):
+                        row = expected_rows[tablename][row_uuid]
+                        table_statement.upsert(
+                            user_db_conn, row_uuid,
+                            {column: getattr(row, column) for column in table_statement.column_names})
+
+                for tablename in reversed(USER_DB_TABLE_ORDER):
+                    table_statement = user_db_table_statement.USER_DB_TABLE_STATEMENTS[tablename]
+                    for row_uuid in report.extra[tablename]:
+                        table_statement.delete(user_db_conn, row_uuid)
+
+            user_db_file_io.checkpoint_user_db(user_db_conn)
+
+        if target_file.s3_bucket_name:
+            target_file.upload_to_s3()
+        user_db_file_io.mark_sync_db_changed(user_id, [
+            tablename for tablename in USER_DB_TABLE_ORDER
+            if report.missing[tablename] or report.stale[tablename] or report.extra[tablename]])
+        report.repaired = True
+
+    # User db is changed, send push to user so that clients can sync it.
+    try:
+        target_fcm_tokens = temp_service_db.get_service_db_connection().get_user_fcm_tokens(user_id)
+        firebase_notify.firebase_send_notify(
+            data={'resource': 'dbsync_event', 'etag': target_file.get_hash(), },
+            target_tokens=target_fcm_tokens)
+    except Exception as push_err:
+        # Just log this as warning and ignore this error, as it's not a important part.
+        print(utils.get_traceback_msg(push_err))
+
+    return report
+
+
+@internal_celery_app.task(rate_limit=USER_DB_CONSISTENCY_RATE_LIMIT)
+def check_user_db_task(user_id: int, repair: bool = False):
+    report = check_user_db(user_id, repair)
+    if not report.is_consistent:
+        print(report.to_dict())
+
+
+def add_check_user_db_task_to_queue(user_id: int, repair: bool = False):
+    # Send this task to the user's shard queue, so that this never runs concurrently with the user's journals.
+    target_queue = shard_router.route(user_id)
+    if target_queue:
+        check_user_db_task.apply_async(args=(user_id, repair), queue=target_queue)
+    else:
+        check_user_db_task.delay(user_id, repair)
+
+
+@internal_celery_app.task()
+def check_all_user_db_task(repair: bool = False, after_user_id: int = 0):
+    user_ids = temp_service_db.get_service_db_connection().get_user_ids(after_user_id, USER_DB_CONSISTENCY_BATCH_SIZE)
+    for user_id in user_ids:
+        add_check_user_db_task_to_queue(user_id, repair)
+
+    # Enqueue the next batch later, so that the queue is not flooded with check tasks.
+    if len(user_ids) >= USER_DB_CONSISTENCY_BATCH_SIZE:
+        check_all_user_db_task.apply_async(
+            args=(repair, user_ids[-1]),
+            countdown=USER_DB_CONSISTENCY_BATCH_INTERVAL)
@@ -1,7 +1,11 @@
 import base64
 import enum
+import gzip
+import hashlib
+import io
 import os
 import pathlib as pt
+import secrets
 import sqlalchemy as sql
 import sqlalchemy.ext.declarative as sqldec
 import sqlalchemy.orm as sqlorm
@@ -9,6 +13,8 @@ import sqlite3
 import tempfile
 import typing
 
+import redis_lock
+
 import app.common.utils as utils
 import app.plugin.bca.user_db.table_def as user_db_table
 
@@ -16,6 +22,265 @@ SYNC_DB_BASE_DIR = pt.Path.cwd() / 'user_content' / 'bca_sync'
 SYNC_DB_BASE_KEY = 'user_content/bca_sync/{user_id}/sync_db.sqlite'
 SYNC_DB_ID_PATH = lambda user_id: SYNC_DB_BASE_DIR / str(user_id) / 'sync_db.sqlite'  # noqa
 SYNC_DB_ID_KEY = lambda user_id: SYNC_DB_BASE_KEY.format(user_id=user_id)  # noqa
+SYNC_DB_TASK_SET_KEY = lambda user_id: SYNC_DB_ID_KEY(user_id) + ':TASK_SETS'  # noqa
+SYNC_DB_APPLIED_TASK_SET_KEY = lambda user_id: SYNC_DB_ID_KEY(user_id) + ':APPLIED_TASKS'  # noqa
+SYNC_DB_TABLE_VERSION_KEY = lambda user_id: SYNC_DB_ID_KEY(user_id) + ':TABLE_VERSIONS'  # noqa
+# User id will be published on this channel when the user db is changed. (See sync_cache)
+SYNC_DB_UPDATED_CHANNEL = 'SYNC_DB_UPDATED'
+SYNC_DB_TABLES: tuple[str] = ('TB_PROFILE', 'TB_PROFILE_RELATION', 'TB_CARD', 'TB_CARD_SUBSCRIPTION', )
+
+# User sync dbs use WAL journaling, so that readers don't block the writer and vice versa.
+# page_size can be changed only before the first table is created.
+# Negative cache_size means KiB, not the number of pages.
+USER_DB_PAGE_SIZE = int(os.environ.get('USER_DB_PAGE_SIZE', 4096))
+USER_DB_CACHE_SIZE = int(os.environ.get('USER_DB_CACHE_SIZE', -2048))
+USER_DB_BUSY_TIMEOUT = int(os.environ.get('USER_DB_BUSY_TIMEOUT', 5000))
+
+# When this is 'true', precompressed copies of the user db (sync artifacts) are written next to the db file
+# whenever the user db is changed, and API servers send those as is instead of encoding the db on every request.
+# Artifacts are available only on local storage mode.
+SYNC_DB_ARTIFACT_ENABLE = os.environ.get('SYNC_DB_ARTIFACT_ENABLE', False) == 'true'
+SYNC_DB_ARTIFACT_GZIP_LEVEL = int(os.environ.get('SYNC_DB_ARTIFACT_GZIP_LEVEL', 9))
+SYNC_DB_ARTIFACT_ZSTD_LEVEL = int(os.environ.get('SYNC_DB_ARTIFACT_ZSTD_LEVEL', 10))
+# Content-Encoding and file extension of each artifact, in order of preference.
+# zstd artifacts are written only when zstandard package is installed.
+SYNC_DB_ARTIFACT_EXTENSIONS: dict[str, str] = {'zstd': 'zst', 'gzip': 'gz', }
+SYNC_DB_ARTIFACT_PATH = lambda user_id, encoding: SYNC_DB_ID_PATH(user_id).with_name(  # noqa
+    f'sync_db.sqlite.{SYNC_DB_ARTIFACT_EXTENSIONS[encoding]}')
+# Files that SQLite makes next to the user db on WAL mode.
+SYNC_DB_SIDECAR_SUFFIXES: tuple[str, ...] = ('-wal', '-shm')
+# Clients can get the user db as a raw sqlite file (not as base64 on JSON) with this mimetype on Accept header.
+SYNC_DB_MIMETYPE = 'application/vnd.sqlite3'
+# Hash of the user db that the artifacts are made from. This is written after all artifacts are written.
+SYNC_DB_ARTIFACT_HASH_PATH = lambda user_id: SYNC_DB_ID_PATH(user_id).with_name('sync_db.sqlite.md5')  # noqa
+
+
+def apply_user_db_pragmas(conn: sqlite3.Connection):
+    conn.execute(f'PRAGMA busy_timeout = {USER_DB_BUSY_TIMEOUT}')
+    conn.execute('PRAGMA journal_mode = WAL')
+    # On WAL mode, synchronous=NORMAL is still safe from corruption,
+    # and fsync is done only on checkpoint, not on every commit.
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA cache_size = {USER_DB_CACHE_SIZE}')
+
+
+def checkpoint_user_db(conn: sqlite3.Connection):
+    # Move all changes on -wal file to the db file, and truncate -wal file.
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+
+def checkpoint_user_db_file(pathobj: pt.Path):
+    # We don't need to open the db when there's no pending changes on -wal file.
+    wal_pathobj = pathobj.with_name(pathobj.name + '-wal')
+    if not wal_pathobj.exists() or not wal_pathobj.stat().st_size:
+        return
+
+    conn = sqlite3.connect(pathobj)
+    try:
+        conn.execute(f'PRAGMA busy_timeout = {USER_DB_BUSY_TIMEOUT}')
+        checkpoint_user_db(conn)
+    finally:
+        conn.close()
+
+
+def read_user_db_bytes(pathobj: pt.Path) -> bytes:
+    '''
+    Returns the content of the user db as a single self-contained SQLite file.
+    Clients cannot get our -wal file, so we need to checkpoint it first,
+    and also need to mark the file as a rollback journal mode file.
+    '''
+    checkpoint_user_db_file(pathobj)
+
+    # Byte 18 and 19 of SQLite header are file format write/read version, and those are 2 on WAL mode.
+    # Setting those to 1 makes the file a legacy(rollback journal) file,
+    # so clients can open it without -wal and -shm files.
+    file_bytes = bytearray(pathobj.read_bytes())
+    if file_bytes[18:20] == b'\x02\x02':
+        file_bytes[18:20] = b'\x01\x01'
+    return bytes(file_bytes)
+
+
+def get_sync_db_artifact_encoders() -> dict[str, typing.Callable[[bytes], bytes]]:
+    encoders: dict[str, typing.Callable[[bytes], bytes]] = dict()
+    try:
+        # On python, all imports will be cached, so it's OK to import in method.
+        import zstandard
+        encoders['zstd'] = zstandard.ZstdCompressor(level=SYNC_DB_ARTIFACT_ZSTD_LEVEL).compress
+    except ImportError:
+        pass
+
+    # mtime is fixed, so that the same user db always makes the same artifact.
+    encoders['gzip'] = lambda z: gzip.compress(z, compresslevel=SYNC_DB_ARTIFACT_GZIP_LEVEL, mtime=0)
+    return encoders
+
+
+def write_file_atomic(pathobj: pt.Path, data: bytes):
+    # Readers must not see a partially written file, so write a temp file on the same directory and rename it.
+    with tempfile.NamedTemporaryFile('wb', dir=pathobj.parent, prefix=pathobj.name + '.', delete=False) as fp:
+        fp.write(data)
+    try:
+        os.replace(fp.name, pathobj)
+    except Exception as err:
+        pt.Path(fp.name).unlink(missing_ok=True)
+        raise err
+
+
+def remove_sync_db_artifacts(user_id: int):
+    # Remove hash file first, so that API servers stop using the artifacts before those are removed.
+    SYNC_DB_ARTIFACT_HASH_PATH(user_id).unlink(missing_ok=True)
+    for encoding in SYNC_DB_ARTIFACT_EXTENSIONS:
+        SYNC_DB_ARTIFACT_PATH(user_id, encoding).unlink(missing_ok=True)
+
+
+def lock_user_db(user_id: int) -> redis_lock.Lock:
+    # Lock of the user db file. Every code that writes or replaces the user db must hold this.
+    # We cannot import this on the top of module, as celery_init imports this module while initializing.
+    import app.plugin.bca.user_db.celery_init as celery_init
+    return redis_lock.Lock(celery_init.get_redis_connection(), SYNC_DB_ID_KEY(user_id))
+
+
+def remove_user_db_file(user_id: int, pathobj: pt.Path):
+    '''
+    Removes the user db file with its WAL sidecar files(-wal, -shm), and caller must hold the user db lock.
+    A leftover -wal can be replayed into a new file on the same path,
+    and connections to the removed file share the sidecar paths with the new file,
+    so the cached connection of this process is closed first, and the sidecars are removed with the file.
+    (Connections cached on other processes never touch the sidecars on close, see connection_cache)
+    '''
+    # On python, all imports will be cached, so it's OK to import in method.
+    # We cannot import this on the top of module, as connection_cache imports this module.
+    import app.plugin.bca.user_db.connection_cache as connection_cache
+    connection_cache.user_db_connection_cache.invalidate(user_id)
+
+    remove_sync_db_artifacts(user_id)
+    pathobj.unlink(missing_ok=True)
+    for sidecar_suffix in SYNC_DB_SIDECAR_SUFFIXES:
+        pathobj.with_name(pathobj.name + sidecar_suffix).unlink(missing_ok=True)
+
+
+def write_sync_db_artifacts(user_id: int) -> typing.Optional[str]:
+    '''
+    Writes precompressed copies of the user db next to the db file, and returns the hash of the user db.
+    Compression is done once per user db version here (mostly on the worker), not on every download.
+    '''
+    if not SYNC_DB_ARTIFACT_ENABLE or BCaSyncFile.s3_bucket_name:
+        return None
+
+    pathobj = SYNC_DB_ID_PATH(user_id)
+    if not pathobj.exists():
+        remove_sync_db_artifacts(user_id)
+        return None
+
+    db_bytes = read_user_db_bytes(pathobj)
+    db_hash = hashlib.md5(db_bytes).hexdigest()
+
+    try:
+        # Artifacts and the hash file cannot be replaced at once,
+        # so remove the old hash file first to prevent pairing the old hash with the new artifacts.
+        SYNC_DB_ARTIFACT_HASH_PATH(user_id).unlink(missing_ok=True)
+        encoders = get_sync_db_artifact_encoders()
+        for encoding in SYNC_DB_ARTIFACT_EXTENSIONS:
+            if encoding in encoders:
+                write_file_atomic(SYNC_DB_ARTIFACT_PATH(user_id, encoding), encoders[encoding](db_bytes))
+            else:
+                # Don't leave an artifact of the older user db.
+                SYNC_DB_ARTIFACT_PATH(user_id, encoding).unlink(missing_ok=True)
+        write_file_atomic(SYNC_DB_ARTIFACT_HASH_PATH(user_id), db_hash.encode())
+    except Exception as err:
+        # API servers will encode the user db by themselves without artifacts.
+        remove_sync_db_artifacts(user_id)
+        raise err
+
+    return db_hash
+
+
+def read_sync_db_artifact(
+        user_id: int,
+        accept_encodings: typing.Container[str]) -> typing.Optional[tuple[str, str, bytes]]:
+    '''
+    Returns (hash, encoding, artifact bytes) of the most preferred artifact that client accepts,
+    or None if there's no usable artifact. Caller must fall back to the user db itself on None.
+    '''
+    if not SYNC_DB_ARTIFACT_ENABLE or BCaSyncFile.s3_bucket_name:
+        return None
+
+    hash_pathobj = SYNC_DB_ARTIFACT_HASH_PATH(user_id)
+    try:
+        hash_stat = hash_pathobj.stat()
+        db_stat = SYNC_DB_ID_PATH(user_id).stat()
+        # Artifacts are stale if the user db is changed after the artifacts are written,
+        # like when the worker failed after applying journals.
+        wal_pathobj = SYNC_DB_ID_PATH(user_id).with_name('sync_db.sqlite-wal')
+        if db_stat.st_mtime_ns > hash_stat.st_mtime_ns or (wal_pathobj.exists() and wal_pathobj.stat().st_size):
+            return None
+
+        db_hash = hash_pathobj.read_text()
+        for encoding in SYNC_DB_ARTIFACT_EXTENSIONS:
+            if encoding not in accept_encodings:
+                continue
+
+            artifact_pathobj = SYNC_DB_ARTIFACT_PATH(user_id, encoding)
+            if not artifact_pathobj.exists():
+                continue
+
+            artifact_bytes = artifact_pathobj.read_bytes()
+            # Check that artifacts are not replaced while we were reading those.
+            if hash_pathobj.read_text() != db_hash:
+                return None
+            return db_hash, encoding, artifact_bytes
+    except FileNotFoundError:
+        return None
+
+    return None
+
+
+def mark_sync_db_changed(user_id: int, tablenames: typing.Iterable[str] = SYNC_DB_TABLES) -> dict[str, str]:
+    '''
+    Changes the versions of the given tables of the user db, and notifies API servers that the user db is changed.
+    Sync artifacts of the user db are also rewritten here.
+    This must be called after the user db is changed (and uploaded),
+    so that clients can refresh only the changed tables, and API servers can drop the cached user db.
+    '''
+    # On python, all imports will be cached, so it's OK to import in method.
+    # We cannot import this on the top of module, as celery_init imports this module while initializing.
+    import app.plugin.bca.user_db.celery_init as celery_init
+
+    # Artifacts must be ready before API servers drop the cached user db.
+    try:
+        write_sync_db_artifacts(user_id)
+    except Exception as err:
+        # Just log this, as API servers can send the user db without artifacts.
+        print(utils.get_traceback_msg(err))
+
+    table_versions = {tablename: secrets.token_hex(8) for tablename in tablenames}
+    with celery_init.get_redis_connection().pipeline(transaction=False) as pipe:
+        if table_versions:
+            pipe.hset(SYNC_DB_TABLE_VERSION_KEY(user_id), mapping=table_versions)
+        pipe.publish(SYNC_DB_UPDATED_CHANNEL, str(user_id))
+        pipe.execute()
+    return table_versions
+
+
+def get_table_versions(user_id: int, tablenames: typing.Iterable[str] = SYNC_DB_TABLES) -> dict[str, str]:
+    import app.plugin.bca.user_db.celery_init as celery_init
+    redis_conn = celery_init.get_redis_connection()
+
+    tablenames = tuple(tablenames)
+    table_versions = dict(zip(
+        tablenames,
+        redis_conn.hmget(SYNC_DB_TABLE_VERSION_KEY(user_id), tablenames)))
+
+    # Version can be lost when redis is flushed. Set a new version in that case,
+    # and a client that has any version of this table will refresh the table.
+    lost_tablenames = [k for k, v in table_versions.items() if v is None]
+    if lost_tablenames:
+        with redis_conn.pipeline() as pipe:
+            for tablename in lost_tablenames:
+                pipe.hsetnx(SYNC_DB_TABLE_VERSION_KEY(user_id), tablename, secrets.token_hex(8))
+            pipe.hmget(SYNC_DB_TABLE_VERSION_KEY(user_id), lost_tablenames)
+            table_versions.update(zip(lost_tablenames, pipe.execute()[-1]))
+
+    return {k: v.decode() if isinstance(v, bytes) else v for k, v in table_versions.items()}
 
 
 class BCaSyncFile:
@@ -23,6 +288,8 @@ class BCaSyncFile:
     pathobj: pt.Path
 
     temp_file: tempfile._TemporaryFileWrapper
+    # True if the schema of this file is upgraded while loading.
+    is_migrated: bool = False
     s3_bucket_name: str = os.environ.get('AWS_S3_BUCKET_NAME', None)
     s3_region_name: str = os.environ.get('AWS_REGION', None)
 
@@ -31,10 +298,14 @@ class BCaSyncFile:
                user_id: int,
                insert_all_data_from_global_db: bool = False,
                delete_if_available: bool = False):
-        return cls.create_s3(user_id, insert_all_data_from_global_db, delete_if_available)\
+        self = cls.create_s3(user_id, insert_all_data_from_global_db, delete_if_available)\
             if BCaSyncFile.s3_bucket_name\
             else cls.create_fs(user_id, insert_all_data_from_global_db, delete_if_available)
 
+        # Whole db is recreated, so all tables are changed.
+        mark_sync_db_changed(user_id)
+        return self
+
     @classmethod
     def create_fs(cls,
                   user_id: int,
@@ -47,8 +318,9 @@ class BCaSyncFile:
         # Check if the file is exist, and if it's exist, then remove it.
         # This won't override `delete_if_available`
         # as local storage can cause exception when there's a file while creating file.
+        # Caller must hold the user db lock, as this replaces the file. (See lock_user_db)
         self.pathobj.parent.mkdir(parents=True, exist_ok=True)
-        self.pathobj.unlink(missing_ok=True)
+        remove_user_db_file(user_id, self.pathobj)
         self.pathobj.open('wb').close()  # Create permanent file
 
         self.apply_sync_table(insert_all_data_from_global_db)
@@ -74,16 +346,37 @@ class BCaSyncFile:
         # On python, all imports will be cached, so it's OK to import in method.
         import boto3
 
-        with self.pathobj.open('wb') as fp:
-            s3 = boto3.client('s3', region_name=BCaSyncFile.s3_region_name)
-            bucket = s3.Bucket(BCaSyncFile.s3_bucket_name)
-            bucket.upload_fileobj(fp, SYNC_DB_ID_KEY(user_id))
+        s3 = boto3.client('s3', region_name=BCaSyncFile.s3_region_name)
+        bucket = s3.Bucket(BCaSyncFile.s3_bucket_name)
+        bucket.upload_fileobj(io.BytesIO(self.read_bytes()), SYNC_DB_ID_KEY(user_id))
 
         return self
 
+    @classmethod
+    def load_or_create(cls, user_id: int):
+        try:
+            return cls.load(user_id)
+        except FileNotFoundError:
+            pass
+
+        # Creating a file replaces it, so this must be done while holding the user db lock,
+        # and another process may have created it while we were waiting for the lock.
+        with lock_user_db(user_id):
+            try:
+                return cls.load(user_id)
+            except FileNotFoundError:
+                return cls.create(user_id, True, True)
+
     @classmethod
     def load(cls, user_id: int):
-        return cls.load_s3(user_id) if BCaSyncFile.s3_bucket_name else cls.load_fs(user_id)
+        self = cls.load_s3(user_id) if BCaSyncFile.s3_bucket_name else cls.load_fs(user_id)
+
+        # Upgrade the schema if this file is created with the older table_def.
+        self.is_migrated = self.migrate()
+        if self.is_migrated:
+            mark_sync_db_changed(user_id)
+
+        return self
 
     @classmethod
     def load_fs(cls, user_id: int):
@@ -142,9 +435,15 @@ class BCaSyncFile:
                 print('user_id will be ignored as BCaSyncFile object has own user_id')
             target_file = SYNC_DB_ID_PATH(self_or_cls.user_id)
 
+        # On python, all imports will be cached, so it's OK to import in method.
+        # We cannot import this on the top of module, as migration module imports this module.
+        import app.plugin.bca.user_db.migration as user_db_migration
+
         if not target_file.exists():
             BCaSyncFile.create_fs(user_id, True, True)
-        return utils.file_md5(target_file)
+        elif user_db_migration.migrate_user_db_file(target_file):
+            mark_sync_db_changed(user_id)
+        return utils.fileobj_md5(io.BytesIO(read_user_db_bytes(target_file)))
 
     @utils.class_or_instancemethod
     def get_hash_s3(self_or_cls, user_id: typing.Optional[int] = None) -> str:
@@ -176,7 +475,7 @@ class BCaSyncFile:
             # then we need to calculate hash from temp file as we have a copy of the file on temp file.
             if not self_or_cls.pathobj.exists():
                 raise FileNotFoundError()
-            return utils.file_md5(self_or_cls.pathobj)
+            return utils.fileobj_md5(io.BytesIO(self_or_cls.read_bytes()))
 
     @utils.class_or_instancemethod
     def delete(cls, user_id: typing.Optional[int] = None):
@@ -187,11 +486,11 @@ class BCaSyncFile:
         if isinstance(self_or_cls, type):  # classmethod call
             if user_id is None:
                 raise ValueError('user_id must not be None when delete_fs method is called as classmethod')
-            SYNC_DB_ID_PATH(user_id).unlink(missing_ok=True)
+            remove_user_db_file(user_id, SYNC_DB_ID_PATH(user_id))
         else:  # instancemethod call
             if user_id is not None:
                 print('user_id will be ignored as BCaSyncFile object has own user_id')
-            self_or_cls.pathobj.unlink(missing_ok=True)
+            remove_user_db_file(self_or_cls.user_id, self_or_cls.pathobj)
 
     @utils.class_or_instancemethod
     def delete_s3(self_or_cls, user_id: typing.Optional[int] = None):
@@ -222,21 +521,63 @@ class BCaSyncFile:
         s3 = boto3.client('s3', region_name=self.s3_region_name)
         bucket = s3.Bucket(self.s3_bucket_name)
 
-        with self.pathobj.open('rb') as fp:
-            bucket.upload_fileobj(fp, SYNC_DB_ID_KEY(self.user_id))
+        bucket.upload_fileobj(io.BytesIO(self.read_bytes()), SYNC_DB_ID_KEY(self.user_id))
+
+    def migrate(self) -> bool:
+        import app.plugin.bca.user_db.migration as user_db_migration
+        return user_db_migration.migrate_user_db_file(self.pathobj)
+
+    def read_bytes(self) -> bytes:
+        if not self.pathobj.exists():
+            raise FileNotFoundError()
+
+        return read_user_db_bytes(self.pathobj)
 
     def as_b64urlsafe(self) -> str:
+        return base64.b64encode(self.read_bytes()).decode()
+
+    def read_tables(self, tablenames: typing.Iterable[str]) -> dict[str, dict[str, list]]:
+        '''
+        Returns columns and rows of the given tables.
+        Values are the same as stored on the db file, so clients can insert those on their db file as is.
+        '''
         if not self.pathobj.exists():
             raise FileNotFoundError()
 
-        return base64.b64encode(self.pathobj.read_bytes()).decode()
+        result: dict[str, dict[str, list]] = dict()
+        conn = sqlite3.connect(f'{self.pathobj.resolve().as_uri()}?mode=ro', uri=True)
+        try:
+            conn.execute(f'PRAGMA busy_timeout = {USER_DB_BUSY_TIMEOUT}')
+            # Read all tables in a single read transaction, so that these are consistent with each other.
+            with conn:
+                conn.execute('BEGIN')
+                for tablename in tablenames:
+                    if tablename not in SYNC_DB_TABLES:
+                        raise ValueError(f'{tablename} is not a sync table')
+
+                    cursor = conn.execute(f'SELECT * FROM "{tablename}"')
+                    result[tablename] = {
+                        'columns': [z[0] for z in cursor.description],
+                        'rows': cursor.fetchall(),
+                    }
+        finally:
+            conn.close()
+
+        return result
 
     def apply_sync_table(self, insert_all_data_from_global_db: bool = False):
         '''
         This opens file and creates B.Ca sync tables,
         and insert sync data from global db if `insert_all_data_from_global_db` is true.
         '''
+        import app.plugin.bca.user_db.migration as user_db_migration
+
         temp_user_db_sqlite_conn = sqlite3.connect(self.pathobj)
+        # page_size must be set before creating tables and enabling WAL mode.
+        temp_user_db_sqlite_conn.execute(f'PRAGMA page_size = {USER_DB_PAGE_SIZE}')
+        apply_user_db_pragmas(temp_user_db_sqlite_conn)
+        # Tables are created from the latest table_def, so we don't need to migrate this.
+        temp_user_db_sqlite_conn.execute(f'PRAGMA user_version = {user_db_migration.USER_DB_SCHEMA_VERSION}')
         temp_user_db_engine = sql.create_engine('sqlite://', creator=lambda: temp_user_db_sqlite_conn)
         temp_user_db_session = sqlorm.scoped_session(
                                     sqlorm.sessionmaker(
@@ -352,4 +693,6 @@ class BCaSyncFile:
                     temp_user_db_session.add(new_row)
 
             temp_user_db_session.commit()
-            temp_user_db_engine.dispose()  # Disconnect all connections (for safety)
+
+        checkpoint_user_db(temp_user_db_sqlite_conn)
+        temp_user_db_engine.dispose()  # Disconnect all connections (for safety)
@@ -1,3 +1,4 @@
+import celery
 import datetime
 import enum
 import flask_sqlalchemy as fsql
@@ -7,19 +8,19 @@ import sqlite3
 import typing
 import uuid
 
-import redis
 import redis_lock
 import sqlalchemy as sql
-import sqlalchemy.ext.declarative as sqldec
-import sqlalchemy.orm as sqlorm
 
 import app.common.utils as utils
 import app.common.firebase_notify as firebase_notify
 import app.plugin.bca.user_db.table_def as user_db_table
 import app.plugin.bca.user_db.file_io as user_db_file_io
-import app.plugin.bca.user_db.table_def as user_db_table_def
+import app.plugin.bca.user_db.table_statement as user_db_table_statement
+import app.plugin.bca.user_db.connection_cache as connection_cache
+import app.plugin.bca.user_db.consistency as user_db_consistency
 import app.plugin.bca.user_db.temp_service_db as temp_service_db
-from app.plugin.bca.user_db.celery_init import internal_celery_app
+import app.plugin.bca.user_db.shard_router as shard_router
+from app.plugin.bca.user_db.celery_init import internal_celery_app, get_redis_connection
 
 USER_DB_JOURNAL_DATA_DICT_TYPE = typing.TypedDict('USER_DB_MODIFY_DATA_DICT_TYPE', {
     'tablename': str,
@@ -46,7 +47,27 @@ USER_DB_JOURNAL_DICT_TYPE = typing.TypedDict('USER_DB_JOURNAL_DICT_TYPE', {
     'db_owner_id': int,
     'changelog': USER_DB_JOURNAL_CHANGELOG_DICT_TYPE
 })
+USER_DB_JOURNAL_ROW_IDENTITY_DICT_TYPE = typing.TypedDict('USER_DB_JOURNAL_ROW_IDENTITY_DICT_TYPE', {
+    'tablename': str,
+    'uuid': int,
+    'action': typing.Literal['add', 'modify', 'delete'],
+    'hints': dict[str, typing.Any]
+})
 USER_DB_TASK_SET_EXPIRE_TIMEDELTA = datetime.timedelta(minutes=10)
+# Applied task ids are kept for this seconds, so that redelivered or retried journals can be skipped.
+USER_DB_APPLIED_TASK_EXPIRE_TIMEDELTA = datetime.timedelta(
+    seconds=int(os.environ.get('USER_DB_APPLIED_TASK_TTL', 86400)))
+
+# When this is 'true', UserDBJournalCreator captures only identities of the changed rows in the request,
+# and fan-out and journal creation are done on the worker.
+USER_DB_JOURNAL_ASYNC = os.environ.get('USER_DB_JOURNAL_ASYNC', False) == 'true'
+# Columns that we need to find db owners of a row, even after the row is deleted from service db.
+USER_DB_JOURNAL_OWNER_HINT_COLUMNS: dict[str, tuple[str]] = {
+    'TB_PROFILE': ('user_id', ),
+    'TB_PROFILE_RELATION': ('from_user_id', 'to_profile_id', ),
+    'TB_CARD': ('user_id', ),
+    'TB_CARD_SUBSCRIPTION': ('subscribed_user_id', 'card_id', 'card_profile_id', ),
+}
 
 
 class UserDBJournalActionCase(utils.EnumAutoName):
@@ -55,6 +76,41 @@ class UserDBJournalActionCase(utils.EnumAutoName):
     delete = enum.auto()
 
 
+# We need to handle changelog this order to avoid FK error
+# 1. profile insertion/modification
+#    - TB_PROFILE, UserDBJournalActionCase.(add | modify)
+# 2. card insertion
+#    - TB_CARD, UserDBJournalActionCase.(add | modify)
+# 3. profile relation insertion/deletion/modification
+#    - TB_PROFILE_RELATION, UserDBJournalActionCase.(add | modify | delete)
+# 4. card subscription insertion/deletion/modification
+#    - TB_CARD_SUBSCRIPTION, UserDBJournalActionCase.(add | modify | delete)
+# 5. profile deletion
+#    - TB_PROFILE, UserDBJournalActionCase.(delete)
+# 6. card deletion
+#    - TB_CARD, UserDBJournalActionCase.(delete)
+USER_DB_JOURNAL_TASK_ORDER: list[tuple[str, tuple[UserDBJournalActionCase]]] = [
+    ('TB_PROFILE', (
+        UserDBJournalActionCase.add,
+        UserDBJournalActionCase.modify, )),
+    ('TB_CARD', (
+        UserDBJournalActionCase.add,
+        UserDBJournalActionCase.modify, )),
+    ('TB_PROFILE_RELATION', (
+        UserDBJournalActionCase.add,
+        UserDBJournalActionCase.modify,
+        UserDBJournalActionCase.delete, )),
+    ('TB_CARD_SUBSCRIPTION', (
+        UserDBJournalActionCase.add,
+        UserDBJournalActionCase.modify,
+        UserDBJournalActionCase.delete, )),
+    ('TB_PROFILE', (
+        UserDBJournalActionCase.delete, )),
+    ('TB_CARD', (
+        UserDBJournalActionCase.delete, )),
+]
+
+
 class UserDBJournalChangelogData:
     tablename: str
     uuid: int
@@ -72,26 +128,15 @@ class UserDBJournalChangelogData:
 
         return self
 
-    def apply(self, session: sqlorm.scoped_session, tables: dict[str, sqldec.DeclarativeMeta]):
-        table_cls = tables[self.tablename]
-        target_table_row: table_cls = None
+    def apply(self, conn: sqlite3.Connection):
+        table_statement = user_db_table_statement.USER_DB_TABLE_STATEMENTS[self.tablename]
 
-        if self.action == UserDBJournalActionCase.add:
-            target_table_row = table_cls()
-            session.add(target_table_row)
-        elif self.action == UserDBJournalActionCase.modify:
-            target_table_row = session.query(table_cls).filter(table_cls.uuid == self.uuid).first()
+        # Add and modify are applied as upsert, and deleting a non-existent row does nothing,
+        # so applying the same change twice is always safe.
+        if self.action in (UserDBJournalActionCase.add, UserDBJournalActionCase.modify):
+            table_statement.upsert(conn, self.uuid, self.column_data_map)
         elif self.action == UserDBJournalActionCase.delete:
-            session.query(table_cls).filter(table_cls.uuid == self.uuid).delete(synchronize_session='fetch')
-            session.commit()
-            return
-        else:
-            return
-
-        for k, v in self.column_data_map.items():
-            setattr(target_table_row, k, v)
-
-        session.commit()
+            table_statement.delete(conn, self.uuid)
 
 
 class UserDBJournal:
@@ -122,6 +167,16 @@ class UserDBJournal:
 
         return self
 
+    @classmethod
+    def create(cls, db_owner_id: int):
+        self = cls()
+        current_time = int(datetime.datetime.now().replace(tzinfo=utils.UTC).timestamp())
+        self.task_id = f'{current_time}-{uuid.uuid4()}'
+        self.is_retry = False
+        self.db_owner_id = db_owner_id
+        self.changes = list()
+        return self
+
     @classmethod
     def from_json(cls, json_str: str) -> list['UserDBJournal']:
         json_data: typing.Union[list[dict], dict] = json.loads(json_str)
@@ -163,18 +218,98 @@ class UserDBJournal:
         }
 
     def add_to_queue(self):
-        task_job_data = json.dumps(self.to_dict(), default=utils.json_default, ensure_ascii=False)
+        UserDBJournal.add_all_to_queue([self, ])
+
+    @staticmethod
+    def add_all_to_queue(journals: list['UserDBJournal']):
+        '''
+        Publishes all journals at once.
+        Task sets are updated in a single redis pipeline, and tasks are sent as a single Celery group,
+        so publishing journals of many users doesn't need a round trip per user.
+        '''
+        if not journals:
+            return
+
+        task_job_data_list: list[str] = [
+            json.dumps(journal.to_dict(), default=utils.json_default, ensure_ascii=False)
+            for journal in journals]
 
         AWS_TASK_SQS_URL = os.environ.get('AWS_TASK_SQS_URL', None)
+
+        # Target queues must be resolved before registering task ids below.
+        # During a rebalance, the shard router keeps a moved user on the previous shard while the user has
+        # pending tasks, so it would always see the journal's own task and never move the user.
+        # Queue is resolved once per user, so that all journals of a user in this batch go to the same queue.
+        target_queues: dict[int, typing.Optional[str]] = dict()
+        if not AWS_TASK_SQS_URL:
+            target_queues = {
+                db_owner_id: shard_router.route(db_owner_id)
+                for db_owner_id in dict.fromkeys(journal.db_owner_id for journal in journals)}
+
+        # Register task ids on the users' task sets before publishing,
+        # so that the shard router and the push notifier can see these tasks as pending.
+        # We need to set expire time to prevent these sets left forever,
+        # so we update exp time everytime when we add a new task id.
+        redis_conn = get_redis_connection()
+        with redis_conn.pipeline(transaction=False) as pipe:
+            for journal in journals:
+                user_db_task_set_key = user_db_file_io.SYNC_DB_TASK_SET_KEY(journal.db_owner_id)
+                pipe.sadd(user_db_task_set_key, journal.task_id)
+                pipe.expire(user_db_task_set_key, USER_DB_TASK_SET_EXPIRE_TIMEDELTA)
+            pipe.execute()
+
         if AWS_TASK_SQS_URL:
             import boto3
             sqs_client = boto3.client('sqs')
-            sqs_client.send_message(
-                QueueUrl=AWS_TASK_SQS_URL,
-                MessageBody=task_job_data,
-                MessageGroupId='userdbmod1')
+            failed_journals: list['UserDBJournal'] = list()
+            # SQS accepts up to 10 messages per batch request.
+            for chunk_start in range(0, len(task_job_data_list), 10):
+                entries = [{
+                    'Id': str(index),
+                    'MessageBody': task_job_data,
+                    'MessageGroupId': 'userdbmod1',
+                } for index, task_job_data in enumerate(task_job_data_list[chunk_start:chunk_start + 10])]
+                response = sqs_client.send_message_batch(QueueUrl=AWS_TASK_SQS_URL, Entries=entries)
+
+                # SQS may accept only some entries of a batch, and those are not retried by boto3,
+                # so resend the failed entries once with their original ids.
+                if response.get('Failed', None):
+                    failed_ids = {z['Id'] for z in response['Failed']}
+                    response = sqs_client.send_message_batch(
+                        QueueUrl=AWS_TASK_SQS_URL,
+                        Entries=[z for z in entries if z['Id'] in failed_ids])
+
+                if response.get('Failed', None):
+                    failed_reasons = ', '.join(
+                        f'{z["Id"]}: {z.get("Code", "")} {z.get("Message", "")}' for z in response['Failed'])
+                    print(f'Failed to send {len(response["Failed"])} journals to SQS ({failed_reasons})')
+                    failed_journals += [journals[chunk_start + int(z['Id'])] for z in response['Failed']]
+
+            if failed_journals:
+                # This runs after the service db transaction is committed, so we must not fail the request here.
+                # Changes of the failed journals are already on the service db,
+                # so the consistency check will apply those to the user db instead.
+                with redis_conn.pipeline(transaction=False) as pipe:
+                    for journal in failed_journals:
+                        pipe.srem(user_db_file_io.SYNC_DB_TASK_SET_KEY(journal.db_owner_id), journal.task_id)
+                    pipe.execute()
+
+                for db_owner_id in dict.fromkeys(journal.db_owner_id for journal in failed_journals):
+                    user_db_consistency.add_check_user_db_task_to_queue(db_owner_id, repair=True)
         else:
-            UserDBJournal.run.delay(task_job_data)
+            # If sharded routing is enabled, send all journals of the user to the same queue.
+            task_signatures: list[celery.Signature] = list()
+            for journal, task_job_data in zip(journals, task_job_data_list):
+                task_signature = UserDBJournal.run.si(task_job_data)
+                target_queue = target_queues[journal.db_owner_id]
+                if target_queue:
+                    task_signature = task_signature.set(queue=target_queue)
+                task_signatures.append(task_signature)
+
+            if len(task_signatures) == 1:
+                task_signatures[0].apply_async()
+            else:
+                celery.group(task_signatures).apply_async()
 
     @staticmethod
     @internal_celery_app.task()
@@ -185,119 +320,65 @@ class UserDBJournal:
             # What we should do here is...
             # 1. Wait redis lock and acquire
             # 2. Get target DB file from File System or S3
-            # 3. Create SQLAlchemy ORM object
-            # 4. Re-Order tasks
-            # 5. Apply those tasks
-            # 6. Save or Upload it
-            # 7. Check if there's another pending tasks,
+            # 3. Re-Order tasks
+            # 4. Apply those tasks on a cached sqlite connection
+            # 5. Save or Upload it
+            # 6. Check if there's another pending tasks,
             #    and if there's no pending tasks to this user, then send push to target user.
             # Now, Let's do this
 
             # Wait redis lock and acquire.
-            # We'll get redis informations from os.environ because celery worker won't initialize flask app.
-            redis_conn = redis.StrictRedis(
-                host=os.environ.get('REDIS_HOST'),
-                port=int(os.environ.get('REDIS_PORT')),
-                password=os.environ.get('REDIS_PASSWORD'),
-                db=int(os.environ.get('REDIS_DB')))
+            # When sharded routing is enabled, only one worker consumes this user's journals,
+            # so this lock will be almost always acquired immediately.
+            redis_conn = get_redis_connection()
             user_db_key = user_db_file_io.SYNC_DB_ID_KEY(self.db_owner_id)
-            user_db_task_set_key = user_db_key + ':TASK_SETS'
-            # It's OK to append task id on the redis set without lock.
-            # But, don't forget to update expire time!
-            # We need to set expire time to prevent this set left forever,
-            # so we need to set newly created sets, and update exp time everytime when we add a new task id.
-            redis_conn.sadd(user_db_task_set_key, self.task_id)
-            redis_conn.expire(user_db_task_set_key, USER_DB_TASK_SET_EXPIRE_TIMEDELTA)
+            user_db_task_set_key = user_db_file_io.SYNC_DB_TASK_SET_KEY(self.db_owner_id)
+            user_db_applied_task_set_key = user_db_file_io.SYNC_DB_APPLIED_TASK_SET_KEY(self.db_owner_id)
+            # Task id is already registered on the task set when this journal was published. (See add_all_to_queue)
 
             with redis_lock.Lock(redis_conn, user_db_key):
                 try:
+                    # Celery can deliver the same task more than once, and failed tasks are re-enqueued.
+                    # Skip this journal if it's already applied.
+                    if redis_conn.sismember(user_db_applied_task_set_key, self.task_id):
+                        redis_conn.srem(user_db_task_set_key, self.task_id)
+                        continue
+
                     # Get target DB file from File System or S3.
                     # If file is not found, then go to exception handler and create a DB file.
                     target_file: user_db_file_io.BCaSyncFile = None
                     try:
                         target_file = user_db_file_io.BCaSyncFile.load(self.db_owner_id)
 
-                        # Create SQLAlchemy ORM object
-                        user_db_orm_sqlite_conn = sqlite3.connect(target_file.pathobj)
-                        user_db_orm_engine = sql.create_engine('sqlite://', creator=lambda: user_db_orm_sqlite_conn)
-                        user_db_orm_session = sqlorm.scoped_session(
-                                                    sqlorm.sessionmaker(
-                                                        autocommit=False,
-                                                        autoflush=False,
-                                                        bind=user_db_orm_engine))
-                        user_db_orm_base = sqldec.declarative_base()
-                        user_db_orm_tables = {
-                            'TB_PROFILE': type(
-                                'ProfileTable', (user_db_orm_base, user_db_table_def.Profile), {}),
-                            'TB_PROFILE_RELATION': type(
-                                'ProfileRelationTable', (user_db_orm_base, user_db_table_def.ProfileRelation), {}),
-                            'TB_CARD': type(
-                                'CardTable', (user_db_orm_base, user_db_table_def.Card), {}),
-                            'TB_CARD_SUBSCRIPTION': type(
-                                'CardSubscriptionTable', (user_db_orm_base, user_db_table_def.CardSubscription), {})
-                        }
-
                         # Re-Order tasks
-                        # We need to handle changelog this order to avoid FK error
-                        # 1. profile insertion/modification
-                        #    - TB_PROFILE, UserDBJournalActionCase.(add | modify)
-                        # 2. card insertion
-                        #    - TB_CARD, UserDBJournalActionCase.(add | modify)
-                        # 3. profile relation insertion/deletion/modification
-                        #    - TB_PROFILE_RELATION, UserDBJournalActionCase.(add | modify | delete)
-                        # 4. card subscription insertion/deletion/modification
-                        #    - TB_CARD_SUBSCRIPTION, UserDBJournalActionCase.(add | modify | delete)
-                        # 5. profile deletion
-                        #    - TB_PROFILE, UserDBJournalActionCase.(delete)
-                        # 6. card deletion
-                        #    - TB_CARD, UserDBJournalActionCase.(delete)
-                        # Let's order it.
-                        TASK_ORDER: list[tuple[str, tuple[UserDBJournalActionCase]]] = [
-                            ('TB_PROFILE', (
-                                UserDBJournalActionCase.add,
-                                UserDBJournalActionCase.modify, )),
-                            ('TB_CARD', (
-                                UserDBJournalActionCase.add,
-                                UserDBJournalActionCase.modify, )),
-                            ('TB_PROFILE_RELATION', (
-                                UserDBJournalActionCase.add,
-                                UserDBJournalActionCase.modify,
-                                UserDBJournalActionCase.delete, )),
-                            ('TB_CARD_SUBSCRIPTION', (
-                                UserDBJournalActionCase.add,
-                                UserDBJournalActionCase.modify,
-                                UserDBJournalActionCase.delete, )),
-                            ('TB_PROFILE', (
-                                UserDBJournalActionCase.delete, )),
-                            ('TB_CARD', (
-                                UserDBJournalActionCase.delete, )),
-                        ]
-
                         ordered_tasks: list[UserDBJournalChangelogData] = list()
-                        for task_order_type in TASK_ORDER:
-                            task_order_type_tb_name = task_order_type[0]
-                            task_order_type_action = task_order_type[1]
-                            target_tb_changelog = [
+                        for task_order_tb_name, task_order_action in USER_DB_JOURNAL_TASK_ORDER:
+                            ordered_tasks += [
                                 mtm for mtm in self.changes
-                                if mtm.tablename == task_order_type_tb_name
-                                and mtm.action in task_order_type_action]
-                            ordered_tasks += target_tb_changelog
+                                if mtm.tablename == task_order_tb_name
+                                and mtm.action in task_order_action]
 
                         # OK, now task is ordered, let's apply it.
-                        for ordered_task in ordered_tasks:
-                            ordered_task.apply(user_db_orm_session, user_db_orm_tables)
+                        # Connection of this user's DB is reused between tasks (see connection_cache),
+                        # and all changes of this journal are committed at once.
+                        with connection_cache.open_user_db(target_file) as user_db_conn:
+                            with user_db_conn:
+                                for ordered_task in ordered_tasks:
+                                    ordered_task.apply(user_db_conn)
 
-                        # Clean up the changes on DB and disconnect it.
-                        user_db_orm_session.commit()
-                        user_db_orm_engine.dispose()
+                            # Flush WAL to the db file, so that API servers can serve the latest file.
+                            user_db_file_io.checkpoint_user_db(user_db_conn)
+                        changed_tablenames = {ordered_task.tablename for ordered_task in ordered_tasks}
 
                     except FileNotFoundError:
                         # As user sync db file is not found, We need to create a new User DB file.
                         # As we created and pulled all latest data from service db,
                         # we don't need to do some additional journal jobs.
+                        connection_cache.user_db_connection_cache.invalidate(self.db_owner_id)
                         target_file = user_db_file_io.BCaSyncFile.create(self.db_owner_id, False, True)
-                        temp_service_db.TemporaryServiceDBConnection()\
+                        temp_service_db.get_service_db_connection()\
                             .insert_user_db_record(self.db_owner_id, target_file)
+                        changed_tablenames = user_db_file_io.SYNC_DB_TABLES
 
                     # Save or upload it.
                     # If the file is on a local storage, then changes will be applied automatically,
@@ -305,15 +386,23 @@ class UserDBJournal:
                     if target_file.s3_bucket_name:
                         target_file.upload_to_s3()
 
-                    # Task complete, check if there's another pending tasks,
+                    # Update versions of the changed tables, so that clients can refresh only those tables.
+                    user_db_file_io.mark_sync_db_changed(self.db_owner_id, changed_tablenames)
+
+                    # Task complete, mark this task as applied only after the changes are committed and uploaded,
+                    # then check if there's another pending tasks,
                     # and if there's no pending tasks to this user, then send push to target user.
                     # Notes: If the set is empty on redis, then redis will remove that set entity,
                     #        so if we delete the last item on set, then redis will remove that set entity.
-                    redis_conn.srem(user_db_task_set_key, self.task_id)
+                    with redis_conn.pipeline() as pipe:
+                        pipe.sadd(user_db_applied_task_set_key, self.task_id)
+                        pipe.expire(user_db_applied_task_set_key, USER_DB_APPLIED_TASK_EXPIRE_TIMEDELTA)
+                        pipe.srem(user_db_task_set_key, self.task_id)
+                        pipe.execute()
                     if not redis_conn.exists(user_db_task_set_key):
                         # There's no pending tasks! Send push to user!
                         try:
-                            target_fcm_tokens = temp_service_db.TemporaryServiceDBConnection()\
+                            target_fcm_tokens = temp_service_db.get_service_db_connection()\
                                 .get_user_fcm_tokens(self.db_owner_id)
                             print(target_fcm_tokens)
                             firebase_notify.firebase_send_notify(
@@ -352,9 +441,165 @@ class UserDBJournalCreator:
         self.session_deleted = [r for r in db.session.deleted]
 
     def __exit__(self, ex_type, ex_value, ex_traceback):
+        if USER_DB_JOURNAL_ASYNC:
+            # Don't publish anything if commit failed.
+            if ex_type is not None:
+                return
+
+            row_identities = self.get_row_identities()
+            if row_identities:
+                UserDBJournalCreator.run.delay(json.dumps(row_identities, default=utils.json_default))
+            return
+
         taskmsg = self.get_journal_from_rowlist()
-        for k, v in taskmsg.items():
-            v.add_to_queue()
+        UserDBJournal.add_all_to_queue(list(taskmsg.values()))
+
+    def get_row_identities(self) -> list[USER_DB_JOURNAL_ROW_IDENTITY_DICT_TYPE]:
+        '''
+        Returns the minimal identities of the changed rows.
+        This must not make any DB queries, as this is called on the request path.
+        '''
+        result: list[USER_DB_JOURNAL_ROW_IDENTITY_DICT_TYPE] = list()
+        for action, rows in ((UserDBJournalActionCase.add, self.session_added),
+                             (UserDBJournalActionCase.modify, self.session_modified),
+                             (UserDBJournalActionCase.delete, self.session_deleted)):
+            for row in rows:
+                tablename = getattr(row, '__tablename__', None)
+                if tablename not in USER_DB_JOURNAL_OWNER_HINT_COLUMNS:
+                    continue
+
+                # Use the instance state instead of attributes,
+                # as accessing expired attributes after commit triggers a refresh query.
+                row_state = sql.inspect(row)
+                if not row_state.identity:
+                    continue
+
+                result.append({
+                    'tablename': tablename,
+                    'uuid': row_state.identity[0],
+                    'action': action.value,
+                    'hints': {k: row_state.dict[k] for k in USER_DB_JOURNAL_OWNER_HINT_COLUMNS[tablename]
+                              if k in row_state.dict},
+                })
+
+        return result
+
+    @staticmethod
+    def get_journal_from_row_identities(
+            row_identities: list[USER_DB_JOURNAL_ROW_IDENTITY_DICT_TYPE]) -> dict[int, UserDBJournal]:
+        '''
+        Builds journals from the row identities using service db.
+        Added or modified rows are read from service db, so journals always contain the latest data.
+        '''
+        service_db = temp_service_db.get_service_db_connection()
+        session = service_db.session
+        TB_Profile = service_db.tables['Profile']
+        TB_ProfileRelation = service_db.tables['ProfileRelation']
+        TB_Card = service_db.tables['Card']
+        TB_CardSubscription = service_db.tables['CardSubscribed']
+        service_db_tables = {
+            'TB_PROFILE': TB_Profile,
+            'TB_PROFILE_RELATION': TB_ProfileRelation,
+            'TB_CARD': TB_Card,
+            'TB_CARD_SUBSCRIPTION': TB_CardSubscription,
+        }
+
+        modify_journal: dict[int, UserDBJournal] = dict()
+
+        def get_row(tablename: str, row_uuid: int):
+            TableClass = service_db_tables[tablename]
+            return session.query(TableClass).filter(TableClass.uuid == row_uuid).first()
+
+        def get_user_ids(column, condition) -> set[int]:
+            return {z[0] for z in session.query(column).filter(condition).distinct().all()}
+
+        def add_change(db_owner_ids: set[int], tablename: str, row_uuid: int, action: UserDBJournalActionCase, row):
+            db_mod_data = UserDBJournalChangelogData()
+            db_mod_data.tablename = tablename
+            db_mod_data.uuid = row_uuid
+            db_mod_data.action = action.value
+            db_mod_data.column_data_map = dict()
+            if row is not None:
+                for column in user_db_table_statement.USER_DB_TABLE_STATEMENTS[tablename].column_names:
+                    db_mod_data.column_data_map[column] = getattr(row, column)
+
+            for user_id in db_owner_ids:
+                if user_id is None:
+                    continue
+                if user_id not in modify_journal:
+                    modify_journal[user_id] = UserDBJournal.create(user_id)
+                modify_journal[user_id].changes.append(db_mod_data)
+
+        try:
+            for row_identity in row_identities:
+                tablename = row_identity['tablename']
+                row_uuid = row_identity['uuid']
+                action = UserDBJournalActionCase(row_identity['action'])
+                hints = row_identity['hints']
+
+                row = None
+                if action != UserDBJournalActionCase.delete:
+                    row = get_row(tablename, row_uuid)
+                    if row is None:
+                        # This row is deleted after the commit, and the delete journal will handle this.
+                        continue
+                    hints = {k: getattr(row, k) for k in USER_DB_JOURNAL_OWNER_HINT_COLUMNS[tablename]}
+
+                if tablename == 'TB_PROFILE':
+                    # Profile is on the owner's db, followers' db, and the db of users who subscribed its cards.
+                    db_owner_ids = {hints.get('user_id', None), }
+                    if action != UserDBJournalActionCase.add:
+                        db_owner_ids |= get_user_ids(
+                            TB_ProfileRelation.from_user_id, TB_ProfileRelation.to_profile_id == row_uuid)
+                        db_owner_ids |= get_user_ids(
+                            TB_CardSubscription.subscribed_user_id, TB_CardSubscription.card_profile_id == row_uuid)
+                    add_change(db_owner_ids, tablename, row_uuid, action, row)
+
+                elif tablename == 'TB_CARD':
+                    # Card is on the owner's db and the subscribers' db.
+                    db_owner_ids = {hints.get('user_id', None), }
+                    if action != UserDBJournalActionCase.add:
+                        db_owner_ids |= get_user_ids(
+                            TB_CardSubscription.subscribed_user_id, TB_CardSubscription.card_id == row_uuid)
+                    add_change(db_owner_ids, tablename, row_uuid, action, row)
+
+                elif tablename == 'TB_PROFILE_RELATION':
+                    # Profile relation is only on the follower's db,
+                    # and the followed profile must be added to the follower's db too.
+                    db_owner_ids = {hints.get('from_user_id', None), }
+                    if action == UserDBJournalActionCase.add and hints.get('to_profile_id', None):
+                        to_profile = get_row('TB_PROFILE', hints['to_profile_id'])
+                        if to_profile is not None:
+                            add_change(db_owner_ids, 'TB_PROFILE', to_profile.uuid,
+                                       UserDBJournalActionCase.add, to_profile)
+                    add_change(db_owner_ids, tablename, row_uuid, action, row)
+
+                elif tablename == 'TB_CARD_SUBSCRIPTION':
+                    # Card subscription is only on the subscriber's db,
+                    # and the subscribed card and its profile must be added to the subscriber's db too.
+                    db_owner_ids = {hints.get('subscribed_user_id', None), }
+                    if action == UserDBJournalActionCase.add:
+                        for related_tablename, related_uuid_key in (('TB_PROFILE', 'card_profile_id'),
+                                                                    ('TB_CARD', 'card_id')):
+                            if not hints.get(related_uuid_key, None):
+                                continue
+                            related_row = get_row(related_tablename, hints[related_uuid_key])
+                            if related_row is not None:
+                                add_change(db_owner_ids, related_tablename, related_row.uuid,
+                                           UserDBJournalActionCase.add, related_row)
+                    add_change(db_owner_ids, tablename, row_uuid, action, row)
+        finally:
+            # This connection is shared between tasks, so we need to return the DB connection to the pool.
+            session.remove()
+
+        return modify_journal
+
+    @staticmethod
+    @internal_celery_app.task()
+    def run(json_in: str):
+        row_identities: list[USER_DB_JOURNAL_ROW_IDENTITY_DICT_TYPE] = json.loads(json_in)
+        journals = UserDBJournalCreator.get_journal_from_row_identities(row_identities)
+        UserDBJournal.add_all_to_queue(list(journals.values()))
 
     def get_journal_from_rowlist(self) -> dict[int, UserDBJournal]:
         # Import db_module and profile_module in this method to make this module file as portable as possible.
@@ -0,0 +1,74 @@
+import datetime
+import os
+import typing
+
+import app.common.utils as utils
+import app.plugin.bca.user_db.temp_service_db as temp_service_db
+from app.plugin.bca.user_db.celery_init import internal_celery_app
+
+# Maintenance runs every MAINTENANCE_INTERVAL seconds on celery beat.
+# Each target deletes MAINTENANCE_BATCH_SIZE rows at once,
+# and waits MAINTENANCE_BATCH_INTERVAL seconds before the next batch, so that it never locks hot tables for long.
+MAINTENANCE_INTERVAL = int(os.environ.get('MAINTENANCE_INTERVAL', 3600))
+MAINTENANCE_BATCH_SIZE = int(os.environ.get('MAINTENANCE_BATCH_SIZE', 1000))
+MAINTENANCE_BATCH_INTERVAL = int(os.environ.get('MAINTENANCE_BATCH_INTERVAL', 1))
+# Rows of deleted uploads are kept for this days, as the files are already removed when those are deleted.
+MAINTENANCE_UPLOADED_FILE_RETENTION_DAYS = int(os.environ.get('MAINTENANCE_UPLOADED_FILE_RETENTION_DAYS', 30))
+
+
+class MaintenanceTarget(typing.NamedTuple):
+    table_name: str  # Key of temp_service_db.TemporaryServiceDBConnection.tables
+    primary_key_name: str
+    column_name: str  # Rows that this column is older than the return value of get_before will be deleted.
+    get_before: typing.Callable[[], datetime.datetime]
+
+
+MAINTENANCE_TARGETS: dict[str, MaintenanceTarget] = {
+    'refresh_token': MaintenanceTarget(
+        'RefreshToken', 'jti', 'exp',
+        lambda: datetime.datetime.utcnow()),
+    'email_token': MaintenanceTarget(
+        'EmailToken', 'uuid', 'expired_at',
+        lambda: datetime.datetime.utcnow()),
+    'uploaded_file': MaintenanceTarget(
+        'UploadedFile', 'uuid', 'deleted_at',
+        lambda: datetime.datetime.utcnow() - datetime.timedelta(days=MAINTENANCE_UPLOADED_FILE_RETENTION_DAYS)),
+}
+
+
+@internal_celery_app.task()
+def purge_task(target_name: str, deleted_count: int = 0):
+    target = MAINTENANCE_TARGETS[target_name]
+    try:
+        batch_deleted_count = temp_service_db.get_service_db_connection().delete_rows_before(
+            target.table_name, target.primary_key_name, target.column_name,
+            target.get_before(), MAINTENANCE_BATCH_SIZE)
+    except Exception as err:
+        # Just log this, remaining rows will be deleted on the next maintenance.
+        print(utils.get_traceback_msg(err))
+        return
+
+    deleted_count += batch_deleted_count
+    if batch_deleted_count >= MAINTENANCE_BATCH_SIZE:
+        # Delete the next batch later, so that other transactions can use the table between batches.
+        purge_task.apply_async(
+            args=(target_name, deleted_count),
+            countdown=MAINTENANCE_BATCH_INTERVAL)
+    elif deleted_count:
+        print(f'Maintenance: {deleted_count} rows of {target.table_name} are deleted')
+
+
+@internal_celery_app.task()
+def run_maintenance_task():
+    for target_name in MAINTENANCE_TARGETS:
+        purge_task.delay(target_name)
+
+
+# This is used only when celery beat is running. (ex: `celery -A worker beat`)
+internal_celery_app.conf.beat_schedule = {
+    **internal_celery_app.conf.beat_schedule,
+    'maintenance': {
+        'task': run_maintenance_task.name,
+        'schedule': MAINTENANCE_INTERVAL,
+    },
+}
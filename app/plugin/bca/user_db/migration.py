@@ -0,0 +1,137 @@
+import os
+import pathlib as pt
+import sqlite3
+import typing
+
+import redis_lock
+
+import app.common.utils as utils
+import app.plugin.bca.user_db.file_io as user_db_file_io
+import app.plugin.bca.user_db.temp_service_db as temp_service_db
+from app.plugin.bca.user_db.celery_init import internal_celery_app, get_redis_connection
+
+# Background migrator migrates USER_DB_MIGRATION_BATCH_SIZE users at once,
+# and waits USER_DB_MIGRATION_BATCH_INTERVAL seconds before the next batch.
+USER_DB_MIGRATION_BATCH_SIZE = int(os.environ.get('USER_DB_MIGRATION_BATCH_SIZE', 100))
+USER_DB_MIGRATION_BATCH_INTERVAL = int(os.environ.get('USER_DB_MIGRATION_BATCH_INTERVAL', 10))
+
+# Schema version of user db is stored on `PRAGMA user_version`, which is 4 bytes big-endian integer at offset 60.
+SQLITE_HEADER_USER_VERSION_OFFSET = 60
+
+USER_DB_MIGRATIONS: dict[int, typing.Callable[[sqlite3.Connection], None]] = dict()
+
+
+def register_migration(version: int):
+    '''
+    Registers a function that upgrades user db schema from `version - 1` to `version`.
+    The function will be called in a transaction, so it must not commit by itself.
+    Don't forget to change table_def too, as new user dbs are created from table_def.
+    '''
+    def decorator(func: typing.Callable[[sqlite3.Connection], None]):
+        if version in USER_DB_MIGRATIONS:
+            raise ValueError(f'Migration of user db version {version} is already registered')
+        USER_DB_MIGRATIONS[version] = func
+        return func
+
+    return decorator
+
+
+@register_migration(1)
+def migrate_to_v1(conn: sqlite3.Connection):
+    # User dbs created before schema versioning have the same schema as version 1,
+    # so we just need to stamp the version.
+    pass
+
+
+# Add new migrations above this line.
+# Newly created user dbs will be stamped with this version.
+USER_DB_SCHEMA_VERSION = max(USER_DB_MIGRATIONS)
+
+
+def get_user_version(pathobj: pt.Path) -> int:
+    # Read user_version from the file header directly, so that we don't need to open the db on every access.
+    with pathobj.open('rb') as fp:
+        fp.seek(SQLITE_HEADER_USER_VERSION_OFFSET)
+        user_version_bytes = fp.read(4)
+
+    if len(user_version_bytes) < 4:
+        # Empty file.
+        return 0
+    return int.from_bytes(user_version_bytes, 'big')
+
+
+def migrate_user_db(conn: sqlite3.Connection) -> bool:
+    '''
+    Upgrades user db schema to USER_DB_SCHEMA_VERSION.
+    Returns True if user db is migrated.
+    '''
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= USER_DB_SCHEMA_VERSION:
+        return False
+
+    # Acquire the write lock first, and read version again,
+    # as other process (API server or worker) can migrate this db concurrently.
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        current_version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if current_version >= USER_DB_SCHEMA_VERSION:
+            conn.rollback()
+            return False
+
+        for version in sorted(z for z in USER_DB_MIGRATIONS if z > current_version):
+            USER_DB_MIGRATIONS[version](conn)
+        conn.execute(f'PRAGMA user_version = {USER_DB_SCHEMA_VERSION}')
+        conn.commit()
+    except Exception as err:
+        conn.rollback()
+        raise err
+
+    return True
+
+
+def migrate_user_db_file(pathobj: pt.Path) -> bool:
+    if not pathobj.exists() or get_user_version(pathobj) >= USER_DB_SCHEMA_VERSION:
+        return False
+
+    conn = sqlite3.connect(pathobj)
+    try:
+        user_db_file_io.apply_user_db_pragmas(conn)
+        is_migrated = migrate_user_db(conn)
+
+        # Flush WAL, so that the header of the db file has the new version.
+        user_db_file_io.checkpoint_user_db(conn)
+    finally:
+        conn.close()
+
+    return is_migrated
+
+
+def migrate_user_db_by_id(user_id: int) -> bool:
+    redis_conn = get_redis_connection()
+    with redis_lock.Lock(redis_conn, user_db_file_io.SYNC_DB_ID_KEY(user_id)):
+        try:
+            # User db is migrated while loading.
+            target_file = user_db_file_io.BCaSyncFile.load(user_id)
+        except FileNotFoundError:
+            return False
+
+        if target_file.is_migrated and target_file.s3_bucket_name:
+            target_file.upload_to_s3()
+
+        return target_file.is_migrated
+
+
+@internal_celery_app.task()
+def migrate_all_user_db_task(after_user_id: int = 0):
+    user_ids = temp_service_db.get_service_db_connection().get_user_ids(after_user_id, USER_DB_MIGRATION_BATCH_SIZE)
+    for user_id in user_ids:
+        try:
+            migrate_user_db_by_id(user_id)
+        except Exception as err:
+            # Just log and go to the next user, this user db will be migrated when it's accessed.
+            print(utils.get_traceback_msg(err))
+
+    # Migrate the next batch later, so that the migration doesn't hog workers and storage.
+    if len(user_ids) >= USER_DB_MIGRATION_BATCH_SIZE:
+        migrate_all_user_db_task.apply_async(
+            args=(user_ids[-1], ),
+            countdown=USER_DB_MIGRATION_BATCH_INTERVAL)
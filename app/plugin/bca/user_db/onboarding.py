@@ -0,0 +1,136 @@
+import enum
+import os
+import secrets
+import typing
+
+import redis_lock
+
+import app.common.mailgun as mailgun
+import app.common.utils as utils
+import app.plugin.bca.user_db.consistency as user_db_consistency
+import app.plugin.bca.user_db.file_io as user_db_file_io
+import app.plugin.bca.user_db.shard_router as shard_router
+from app.plugin.bca.user_db.celery_init import internal_celery_app, get_redis_connection
+
+# Side effects of signup (sending confirmation mail and creating user db) are done on the worker,
+# and status of each step is stored on a redis hash, so that clients can check those after signup.
+ONBOARDING_STATUS_KEY = lambda user_id: f'ONBOARDING_STATUS={user_id}'  # noqa
+# Users that need email verification before signing in don't get an access token on signup,
+# so they get a random status token instead, which can be used to check the status and resend the mail.
+ONBOARDING_STATUS_TOKEN_KEY = lambda token: f'ONBOARDING_STATUS_TOKEN={token}'  # noqa
+# Status is kept for this duration(seconds), clients only need this right after signup.
+ONBOARDING_STATUS_EXPIRE = int(os.environ.get('ONBOARDING_STATUS_EXPIRE', 24 * 60 * 60))
+# Failed mails are retried ONBOARDING_MAIL_MAX_RETRIES times with ONBOARDING_MAIL_RETRY_INTERVAL seconds.
+ONBOARDING_MAIL_MAX_RETRIES = int(os.environ.get('ONBOARDING_MAIL_MAX_RETRIES', 3))
+ONBOARDING_MAIL_RETRY_INTERVAL = int(os.environ.get('ONBOARDING_MAIL_RETRY_INTERVAL', 30))
+
+
+class OnboardingStep(utils.EnumAutoName):
+    MAIL = enum.auto()
+    SYNC_DB = enum.auto()
+
+
+class OnboardingStatus(utils.EnumAutoName):
+    PENDING = enum.auto()
+    DONE = enum.auto()
+    FAILED = enum.auto()
+    SKIPPED = enum.auto()
+
+
+def set_onboarding_status(user_id: int, statuses: dict[OnboardingStep, OnboardingStatus]):
+    redis_key = ONBOARDING_STATUS_KEY(user_id)
+    with get_redis_connection().pipeline(transaction=False) as pipe:
+        pipe.hset(redis_key, mapping={k.value: v.value for k, v in statuses.items()})
+        pipe.expire(redis_key, ONBOARDING_STATUS_EXPIRE)
+        pipe.execute()
+
+
+def get_onboarding_status(user_id: int) -> dict[str, str]:
+    # Returns an empty dict when the status is expired or the user signed up before this was introduced.
+    return {
+        k.decode(): v.decode()
+        for k, v in get_redis_connection().hgetall(ONBOARDING_STATUS_KEY(user_id)).items()}
+
+
+def create_status_token(user_id: int) -> str:
+    # Token expires with the status, as there's nothing to check after that.
+    status_token = secrets.token_urlsafe(32)
+    get_redis_connection().set(ONBOARDING_STATUS_TOKEN_KEY(status_token), user_id, ex=ONBOARDING_STATUS_EXPIRE)
+    return status_token
+
+
+def get_user_id_by_status_token(status_token: str) -> typing.Optional[int]:
+    user_id = get_redis_connection().get(ONBOARDING_STATUS_TOKEN_KEY(status_token))
+    return int(user_id) if user_id else None
+
+
+@internal_celery_app.task(bind=True, max_retries=ONBOARDING_MAIL_MAX_RETRIES)
+def send_mail_task(self, user_id: int, fromaddr: str, toaddr: str, subject: str, message: str):
+    # Mail is rendered on the API server, as the worker doesn't have flask app to render templates.
+    try:
+        mailgun.send_mail_with_config(
+            mailgun.get_mail_config_from_env(),
+            fromaddr, toaddr, subject, message, raise_on_fail=True)
+    except Exception as err:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=err, countdown=ONBOARDING_MAIL_RETRY_INTERVAL)
+
+        print(utils.get_traceback_msg(err))
+        set_onboarding_status(user_id, {OnboardingStep.MAIL: OnboardingStatus.FAILED})
+        return
+
+    set_onboarding_status(user_id, {OnboardingStep.MAIL: OnboardingStatus.DONE})
+
+
+@internal_celery_app.task()
+def create_user_db_task(user_id: int):
+    # Worker cannot query the service db using flask app, so create an empty user db
+    # and then fill it using the consistency checker, which reads the service db by itself.
+    try:
+        # Sync route creates the user db on demand, and journal tasks may be using it,
+        # so create it only when it doesn't exist, while holding the user db lock.
+        redis_conn = get_redis_connection()
+        with redis_lock.Lock(redis_conn, user_db_file_io.SYNC_DB_ID_KEY(user_id)):
+            try:
+                user_db_file_io.BCaSyncFile.load(user_id)
+                is_created = False
+            except FileNotFoundError:
+                user_db_file_io.BCaSyncFile.create(user_id, False, True)
+                is_created = True
+
+        # Consistency checker takes the lock by itself, so this must be called after releasing it.
+        if is_created:
+            user_db_consistency.check_user_db(user_id, repair=True)
+    except Exception as err:
+        # User db will be created again when the client requests it on sync route.
+        print(utils.get_traceback_msg(err))
+        set_onboarding_status(user_id, {OnboardingStep.SYNC_DB: OnboardingStatus.FAILED})
+        return
+
+    set_onboarding_status(user_id, {OnboardingStep.SYNC_DB: OnboardingStatus.DONE})
+
+
+def start_onboarding(user_id: int, mail_args: typing.Optional[dict[str, str]] = None):
+    '''
+    Queues signup side effects of the user, and marks those as pending.
+    mail_args must have fromaddr, toaddr, subject and message, and mail step is skipped if this is None.
+    '''
+    set_onboarding_status(user_id, {
+        OnboardingStep.MAIL: OnboardingStatus.PENDING if mail_args else OnboardingStatus.SKIPPED,
+        OnboardingStep.SYNC_DB: OnboardingStatus.PENDING, })
+
+    if mail_args:
+        send_mail_task.delay(user_id, **mail_args)
+
+    # Send this task to the user's shard queue, so that this never runs concurrently with the user's journals.
+    target_queue = shard_router.route(user_id)
+    if target_queue:
+        create_user_db_task.apply_async(args=(user_id, ), queue=target_queue)
+    else:
+        create_user_db_task.delay(user_id)
+
+
+def resend_mail(user_id: int, mail_args: dict[str, str]):
+    # Status of the other steps are not changed.
+    set_onboarding_status(user_id, {OnboardingStep.MAIL: OnboardingStatus.PENDING})
+    send_mail_task.delay(user_id, **mail_args)
@@ -0,0 +1,157 @@
+import bisect
+import functools
+import hashlib
+import os
+import time
+import typing
+
+import app.common.utils as utils
+import app.plugin.bca.user_db.celery_init as celery_init
+import app.plugin.bca.user_db.file_io as user_db_file_io
+
+# Sharded routing is disabled unless $env:USER_DB_SHARD_ENABLE is 'true'.
+# When this is enabled, all journals of a user will be sent to the same queue,
+# so that a worker which consumes the queue can keep the user's sync db hot.
+USER_DB_SHARD_ENABLE = os.environ.get('USER_DB_SHARD_ENABLE', False) == 'true'
+USER_DB_SHARD_COUNT = int(os.environ.get('USER_DB_SHARD_COUNT', 1))
+USER_DB_SHARD_QUEUE_PREFIX = os.environ.get('USER_DB_SHARD_QUEUE_PREFIX', 'userdb_shard')
+USER_DB_SHARD_VNODE_COUNT = int(os.environ.get('USER_DB_SHARD_VNODE_COUNT', 128))
+# Shard count on redis will be re-fetched after this seconds.
+USER_DB_SHARD_CONFIG_TTL = int(os.environ.get('USER_DB_SHARD_CONFIG_TTL', 30))
+
+# Shard count can be changed on runtime using these keys. (See `resize_shard`)
+USER_DB_SHARD_COUNT_KEY = 'USER_DB_SHARD:COUNT'
+USER_DB_SHARD_PREVIOUS_COUNT_KEY = 'USER_DB_SHARD:PREVIOUS_COUNT'
+
+# (fetched_at, shard_count, previous_shard_count)
+_shard_config_cache: tuple[float, int, int] = (0.0, 0, 0)
+
+
+class ConsistentHashRing:
+    '''
+    Simple consistent hash ring.
+    Each shard owns `vnode_count` points on the ring,
+    so only about 1/N of users are moved to another shard when the shard count changes.
+    '''
+    shard_count: int
+    ring_points: list[int]
+    ring_shards: list[int]
+
+    def __init__(self, shard_count: int, vnode_count: int = USER_DB_SHARD_VNODE_COUNT):
+        if shard_count < 1:
+            raise ValueError('shard_count must be bigger than 0')
+
+        self.shard_count = shard_count
+
+        ring: list[tuple[int, int]] = list()
+        for shard in range(shard_count):
+            for vnode in range(vnode_count):
+                ring.append((self.hash_key(f'{shard}-{vnode}'), shard))
+        ring.sort()
+
+        self.ring_points = [z[0] for z in ring]
+        self.ring_shards = [z[1] for z in ring]
+
+    @staticmethod
+    def hash_key(key: typing.Any) -> int:
+        # We don't need a cryptographic hash here, but md5 is stable between processes unlike hash().
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+    def get_shard(self, key: typing.Any) -> int:
+        ring_index = bisect.bisect(self.ring_points, self.hash_key(key))
+        if ring_index == len(self.ring_points):
+            ring_index = 0
+        return self.ring_shards[ring_index]
+
+
+@functools.lru_cache(maxsize=8)
+def get_hash_ring(shard_count: int) -> ConsistentHashRing:
+    return ConsistentHashRing(shard_count)
+
+
+def get_queue_name(shard: int) -> str:
+    return f'{USER_DB_SHARD_QUEUE_PREFIX}_{shard}'
+
+
+def get_shard_config(force_reload: bool = False) -> tuple[int, int]:
+    '''
+    Returns (shard_count, previous_shard_count).
+    previous_shard_count will be 0 if there's no rebalance in progress.
+    '''
+    global _shard_config_cache
+
+    fetched_at, shard_count, previous_shard_count = _shard_config_cache
+    if force_reload or time.monotonic() - fetched_at > USER_DB_SHARD_CONFIG_TTL:
+        try:
+            redis_conn = celery_init.get_redis_connection()
+            redis_shard_count, redis_previous_shard_count = redis_conn.mget(
+                USER_DB_SHARD_COUNT_KEY, USER_DB_SHARD_PREVIOUS_COUNT_KEY)
+            shard_count = utils.safe_int(redis_shard_count) or USER_DB_SHARD_COUNT
+            previous_shard_count = utils.safe_int(redis_previous_shard_count)
+        except Exception as err:
+            # Use the last known configuration (or the env value) if redis is not reachable.
+            print(utils.get_traceback_msg(err))
+            shard_count = shard_count or USER_DB_SHARD_COUNT
+
+        _shard_config_cache = (time.monotonic(), shard_count, previous_shard_count)
+
+    return shard_count, previous_shard_count
+
+
+def get_shard(db_owner_id: int) -> int:
+    shard_count, previous_shard_count = get_shard_config()
+    shard = get_hash_ring(shard_count).get_shard(db_owner_id)
+
+    if previous_shard_count and previous_shard_count != shard_count:
+        # Rebalance is in progress. If this user was moved to another shard,
+        # keep sending journals to the previous shard until all pending tasks of this user are drained,
+        # so that the journals of a user are never applied out of order.
+        previous_shard = get_hash_ring(previous_shard_count).get_shard(db_owner_id)
+        if previous_shard != shard:
+            redis_conn = celery_init.get_redis_connection()
+            if redis_conn.exists(user_db_file_io.SYNC_DB_TASK_SET_KEY(db_owner_id)):
+                return previous_shard
+
+    return shard
+
+
+def route(db_owner_id: int) -> typing.Optional[str]:
+    '''
+    Returns a queue name that the journal of db_owner_id must be sent,
+    or None if sharded routing is disabled.
+    '''
+    if not USER_DB_SHARD_ENABLE:
+        return None
+    return get_queue_name(get_shard(db_owner_id))
+
+
+def resize_shard(new_shard_count: int):
+    '''
+    Starts a rebalance to new_shard_count.
+    Workers of the previous shards must be kept running until `finish_rebalance` is called.
+    '''
+    if new_shard_count < 1:
+        raise ValueError('new_shard_count must be bigger than 0')
+
+    current_shard_count, _ = get_shard_config(force_reload=True)
+
+    redis_conn = celery_init.get_redis_connection()
+    with redis_conn.pipeline() as pipe:
+        pipe.set(USER_DB_SHARD_PREVIOUS_COUNT_KEY, current_shard_count)
+        pipe.set(USER_DB_SHARD_COUNT_KEY, new_shard_count)
+        pipe.execute()
+
+    get_shard_config(force_reload=True)
+
+
+def finish_rebalance():
+    redis_conn = celery_init.get_redis_connection()
+    redis_conn.delete(USER_DB_SHARD_PREVIOUS_COUNT_KEY)
+    get_shard_config(force_reload=True)
+
+
+def get_moved_ratio(from_shard_count: int, to_shard_count: int, sample_size: int = 10000) -> float:
+    from_ring = get_hash_ring(from_shard_count)
+    to_ring = get_hash_ring(to_shard_count)
+    moved = sum(1 for z in range(sample_size) if from_ring.get_shard(z) != to_ring.get_shard(z))
+    return moved / sample_size
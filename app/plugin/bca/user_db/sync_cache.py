@@ -0,0 +1,212 @@
+import base64
+import collections
+import hashlib
+import os
+import threading
+import time
+import typing
+
+import app.common.utils as utils
+import app.plugin.bca.user_db.file_io as user_db_file_io
+
+# Sync db cache is disabled unless $env:SYNC_DB_CACHE_ENABLE is 'true'.
+# When this is enabled, API servers keep recently synced user dbs on memory,
+# and drop those when the worker publishes a new version through redis pub/sub.
+SYNC_DB_CACHE_ENABLE = os.environ.get('SYNC_DB_CACHE_ENABLE', False) == 'true'
+SYNC_DB_CACHE_MAX_BYTES = int(os.environ.get('SYNC_DB_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# User dbs bigger than this won't be cached, so that a few huge files cannot evict all the others.
+SYNC_DB_CACHE_MAX_ENTRY_BYTES = int(os.environ.get('SYNC_DB_CACHE_MAX_ENTRY_BYTES', 4 * 1024 * 1024))
+
+
+class SyncDBCacheEntry:
+    user_id: int
+    db_bytes: bytes
+    hash: str
+    # Encoded forms of db_bytes (like base64), which are created only when requested.
+    encoded: dict[str, typing.Union[str, bytes]]
+
+    def __init__(self, user_id: int, db_bytes: bytes):
+        self.user_id = user_id
+        self.db_bytes = db_bytes
+        self.hash = hashlib.md5(db_bytes).hexdigest()
+        self.encoded = dict()
+
+    @property
+    def size(self) -> int:
+        return len(self.db_bytes) + sum(len(z) for z in self.encoded.values())
+
+    def get_encoded(self, encoding: str, encoder: typing.Callable[[bytes], typing.Union[str, bytes]]):
+        if encoding not in self.encoded:
+            self.encoded[encoding] = encoder(self.db_bytes)
+        return self.encoded[encoding]
+
+    def as_b64urlsafe(self) -> str:
+        return self.get_encoded('b64', lambda z: base64.b64encode(z).decode())
+
+
+class SyncDBCache:
+    '''
+    Bounded LRU of user db bytes and hashes, which is limited by the total size of the entries.
+    Entries are invalidated by the messages on SYNC_DB_UPDATED_CHANNEL.
+    '''
+    max_bytes: int
+    max_entry_bytes: int
+    entries: collections.OrderedDict[int, SyncDBCacheEntry]
+    # Generation of each user is increased on invalidation.
+    # This prevents caching a user db that was read before the invalidation message arrived.
+    generations: collections.defaultdict[int, int]
+    # Epoch is increased when the whole cache is cleared, as we may have missed some invalidation messages.
+    epoch: int = 0
+    total_bytes: int = 0
+
+    lock: threading.Lock
+    subscriber_thread: typing.Optional[threading.Thread] = None
+    subscriber_pid: typing.Optional[int] = None
+
+    def __init__(self,
+                 max_bytes: int = SYNC_DB_CACHE_MAX_BYTES,
+                 max_entry_bytes: int = SYNC_DB_CACHE_MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.entries = collections.OrderedDict()
+        self.generations = collections.defaultdict(int)
+        self.lock = threading.Lock()
+
+    def get(self, user_id: int) -> typing.Optional[SyncDBCacheEntry]:
+        with self.lock:
+            entry = self.entries.get(user_id, None)
+            if entry is not None:
+                self.entries.move_to_end(user_id)
+            return entry
+
+    def get_generation(self, user_id: int) -> tuple[int, int]:
+        with self.lock:
+            return (self.epoch, self.generations[user_id])
+
+    def put(self, entry: SyncDBCacheEntry, generation: tuple[int, int]) -> bool:
+        if entry.size > self.max_entry_bytes:
+            return False
+
+        with self.lock:
+            if (self.epoch, self.generations[entry.user_id]) != generation:
+                # User db is changed while we were reading it.
+                return False
+
+            self._pop(entry.user_id)
+            self.entries[entry.user_id] = entry
+            self.total_bytes += entry.size
+            while self.total_bytes > self.max_bytes and self.entries:
+                self._pop(next(iter(self.entries)))
+            return True
+
+    def resize(self, entry: SyncDBCacheEntry, previous_size: int):
+        # Encoded forms are added after the entry is cached, so we need to recalculate the total size.
+        with self.lock:
+            if self.entries.get(entry.user_id, None) is not entry:
+                return
+
+            self.total_bytes += entry.size - previous_size
+            if entry.size > self.max_entry_bytes:
+                self._pop(entry.user_id)
+            while self.total_bytes > self.max_bytes and self.entries:
+                self._pop(next(iter(self.entries)))
+
+    def invalidate(self, user_id: int):
+        with self.lock:
+            self.generations[user_id] += 1
+            self._pop(user_id)
+
+            # Generations are kept for every changed user, so reset those sometimes.
+            # Increasing epoch makes pending reads of all users not cacheable, which is safe.
+            if len(self.generations) > 65536:
+                self.epoch += 1
+                self.generations.clear()
+
+    def clear(self):
+        with self.lock:
+            self.epoch += 1
+            self.generations.clear()
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def _pop(self, user_id: int):
+        # This must be called while holding the lock.
+        entry = self.entries.pop(user_id, None)
+        if entry is not None:
+            self.total_bytes -= entry.size
+
+    def ensure_subscriber(self):
+        # Threads are not copied on fork (like gunicorn workers with preload),
+        # so start the subscriber thread lazily on each process.
+        if self.subscriber_pid == os.getpid() and self.subscriber_thread and self.subscriber_thread.is_alive():
+            return
+
+        with self.lock:
+            if self.subscriber_pid == os.getpid() and self.subscriber_thread and self.subscriber_thread.is_alive():
+                return
+
+            self.subscriber_pid = os.getpid()
+            self.subscriber_thread = threading.Thread(
+                target=self.run_subscriber,
+                name='SyncDBCacheSubscriber',
+                daemon=True)
+            self.subscriber_thread.start()
+
+    def run_subscriber(self):
+        import app.plugin.bca.user_db.celery_init as celery_init
+
+        while True:
+            try:
+                pubsub = celery_init.get_redis_connection().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(user_db_file_io.SYNC_DB_UPDATED_CHANNEL)
+
+                # We may have missed some messages while we were not subscribing.
+                self.clear()
+
+                for message in pubsub.listen():
+                    user_id = utils.safe_int(message.get('data', None))
+                    if user_id:
+                        self.invalidate(user_id)
+            except Exception as err:
+                print(utils.get_traceback_msg(err))
+
+            # Don't serve the cached data while we cannot receive invalidation messages.
+            self.clear()
+            time.sleep(1)
+
+
+sync_db_cache = SyncDBCache()
+
+
+def get_sync_db(user_id: int) -> SyncDBCacheEntry:
+    '''
+    Returns the user db bytes and hash, from memory if possible.
+    User db will be created if the user doesn't have one.
+    '''
+    if SYNC_DB_CACHE_ENABLE:
+        sync_db_cache.ensure_subscriber()
+        entry = sync_db_cache.get(user_id)
+        if entry is not None:
+            return entry
+
+    generation = sync_db_cache.get_generation(user_id)
+    user_db_obj = user_db_file_io.BCaSyncFile.load_or_create(user_id)
+
+    entry = SyncDBCacheEntry(user_id, user_db_obj.read_bytes())
+    if SYNC_DB_CACHE_ENABLE:
+        sync_db_cache.put(entry, generation)
+    return entry
+
+
+def get_sync_db_b64urlsafe(entry: SyncDBCacheEntry) -> str:
+    previous_size = entry.size
+    result = entry.as_b64urlsafe()
+    if SYNC_DB_CACHE_ENABLE and entry.size != previous_size:
+        sync_db_cache.resize(entry, previous_size)
+    return result
+
+
+def get_sync_db_hash(user_id: int) -> str:
+    if SYNC_DB_CACHE_ENABLE:
+        return get_sync_db(user_id).hash
+    return user_db_file_io.BCaSyncFile.get_hash(user_id)
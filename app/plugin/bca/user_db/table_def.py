@@ -175,3 +175,19 @@ class CardSubscription:
     @sqldec.declared_attr
     def subscribed_profile_id(cls):
         return sql.Column(sql.Integer, sql.ForeignKey('TB_PROFILE.uuid'), nullable=False)
+
+
+# Declarative table classes of the tables above.
+# Creating declarative classes is quite expensive, so we create them only once per process.
+UserDBBase = sqldec.declarative_base()
+ProfileTable = type('ProfileTable', (UserDBBase, Profile), {})
+ProfileRelationTable = type('ProfileRelationTable', (UserDBBase, ProfileRelation), {})
+CardTable = type('CardTable', (UserDBBase, Card), {})
+CardSubscriptionTable = type('CardSubscriptionTable', (UserDBBase, CardSubscription), {})
+
+USER_DB_TABLES: dict[str, sqldec.DeclarativeMeta] = {
+    'TB_PROFILE': ProfileTable,
+    'TB_PROFILE_RELATION': ProfileRelationTable,
+    'TB_CARD': CardTable,
+    'TB_CARD_SUBSCRIPTION': CardSubscriptionTable,
+}
@@ -0,0 +1,112 @@
+import enum
+import functools
+import sqlite3
+import sqlalchemy as sql
+import sqlalchemy.dialects.sqlite as sqldlc_sqlite
+import sqlalchemy.ext.declarative as sqldec
+import sqlalchemy.types as sqltypes
+import typing
+
+import app.plugin.bca.user_db.table_def as user_db_table_def
+
+sqlite_dialect = sqldlc_sqlite.dialect()
+
+
+class UserDBTableStatement:
+    '''
+    Precompiled INSERT/UPDATE/DELETE statements of a user db table.
+    These are executed directly on sqlite3 connection, so we don't need any ORM objects while applying journals.
+    '''
+    tablename: str
+    column_names: tuple[str]
+    column_defaults: dict[str, typing.Any]
+    bind_processors: dict[str, typing.Callable[[typing.Any], typing.Any]]
+
+    insert_sql: str
+    update_sql: str
+    upsert_sql: str
+    delete_sql: str
+
+    def __init__(self, table_cls: sqldec.DeclarativeMeta):
+        table: sql.Table = table_cls.__table__
+        self.tablename = table.name
+        self.column_names = tuple(table_cls.column_names)
+
+        self.column_defaults = dict()
+        self.bind_processors = dict()
+        for column in table.columns:
+            if column.default is not None and column.default.is_scalar:
+                self.column_defaults[column.name] = column.default.arg
+            if isinstance(column.type, sqltypes.TypeDecorator):
+                self.bind_processors[column.name] = functools.partial(
+                    column.type.process_bind_param, dialect=sqlite_dialect)
+
+        self.insert_sql = self.get_insert_sql(self.column_names)
+        self.update_sql = self.get_update_sql(self.column_names)
+        self.upsert_sql = self.get_upsert_sql(self.column_names, self.column_names)
+        self.delete_sql = f'DELETE FROM "{self.tablename}" WHERE uuid = :uuid'
+
+    @functools.lru_cache(maxsize=16)
+    def get_insert_sql(self, column_names: tuple[str]) -> str:
+        return (f'INSERT INTO "{self.tablename}" ({", ".join(column_names)}) '
+                f'VALUES ({", ".join(":" + z for z in column_names)})')
+
+    @functools.lru_cache(maxsize=16)
+    def get_update_sql(self, column_names: tuple[str]) -> str:
+        return (f'UPDATE "{self.tablename}" '
+                f'SET {", ".join(f"{z} = :{z}" for z in column_names if z != "uuid")} '
+                'WHERE uuid = :uuid')
+
+    @functools.lru_cache(maxsize=16)
+    def get_upsert_sql(self, column_names: tuple[str], update_column_names: tuple[str]) -> str:
+        # Inserts a row, or updates only the given columns if the row already exists.
+        update_set_sql = ", ".join(f"{z} = excluded.{z}" for z in update_column_names if z != "uuid")
+        if not update_set_sql:
+            return self.get_insert_sql(column_names) + ' ON CONFLICT(uuid) DO NOTHING'
+        return self.get_insert_sql(column_names) + f' ON CONFLICT(uuid) DO UPDATE SET {update_set_sql}'
+
+    def bind(self, uuid: int, column_data_map: dict[str, typing.Any], fill_default: bool = False) -> dict:
+        result = {k: v for k, v in column_data_map.items() if k in self.column_names}
+        if fill_default:
+            for column_name, default_value in self.column_defaults.items():
+                result.setdefault(column_name, default_value)
+
+        for column_name, column_value in result.items():
+            if isinstance(column_value, enum.Enum):
+                column_value = column_value.value
+            if column_name in self.bind_processors:
+                column_value = self.bind_processors[column_name](column_value)
+            result[column_name] = column_value
+
+        result['uuid'] = int(uuid)
+        return result
+
+    def insert(self, conn: sqlite3.Connection, uuid: int, column_data_map: dict[str, typing.Any]) -> sqlite3.Cursor:
+        params = self.bind(uuid, column_data_map, fill_default=True)
+        column_names = tuple(params.keys())
+        insert_sql = self.insert_sql if column_names == self.column_names else self.get_insert_sql(column_names)
+        return conn.execute(insert_sql, params)
+
+    def update(self, conn: sqlite3.Connection, uuid: int, column_data_map: dict[str, typing.Any]) -> sqlite3.Cursor:
+        params = self.bind(uuid, column_data_map)
+        column_names = tuple(params.keys())
+        update_sql = self.update_sql if column_names == self.column_names else self.get_update_sql(column_names)
+        return conn.execute(update_sql, params)
+
+    def upsert(self, conn: sqlite3.Connection, uuid: int, column_data_map: dict[str, typing.Any]) -> sqlite3.Cursor:
+        params = self.bind(uuid, column_data_map, fill_default=True)
+        column_names = tuple(params.keys())
+        update_column_names = tuple(k for k in column_data_map.keys() if k in self.column_names)
+        upsert_sql = self.upsert_sql\
+            if column_names == self.column_names and update_column_names == self.column_names\
+            else self.get_upsert_sql(column_names, update_column_names)
+        return conn.execute(upsert_sql, params)
+
+    def delete(self, conn: sqlite3.Connection, uuid: int) -> sqlite3.Cursor:
+        return conn.execute(self.delete_sql, {'uuid': int(uuid)})
+
+
+USER_DB_TABLE_STATEMENTS: dict[str, UserDBTableStatement] = {
+    tablename: UserDBTableStatement(table_cls)
+    for tablename, table_cls in user_db_table_def.USER_DB_TABLES.items()
+}
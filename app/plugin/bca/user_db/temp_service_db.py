@@ -1,4 +1,4 @@
-import enum
+import datetime
 import os
 import pathlib as pt
 import typing
@@ -9,6 +9,7 @@ import sqlalchemy.ext.declarative as sqldec
 import sqlalchemy.orm as sqlorm
 
 import app.plugin.bca.user_db.file_io as file_io
+import app.plugin.bca.user_db.table_statement as user_db_table_statement
 
 
 class TemporaryServiceDBConnection:
@@ -43,6 +44,16 @@ class TemporaryServiceDBConnection:
                 'TB_REFRESH_TOKEN', self.base.metadata,
                 autoload=True, autoload_with=self.engine)
 
+        class EmailToken(self.base):
+            __table__ = sql.Table(
+                'TB_EMAILTOKEN', self.base.metadata,
+                autoload=True, autoload_with=self.engine)
+
+        class UploadedFile(self.base):
+            __table__ = sql.Table(
+                'TB_UPLOADED_FILE', self.base.metadata,
+                autoload=True, autoload_with=self.engine)
+
         class Profile(self.base):
             __table__ = sql.Table(
                 'TB_PROFILE', self.base.metadata,
@@ -66,6 +77,8 @@ class TemporaryServiceDBConnection:
         self.tables = {
             'User': User,
             'RefreshToken': RefreshToken,
+            'EmailToken': EmailToken,
+            'UploadedFile': UploadedFile,
             'Profile': Profile,
             'ProfileRelation': ProfileRelation,
             'Card': Card,
@@ -75,125 +88,175 @@ class TemporaryServiceDBConnection:
     def get_user_fcm_tokens(self, user_id: int) -> list[str]:
         RefreshTokenTable = self.tables['RefreshToken']
 
-        result: list[tuple[str]] = self.session.query(RefreshTokenTable.client_token)\
-            .filter(RefreshTokenTable.user == int(user_id))\
-            .filter(RefreshTokenTable.client_token.is_not(None))\
-            .distinct().all()
+        try:
+            result: list[tuple[str]] = self.session.query(RefreshTokenTable.client_token)\
+                .filter(RefreshTokenTable.user == int(user_id))\
+                .filter(RefreshTokenTable.client_token.is_not(None))\
+                .distinct().all()
+        finally:
+            # This connection is shared between tasks, so we need to return the DB connection to the pool.
+            self.session.remove()
+
         # I don't know why, I don't want to know why, I shouldn't
         # have to wonder why, but for whatever reason this stupid
         # query isn't returning list[str] correctly. (It's returning `list[tuple[str]]`)!
         # So, FCM request will fail unless we do this terribleness
         return [item for sublist in result for item in sublist]
 
-    def insert_user_db_record(self, user_id: int, bca_sync_file: file_io.BCaSyncFile):
-        temp_user_db_sqlite_conn = sqlite3.connect(bca_sync_file.pathobj)
-        temp_user_db_engine = sql.create_engine('sqlite://', creator=lambda: temp_user_db_sqlite_conn)
-        temp_user_db_session = sqlorm.scoped_session(
-                                    sqlorm.sessionmaker(
-                                        autocommit=False,
-                                        autoflush=False,
-                                        bind=temp_user_db_engine))
-        temp_user_db_base = sqldec.declarative_base()
-
-        # Define necessary user db tables
-        class ProfileTable(temp_user_db_base):
-            __table__ = sql.Table(
-                'TB_PROFILE', temp_user_db_base.metadata,
-                autoload=True, autoload_with=temp_user_db_engine)
-
-        class ProfileRelationTable(temp_user_db_base):
-            __table__ = sql.Table(
-                'TB_PROFILE_RELATION', temp_user_db_base.metadata,
-                autoload=True, autoload_with=temp_user_db_engine)
-
-        class CardTable(temp_user_db_base):
-            __table__ = sql.Table(
-                'TB_CARD', temp_user_db_base.metadata,
-                autoload=True, autoload_with=temp_user_db_engine)
-
-        class CardSubscribedTable(temp_user_db_base):
-            __table__ = sql.Table(
-                'TB_CARD_SUBSCRIPTION', temp_user_db_base.metadata,
-                autoload=True, autoload_with=temp_user_db_engine)
-
+    def get_user_ids(self, after_user_id: int = 0, limit: int = 100) -> list[int]:
+        UserTable = self.tables['User']
+
+        try:
+            result: list[tuple[int]] = self.session.query(UserTable.uuid)\
+                .filter(UserTable.uuid > after_user_id)\
+                .filter(UserTable.deactivated_at.is_(None))\
+                .order_by(UserTable.uuid.asc())\
+                .limit(limit).all()
+        finally:
+            self.session.remove()
+
+        return [z[0] for z in result]
+
+    def delete_rows_before(self,
+                           table_name: str,
+                           primary_key_name: str,
+                           column_name: str,
+                           before: datetime.datetime,
+                           limit: int = 1000) -> int:
+        '''
+        Deletes at most `limit` rows that `column_name` is older than `before`, and returns the number of deleted rows.
+        Rows are selected using the index of `column_name` first, and then deleted by primary keys,
+        so that a single call never holds locks on many rows.
+        '''
+        TargetTable = self.tables[table_name]
+        primary_key_column = getattr(TargetTable, primary_key_name)
+        target_column = getattr(TargetTable, column_name)
+
+        try:
+            target_primary_keys: list[int] = [z[0] for z in self.session.query(primary_key_column)
+                                              .filter(target_column.is_not(None))
+                                              .filter(target_column < before)
+                                              .order_by(target_column.asc())
+                                              .limit(limit).all()]
+            if target_primary_keys:
+                self.session.query(TargetTable)\
+                    .filter(primary_key_column.in_(target_primary_keys))\
+                    .delete(synchronize_session=False)
+                self.session.commit()
+        except Exception as err:
+            self.session.rollback()
+            raise err
+        finally:
+            self.session.remove()
+
+        return len(target_primary_keys)
+
+    def get_user_db_records(self, user_id: int) -> dict[str, list]:
+        '''
+        Returns all service db rows that must be on the user db, keyed by the user db table name.
+        Tables are ordered to avoid FK errors on insertion.
+        '''
         # Get necessary service db tables
         TB_Profile = self.tables['Profile']
         TB_ProfileRelation = self.tables['ProfileRelation']
         TB_Card = self.tables['Card']
         TB_CardSubscription = self.tables['CardSubscribed']
 
-        # All profile's ID that created by user, following profiles, and subscribed cards' profiles
-        user_profiles_query = self.session.query(TB_Profile.uuid)\
-            .filter(TB_Profile.locked_at.is_(None))\
-            .filter(TB_Profile.deleted_at.is_(None))\
-            .filter(TB_Profile.user_id == user_id)\
-            .subquery()
-
-        following_profiles_query = self.session.query(TB_ProfileRelation.to_profile_id)\
-            .filter(TB_ProfileRelation.from_user_id == user_id)\
-            .join(TB_ProfileRelation.to_profile, aliased=True)\
-            .filter(TB_Profile.locked_at.is_(None))\
-            .distinct().subquery()
-
-        subscribed_cards_profiles_query = self.session.query(TB_CardSubscription.card_profile_id)\
-            .filter(TB_CardSubscription.subscribed_user_id == user_id)\
-            .join(TB_CardSubscription.card, aliased=True)\
-            .filter(TB_Card.locked_at.is_(None))\
-            .distinct().subquery()
-
-        # All profiles to be loaded
-        load_target_profiles: list[TB_Profile] = self.session.query(TB_Profile)\
-            .filter(TB_Profile.locked_at.is_(None))\
-            .filter(sql.or_(
-                TB_Profile.uuid.in_(user_profiles_query),
-                TB_Profile.uuid.in_(following_profiles_query),
-                TB_Profile.uuid.in_(subscribed_cards_profiles_query),
-            )).distinct(TB_Profile.uuid).all()
-
-        # All profile relations to be loaded
-        load_target_profile_relations: list[TB_ProfileRelation] = self.session.query(
-            TB_ProfileRelation)\
-            .filter(TB_ProfileRelation.from_user_id == user_id)\
-            .join(TB_ProfileRelation.to_profile, aliased=True)\
-            .filter(TB_Profile.locked_at.is_(None))\
-            .distinct(TB_ProfileRelation.uuid).all()
-
-        # All card subscriptions to be loaded
-        card_subscriptions_query = self.session.query(TB_CardSubscription)\
-            .filter(TB_CardSubscription.subscribed_user_id == user_id)\
-            .join(TB_CardSubscription.card, aliased=True)\
-            .filter(TB_Card.locked_at.is_(None))\
-            .distinct(TB_CardSubscription.uuid)
-
-        load_target_card_subscriptions: list[TB_CardSubscription] = card_subscriptions_query.all()
-
-        # All cards to be loaded
-        load_target_cards: list[TB_Card] = self.session.query(TB_Card)\
-            .filter(TB_Card.locked_at.is_(None))\
-            .filter(sql.or_(
-                TB_Card.user_id == user_id,  # User's cards
-                TB_Card.uuid.in_(  # Subscribed cards
-                    card_subscriptions_query.with_entities(TB_CardSubscription.uuid)),
-            ))\
-            .distinct(TB_Card.uuid).all()
-
-        load_target_table_map: list[tuple[list, typing.Type]] = [
-            (load_target_profiles, ProfileTable),
-            (load_target_profile_relations, ProfileRelationTable),
-            (load_target_cards, CardTable),
-            (load_target_card_subscriptions, CardSubscribedTable),
-        ]
-        for load_target_data_list, TableClass in load_target_table_map:
-            for load_target_data in load_target_data_list:
-                new_row = TableClass()
-
-                for column in TableClass.column_names:
-                    result_val = getattr(load_target_data, column)
-                    if isinstance(result_val, enum.Enum):
-                        result_val = result_val.value
-                    setattr(new_row, column, result_val)
-
-                temp_user_db_session.add(new_row)
-
-        temp_user_db_session.commit()
-        temp_user_db_engine.dispose()  # Disconnect all connections (for safety)
+        try:
+            # All profile's ID that created by user, following profiles, and subscribed cards' profiles
+            user_profiles_query = self.session.query(TB_Profile.uuid)\
+                .filter(TB_Profile.locked_at.is_(None))\
+                .filter(TB_Profile.deleted_at.is_(None))\
+                .filter(TB_Profile.user_id == user_id)\
+                .subquery()
+
+            following_profiles_query = self.session.query(TB_ProfileRelation.to_profile_id)\
+                .filter(TB_ProfileRelation.from_user_id == user_id)\
+                .join(TB_ProfileRelation.to_profile, aliased=True)\
+                .filter(TB_Profile.locked_at.is_(None))\
+                .distinct().subquery()
+
+            subscribed_cards_profiles_query = self.session.query(TB_CardSubscription.card_profile_id)\
+                .filter(TB_CardSubscription.subscribed_user_id == user_id)\
+                .join(TB_CardSubscription.card, aliased=True)\
+                .filter(TB_Card.locked_at.is_(None))\
+                .distinct().subquery()
+
+            # All profiles to be loaded
+            load_target_profiles: list[TB_Profile] = self.session.query(TB_Profile)\
+                .filter(TB_Profile.locked_at.is_(None))\
+                .filter(sql.or_(
+                    TB_Profile.uuid.in_(user_profiles_query),
+                    TB_Profile.uuid.in_(following_profiles_query),
+                    TB_Profile.uuid.in_(subscribed_cards_profiles_query),
+                )).distinct(TB_Profile.uuid).all()
+
+            # All profile relations to be loaded
+            load_target_profile_relations: list[TB_ProfileRelation] = self.session.query(
+                TB_ProfileRelation)\
+                .filter(TB_ProfileRelation.from_user_id == user_id)\
+                .join(TB_ProfileRelation.to_profile, aliased=True)\
+                .filter(TB_Profile.locked_at.is_(None))\
+                .distinct(TB_ProfileRelation.uuid).all()
+
+            # All card subscriptions to be loaded
+            card_subscriptions_query = self.session.query(TB_CardSubscription)\
+                .filter(TB_CardSubscription.subscribed_user_id == user_id)\
+                .join(TB_CardSubscription.card, aliased=True)\
+                .filter(TB_Card.locked_at.is_(None))\
+                .distinct(TB_CardSubscription.uuid)
+
+            load_target_card_subscriptions: list[TB_CardSubscription] = card_subscriptions_query.all()
+
+            # All cards to be loaded
+            load_target_cards: list[TB_Card] = self.session.query(TB_Card)\
+                .filter(TB_Card.locked_at.is_(None))\
+                .filter(sql.or_(
+                    TB_Card.user_id == user_id,  # User's cards
+                    TB_Card.uuid.in_(  # Subscribed cards
+                        card_subscriptions_query.with_entities(TB_CardSubscription.uuid)),
+                ))\
+                .distinct(TB_Card.uuid).all()
+        finally:
+            # This connection is shared between tasks, so we need to return the DB connection to the pool.
+            self.session.remove()
+
+        return {
+            'TB_PROFILE': load_target_profiles,
+            'TB_CARD': load_target_cards,
+            'TB_PROFILE_RELATION': load_target_profile_relations,
+            'TB_CARD_SUBSCRIPTION': load_target_card_subscriptions,
+        }
+
+    def insert_user_db_record(self, user_id: int, bca_sync_file: file_io.BCaSyncFile):
+        user_db_records = self.get_user_db_records(user_id)
+
+        temp_user_db_sqlite_conn = sqlite3.connect(bca_sync_file.pathobj)
+        try:
+            file_io.apply_user_db_pragmas(temp_user_db_sqlite_conn)
+            with temp_user_db_sqlite_conn:
+                for tablename, rows in user_db_records.items():
+                    table_statement = user_db_table_statement.USER_DB_TABLE_STATEMENTS[tablename]
+                    for row in rows:
+                        table_statement.upsert(
+                            temp_user_db_sqlite_conn, row.uuid,
+                            {column: getattr(row, column) for column in table_statement.column_names})
+
+            file_io.checkpoint_user_db(temp_user_db_sqlite_conn)
+        finally:
+            temp_user_db_sqlite_conn.close()
+
+
+_service_db_connection: typing.Optional[TemporaryServiceDBConnection] = None
+
+
+def get_service_db_connection() -> TemporaryServiceDBConnection:
+    '''
+    Returns a service db connection of this worker process.
+    Creating TemporaryServiceDBConnection reflects all tables from service db, which is really slow,
+    so we create it only once per process and reuse it.
+    '''
+    global _service_db_connection
+    if _service_db_connection is None:
+        _service_db_connection = TemporaryServiceDBConnection()
+    return _service_db_connection
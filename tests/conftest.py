@@ -0,0 +1,8 @@
+import os
+
+# app.config reads these on import, so those must be set before any test imports the app package.
+# Tests don't connect to redis, those are only needed to load the config and the celery app.
+os.environ.setdefault('REDIS_HOST', 'localhost')
+os.environ.setdefault('REDIS_PORT', '6379')
+os.environ.setdefault('REDIS_DB', '0')
+os.environ.setdefault('LOCAL_DEV_CLIENT_PORT', '3000')
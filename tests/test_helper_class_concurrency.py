@@ -0,0 +1,67 @@
+import concurrent.futures
+import sys
+import threading
+
+import flask
+import pytest
+
+import app.api.helper_class as api_class
+
+CONCURRENT_REQUESTS = 8
+REQUEST_ROUNDS = 50
+
+
+def create_test_app(barrier: threading.Barrier) -> flask.Flask:
+    test_app = flask.Flask(__name__)
+
+    # Wait until all requests of the round arrived, so that the decorators handle those at the same time.
+    @test_app.before_request
+    def wait_for_other_requests():
+        barrier.wait()
+
+    # Decorator objects are created once, and shared by all requests of this route, like the real routes.
+    @api_class.RequestHeader(required_fields={'X-Csrf-Token': {'type': 'string', }, })
+    @api_class.RequestQuery(required_fields={'query': {'type': 'string', }, })
+    @api_class.RequestBody(required_fields={'value': {'type': 'string', }, })
+    def echo_route(req_header: dict, req_query: dict, req_body: dict):
+        return flask.jsonify({
+            'header': req_header['X-Csrf-Token'],
+            'query': req_query['query'],
+            'body': req_body['value'], })
+
+    test_app.add_url_rule('/echo', view_func=echo_route, methods=['POST', ])
+    return test_app
+
+
+@pytest.fixture
+def fast_thread_switch():
+    # Switch threads as often as possible, so that requests are interleaved inside the decorators.
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(switch_interval)
+
+
+def test_decorators_keep_per_request_values_on_concurrent_requests(fast_thread_switch):
+    barrier = threading.Barrier(CONCURRENT_REQUESTS, timeout=10)
+    test_app = create_test_app(barrier)
+
+    def send_request(index: int) -> tuple[int, dict]:
+        with test_app.test_client() as client:
+            response = client.post(
+                '/echo',
+                query_string={'query': f'query-{index}', },
+                headers={'X-Csrf-Token': f'csrf-token-{index}', },
+                json={'value': f'body-value-{index}', })
+            assert response.status_code == 200, response.get_data(as_text=True)
+            return index, response.get_json()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=CONCURRENT_REQUESTS) as executor:
+        for round_index in range(REQUEST_ROUNDS):
+            request_indexes = range(round_index * CONCURRENT_REQUESTS, (round_index + 1) * CONCURRENT_REQUESTS)
+            for index, result in executor.map(send_request, request_indexes):
+                # Each request must see only the values that it sent.
+                assert result == {
+                    'header': f'csrf-token-{index}',
+                    'query': f'query-{index}',
+                    'body': f'body-value-{index}', }
@@ -0,0 +1,80 @@
+import boto3
+import fakeredis
+import pytest
+
+import app.plugin.bca.user_db.celery_init as celery_init
+import app.plugin.bca.user_db.consistency as user_db_consistency
+import app.plugin.bca.user_db.file_io as user_db_file_io
+import app.plugin.bca.user_db.journal_handler as journal_handler
+
+
+class FakeSQSClient:
+    # Fails the entries of failing_ids on each send_message_batch call, and records all sent entries.
+    def __init__(self, failing_ids_per_call: list[set[str]]):
+        self.failing_ids_per_call = failing_ids_per_call
+        self.sent_entries: list[list[dict]] = list()
+
+    def send_message_batch(self, QueueUrl: str, Entries: list[dict]) -> dict:
+        failing_ids = self.failing_ids_per_call[len(self.sent_entries)]
+        self.sent_entries.append(Entries)
+        return {
+            'Successful': [{'Id': z['Id']} for z in Entries if z['Id'] not in failing_ids],
+            'Failed': [
+                {'Id': z['Id'], 'SenderFault': False, 'Code': 'InternalError', 'Message': ''}
+                for z in Entries if z['Id'] in failing_ids],
+        }
+
+
+@pytest.fixture
+def redis_conn(monkeypatch):
+    redis_conn = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(celery_init, 'internal_redis_conn', redis_conn)
+    return redis_conn
+
+
+@pytest.fixture
+def repair_requests(monkeypatch) -> list:
+    repair_requests = list()
+    monkeypatch.setenv('AWS_TASK_SQS_URL', 'https://sqs.example.com/userdbmod1.fifo')
+    monkeypatch.setattr(
+        user_db_consistency, 'add_check_user_db_task_to_queue',
+        lambda user_id, repair=False: repair_requests.append((user_id, repair)))
+    return repair_requests
+
+
+def use_sqs_client(monkeypatch, sqs_client: FakeSQSClient):
+    monkeypatch.setattr(boto3, 'client', lambda service_name, *args, **kwargs: sqs_client)
+
+
+def create_journal(db_owner_id: int) -> journal_handler.UserDBJournal:
+    journal = journal_handler.UserDBJournal.create(db_owner_id)
+    change = journal_handler.UserDBJournalChangelogData()
+    change.tablename = 'TB_CARD'
+    change.uuid = 1
+    change.action = journal_handler.UserDBJournalActionCase.modify.value
+    change.column_data_map = dict()
+    journal.changes.append(change)
+    return journal
+
+
+def test_failed_entries_are_resent_with_original_ids(monkeypatch, redis_conn, repair_requests):
+    sqs_client = FakeSQSClient([{'1'}, set()])
+    use_sqs_client(monkeypatch, sqs_client)
+
+    journal_handler.UserDBJournal.add_all_to_queue([create_journal(1), create_journal(2), ])
+
+    assert [z['Id'] for z in sqs_client.sent_entries[1]] == ['1', ]
+    assert sqs_client.sent_entries[1][0]['MessageBody'] == sqs_client.sent_entries[0][1]['MessageBody']
+    assert repair_requests == []
+
+
+def test_failed_entries_schedule_repair_instead_of_raising(monkeypatch, redis_conn, repair_requests):
+    use_sqs_client(monkeypatch, FakeSQSClient([{'1'}, {'1'}]))
+    sent_journal, failed_journal = create_journal(1), create_journal(2)
+
+    journal_handler.UserDBJournal.add_all_to_queue([sent_journal, failed_journal, ])
+
+    assert repair_requests == [(2, True), ]
+    # Failed journal will never run, so it must not be left as a pending task of the user.
+    assert not redis_conn.sismember(user_db_file_io.SYNC_DB_TASK_SET_KEY(2), failed_journal.task_id)
+    assert redis_conn.sismember(user_db_file_io.SYNC_DB_TASK_SET_KEY(1), sent_journal.task_id)
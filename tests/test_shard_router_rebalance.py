@@ -0,0 +1,83 @@
+import celery.canvas
+import fakeredis
+import pytest
+
+import app.plugin.bca.user_db.celery_init as celery_init
+import app.plugin.bca.user_db.file_io as user_db_file_io
+import app.plugin.bca.user_db.journal_handler as journal_handler
+import app.plugin.bca.user_db.shard_router as shard_router
+
+PREVIOUS_SHARD_COUNT = 2
+SHARD_COUNT = 3
+
+
+@pytest.fixture
+def redis_conn(monkeypatch):
+    # All user db modules get the redis connection from celery_init.get_redis_connection.
+    redis_conn = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(celery_init, 'internal_redis_conn', redis_conn)
+    return redis_conn
+
+
+@pytest.fixture
+def rebalancing(monkeypatch, redis_conn):
+    # Rebalance from PREVIOUS_SHARD_COUNT to SHARD_COUNT is in progress.
+    monkeypatch.setattr(shard_router, 'USER_DB_SHARD_ENABLE', True)
+    monkeypatch.setattr(shard_router, '_shard_config_cache', (0.0, 0, 0))
+    redis_conn.set(shard_router.USER_DB_SHARD_PREVIOUS_COUNT_KEY, PREVIOUS_SHARD_COUNT)
+    redis_conn.set(shard_router.USER_DB_SHARD_COUNT_KEY, SHARD_COUNT)
+    shard_router.get_shard_config(force_reload=True)
+
+
+@pytest.fixture
+def published_queues(monkeypatch) -> list:
+    # Records the queue of each published journal, instead of sending it to the broker.
+    published_queues = list()
+    monkeypatch.setattr(
+        celery.canvas.Signature, 'apply_async',
+        lambda self, *args, **kwargs: published_queues.append(self.options.get('queue', None)))
+    monkeypatch.setattr(
+        celery.canvas.group, 'apply_async',
+        lambda self, *args, **kwargs: published_queues.extend(z.options.get('queue', None) for z in self.tasks))
+    return published_queues
+
+
+def get_moved_user_id() -> tuple[int, int, int]:
+    # Returns (user id, previous shard, new shard) of a user that is moved by the rebalance.
+    previous_ring = shard_router.get_hash_ring(PREVIOUS_SHARD_COUNT)
+    new_ring = shard_router.get_hash_ring(SHARD_COUNT)
+    user_id = next(z for z in range(1, 10000) if previous_ring.get_shard(z) != new_ring.get_shard(z))
+    return user_id, previous_ring.get_shard(user_id), new_ring.get_shard(user_id)
+
+
+def create_journal(db_owner_id: int) -> journal_handler.UserDBJournal:
+    journal = journal_handler.UserDBJournal.create(db_owner_id)
+    # Same as the journals made by UserDBJournalCreator.
+    change = journal_handler.UserDBJournalChangelogData()
+    change.tablename = 'TB_CARD'
+    change.uuid = 1
+    change.action = journal_handler.UserDBJournalActionCase.modify.value
+    change.column_data_map = dict()
+    journal.changes.append(change)
+    return journal
+
+
+def test_moved_user_without_pending_tasks_goes_to_new_shard(redis_conn, rebalancing, published_queues):
+    user_id, _, new_shard = get_moved_user_id()
+    journal = create_journal(user_id)
+
+    journal_handler.UserDBJournal.add_all_to_queue([journal, ])
+
+    assert published_queues == [shard_router.get_queue_name(new_shard), ]
+    # Journal must still be registered as pending, for the push notifier and the next journals.
+    assert redis_conn.sismember(user_db_file_io.SYNC_DB_TASK_SET_KEY(user_id), journal.task_id)
+
+
+def test_moved_user_with_pending_tasks_stays_on_previous_shard(redis_conn, rebalancing, published_queues):
+    user_id, previous_shard, _ = get_moved_user_id()
+    redis_conn.sadd(user_db_file_io.SYNC_DB_TASK_SET_KEY(user_id), 'pending-task-on-previous-shard')
+
+    journal_handler.UserDBJournal.add_all_to_queue([create_journal(user_id), create_journal(user_id), ])
+
+    # All journals of the user must be sent after the pending task, on the same queue.
+    assert published_queues == [shard_router.get_queue_name(previous_shard), ] * 2
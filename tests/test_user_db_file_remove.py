@@ -0,0 +1,38 @@
+import sqlite3
+
+import pytest
+
+import app.plugin.bca.user_db.connection_cache as connection_cache
+import app.plugin.bca.user_db.file_io as user_db_file_io
+
+USER_ID = 1
+
+
+@pytest.fixture
+def user_db_path(monkeypatch, tmp_path):
+    user_db_path = tmp_path / str(USER_ID) / 'sync_db.sqlite'
+    user_db_path.parent.mkdir(parents=True)
+    monkeypatch.setattr(user_db_file_io, 'SYNC_DB_ID_PATH', lambda user_id: tmp_path / str(user_id) / 'sync_db.sqlite')
+    monkeypatch.setattr(connection_cache, 'user_db_connection_cache', connection_cache.UserDBConnectionCache())
+    return user_db_path
+
+
+def get_sidecar_paths(user_db_path):
+    return [user_db_path.with_name(user_db_path.name + z) for z in user_db_file_io.SYNC_DB_SIDECAR_SUFFIXES]
+
+
+def test_delete_removes_wal_sidecars_and_cached_connection(user_db_path):
+    with sqlite3.connect(user_db_path) as setup_conn:
+        setup_conn.execute('CREATE TABLE TB_TEST (value INTEGER)')
+    conn = connection_cache.user_db_connection_cache.get(USER_ID, user_db_path)
+    conn.execute('INSERT INTO TB_TEST VALUES (1)')
+    conn.commit()
+    assert all(z.exists() for z in get_sidecar_paths(user_db_path))
+
+    user_db_file_io.BCaSyncFile.delete_fs(USER_ID)
+
+    assert not user_db_path.exists()
+    assert not any(z.exists() for z in get_sidecar_paths(user_db_path))
+    assert USER_ID not in connection_cache.user_db_connection_cache.entries
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.execute('SELECT 1')